@@ -0,0 +1,212 @@
+# analysis/combined_extraction.py
+
+import logging
+
+from db.database import (
+    get_connection,
+    iter_query,
+    stage_pending_condition,
+    mark_stage_done,
+    mark_stage_failed
+)
+from llm_calls import call_gpt_api_chunks, format_handled_articles, MODEL
+from utils import pack_summaries, batch_summaries
+from tokenizer import count_tokens
+from analysis.two_phase_grouping import (
+    CATEGORY_OUTPUT_TOKENS_PER_ARTICLE,
+    group_assignments_by_category,
+    save_category_assignments
+)
+from analysis.company_extraction import COMPANY_OUTPUT_TOKENS_PER_ARTICLE
+from db.checkpoints import ChunkRun
+from analysis.text_views import get_stage_text_view, text_view_sql, apply_text_view, load_text_view
+from analysis.taxonomy import get_categories
+
+logger = logging.getLogger(__name__)
+
+COMBINED_STAGES = ("companies", "categorization")
+# Combined runs are checkpointed under the 'companies' stage, in this scope
+CHECKPOINT_SCOPE = "combined"
+
+def get_articles_for_combined_extraction(db_path="db/news.db"):
+    """
+    Yields (link, text) for articles whose 'companies' AND 'categorization'
+    stages are both due (streamed, see iter_query), i.e. new articles.
+    Anything else (one stage already done, or backed off) is left to the
+    separate stages.
+    The text is in the 'companies' text view, which needs more of the article
+    than categorization does.
+    """
+    view = get_stage_text_view("companies", db_path=db_path)
+    query = f"""
+        SELECT
+            a.link,
+            {text_view_sql(view)} AS expanded_summary
+        FROM articles a
+        JOIN article_pipeline_state pc
+          ON pc.article_link = a.link AND pc.stage = 'companies'
+        JOIN article_pipeline_state pg
+          ON pg.article_link = a.link AND pg.stage = 'categorization'
+        WHERE {stage_pending_condition("pc")}
+          AND {stage_pending_condition("pg")}
+        ORDER BY a.published_date DESC
+    """
+    for link, text in iter_query(query, db_path=db_path):
+        yield link, apply_text_view(text, view)
+
+def extract_companies_and_categories(api_key, db_path="db/news.db"):
+    """
+    One LLM pass per chunk that returns both the companies and the top-level
+    category of every article, instead of sending the same text twice
+    (extract_company_names_for_all_articles + two_phase_grouping_with_predefined_categories).
+    Each chunk's companies and category memberships are saved in one transaction,
+    and every batch is a checkpointed run (see db/checkpoints.py); runs a
+    killed process left unfinished are resumed first.
+    Returns the number of articles processed.
+    """
+    categories = get_categories(db_path=db_path)
+    prompt_header = _combined_prompt_header(categories)
+    total_processed = 0
+    view = get_stage_text_view("companies", db_path=db_path)
+    for run in ChunkRun.unfinished("companies", scope=CHECKPOINT_SCOPE, db_path=db_path):
+        chunks = run.pending_chunks(load_text_view(run.pending_links(), view, db_path=db_path))
+        total_processed += _extract_batch(chunks, run, prompt_header, categories, api_key, db_path)
+
+    batches = batch_summaries(
+        ((link, text.strip()) for link, text in get_articles_for_combined_extraction(db_path=db_path)
+         if text and text.strip()),
+        model=MODEL,
+        prompt_tokens=count_tokens(prompt_header, MODEL),
+        output_tokens_per_article=CATEGORY_OUTPUT_TOKENS_PER_ARTICLE + COMPANY_OUTPUT_TOKENS_PER_ARTICLE
+    )
+    found = 0
+    for summaries_dict in batches:
+        found += len(summaries_dict)
+        chunks = list(pack_summaries(
+            summaries_dict,
+            model=MODEL,
+            prompt_tokens=count_tokens(prompt_header, MODEL),
+            output_tokens_per_article=CATEGORY_OUTPUT_TOKENS_PER_ARTICLE + COMPANY_OUTPUT_TOKENS_PER_ARTICLE
+        ))
+        run = ChunkRun.start("companies", chunks, scope=CHECKPOINT_SCOPE, db_path=db_path)
+        total_processed += _extract_batch(chunks, run, prompt_header, categories, api_key, db_path)
+
+    if not found and not total_processed:
+        logger.info("No new articles for combined company/category extraction.")
+        return 0
+    logger.info(f"Finished combined extraction for {total_processed} articles.")
+    return total_processed
+
+def _combined_prompt_header(categories):
+    """Prompt of the combined extraction, listing 'categories'."""
+    categories_text = "\n".join(f"- {cat}" for cat in categories)
+    return (
+        f"Here is the list of valid categories:\n\n{categories_text}\n\n"
+        "For each article below:\n"
+        "  - category: pick exactly one category from the list (or 'Other')\n"
+        "  - companies: all company names mentioned in the article\n\n"
+        "Return JSON only, in this format:\n"
+        "{ \"results\": [ {\"article_id\": 1, \"category\": \"...\", "
+        "\"companies\": [\"CompanyA\", \"CompanyB\"]}, ... ] }\n"
+        "where article_id is the article's number.\n\n"
+    )
+
+def _extract_batch(chunks, run, prompt_header, categories, api_key, db_path="db/news.db"):
+    """
+    Run the combined extraction for the chunks of 'run' (a ChunkRun) and save
+    them, checkpointing each saved chunk. Returns the number of articles processed.
+    """
+
+    def build_messages(handled_chunk, chunk_dict):
+        prompt = prompt_header + format_handled_articles(handled_chunk)
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "You are an AI that categorizes news articles and extracts the company names "
+                    "they mention. Return valid JSON only."
+                )
+            },
+            {"role": "user", "content": prompt}
+        ]
+
+    # Chunks a resumed run already had answered are saved from their stored answers
+    results_per_chunk = run.answered_results() + call_gpt_api_chunks(
+        chunks, build_messages, "results", api_key, model=MODEL
+    )
+    run.record_answers(results_per_chunk)
+
+    total_processed = 0
+    for idx, (chunk_dict, messages, results) in enumerate(results_per_chunk, start=1):
+        logger.info(
+            f"Saving combined extraction for chunk {idx}/{len(results_per_chunk)} "
+            f"with {len(chunk_dict)} articles."
+        )
+        if results is None:
+            _record_combined_failure(chunk_dict.keys(), "No usable response from GPT", db_path)
+            run.chunk_saved(chunk_dict)
+            continue
+
+        # Only accept IDs that were actually in this chunk
+        results = [
+            item for item in results
+            if isinstance(item, dict) and item.get("article_id") in chunk_dict
+        ]
+        total_processed += _save_combined_results(chunk_dict, results, categories, db_path)
+        run.chunk_saved(chunk_dict)
+
+    run.finish()
+    return total_processed
+
+def _save_combined_results(chunk_dict, results, categories, db_path="db/news.db"):
+    """
+    Write one chunk's companies and categories in a single transaction.
+    Returns the number of articles saved.
+    """
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        processed = set()
+        for item in results:
+            companies = item.get("companies", [])
+            if not isinstance(companies, list):
+                continue
+            processed.add(item["article_id"])
+            for comp in companies:
+                comp_name = str(comp).strip()
+                if comp_name:
+                    c.execute("""
+                        INSERT OR IGNORE INTO article_companies (article_link, company_name)
+                        VALUES (?, ?)
+                    """, (item["article_id"], comp_name))
+        mark_stage_done(c, processed, "companies")
+
+        missing = [link for link in chunk_dict if link not in processed]
+        save_category_assignments(c, {
+            "groups": group_assignments_by_category(
+                [item for item in results if item["article_id"] in processed],
+                categories=categories
+            ),
+            "failed": {link: "Missing from LLM response" for link in missing}
+        })
+        mark_stage_failed(c, missing, "companies", "Missing from LLM response")
+        conn.commit()
+        return len(processed)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"DB error saving combined extraction: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def _record_combined_failure(article_links, error, db_path="db/news.db"):
+    """
+    Record a failed attempt of both combined stages for every article in a chunk.
+    """
+    conn = get_connection(db_path)
+    try:
+        for stage in COMBINED_STAGES:
+            mark_stage_failed(conn.cursor(), list(article_links), stage, error)
+        conn.commit()
+    finally:
+        conn.close()
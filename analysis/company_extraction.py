@@ -1,77 +1,124 @@
 # analysis/company_extraction.py
 
 import sqlite3
-import json
-import re
 import time
-import pandas as pd
 import logging
 
-from db.database import get_connection
-from llm_calls import call_gpt_api
-from utils import chunk_summaries, MAX_TOKEN_CHUNK
+from db.database import (
+    get_connection,
+    iter_query,
+    stage_pending_condition,
+    mark_stage_done,
+    mark_stage_failed
+)
+from llm_calls import call_gpt_api_chunks, format_handled_articles
+from utils import pack_summaries, batch_summaries
+from tokenizer import count_tokens
+from db.checkpoints import ChunkRun
+from analysis.text_views import get_stage_text_view, text_view_sql, apply_text_view, load_text_view
 
 logger = logging.getLogger(__name__)
 MODEL = "o3-mini"  # or whichever model you prefer
+COMPANY_OUTPUT_TOKENS_PER_ARTICLE = 25
+
+COMPANY_PROMPT_HEADER = (
+    "You are a named-entity recognition AI. For each article, extract all company names mentioned. "
+    "Return only JSON with the format:\n"
+    "{ \"extractions\": [ {\"article_id\": 1, \"companies\": [\"CompanyA\", \"CompanyB\"]}, ... ] }\n"
+    "where article_id is the article's number.\n\n"
+)
 
 def get_articles_missing_company_extraction(db_path="db/news.db"):
     """
-    Returns a DataFrame of articles that do NOT have any entry in article_companies.
+    Yields (link, text) for articles whose 'companies' pipeline stage is due
+    (pending and past any retry backoff), streamed from the cursor (see
+    iter_query), with the text in the 'companies' text view (by default only
+    the start of each article is sent).
     """
-    conn = get_connection(db_path)
-    query = """
+    view = get_stage_text_view("companies", db_path=db_path)
+    query = f"""
         SELECT 
             a.link,
-            a.title || ' - ' || a.content AS expanded_summary
-        FROM articles a
-        WHERE NOT EXISTS (
-            SELECT 1 FROM article_companies ac
-            WHERE ac.article_link = a.link
-        )
+            {text_view_sql(view)} AS expanded_summary
+        FROM article_pipeline_state ps
+        JOIN articles a ON a.link = ps.article_link
+        WHERE ps.stage = 'companies'
+          AND {stage_pending_condition("ps")}
         ORDER BY a.published_date DESC
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    return df
+    for link, text in iter_query(query, db_path=db_path):
+        yield link, apply_text_view(text, view)
 
 def extract_company_names_for_all_articles(api_key, db_path="db/news.db"):
     """
     Identify articles with no company extractions, parse them with LLM for company names,
-    store results in article_companies.
+    store results in article_companies. Articles are streamed from the DB and
+    processed one batch (see batch_summaries) at a time, each batch as one
+    checkpointed run (see db/checkpoints.py); runs a killed process left
+    unfinished are resumed first.
     """
-    df = get_articles_missing_company_extraction(db_path=db_path)
-    if df.empty:
+    total_articles = total_extractions = 0
+    view = get_stage_text_view("companies", db_path=db_path)
+    for run in ChunkRun.unfinished("companies", db_path=db_path):
+        chunks = run.pending_chunks(load_text_view(run.pending_links(), view, db_path=db_path))
+        total_articles += sum(len(chunk) for chunk in chunks)
+        total_extractions += _extract_company_names(chunks, run, api_key, db_path)
+
+    empty_links = []
+
+    def texts():
+        for link, text in get_articles_missing_company_extraction(db_path=db_path):
+            text = (text or "").strip()
+            if text:
+                yield link, text
+            else:
+                empty_links.append(link)
+
+    batches = batch_summaries(
+        texts(),
+        model=MODEL,
+        prompt_tokens=count_tokens(COMPANY_PROMPT_HEADER, MODEL),
+        output_tokens_per_article=COMPANY_OUTPUT_TOKENS_PER_ARTICLE
+    )
+    for summaries_dict in batches:
+        chunks = list(pack_summaries(
+            summaries_dict,
+            model=MODEL,
+            prompt_tokens=count_tokens(COMPANY_PROMPT_HEADER, MODEL),
+            output_tokens_per_article=COMPANY_OUTPUT_TOKENS_PER_ARTICLE
+        ))
+        run = ChunkRun.start("companies", chunks, db_path=db_path)
+        total_articles += len(summaries_dict)
+        total_extractions += _extract_company_names(chunks, run, api_key, db_path)
+
+    if empty_links:
+        # Nothing to extract from; don't select these again
+        conn = get_connection(db_path)
+        mark_stage_done(conn.cursor(), empty_links, "companies")
+        conn.commit()
+        conn.close()
+
+    if not total_articles and not empty_links:
         logger.info("All articles already have company extractions.")
         return
 
-    # Build a dict {link: expanded_summary}
-    summaries_dict = {}
-    for _, row in df.iterrows():
-        link = row["link"]
-        content = str(row["expanded_summary"]).strip()
-        if content:
-            summaries_dict[link] = content
+    logger.info(
+        f"Finished extracting company names for {total_articles} articles. "
+        f"Inserted {total_extractions} new (article, company) pairs."
+    )
 
-    chunked_articles = list(chunk_summaries(summaries_dict, max_token_chunk=MAX_TOKEN_CHUNK))
+def _extract_company_names(chunked_articles, run, api_key, db_path="db/news.db"):
+    """
+    Extract and save the companies of the chunks of 'run' (a ChunkRun),
+    checkpointing each saved chunk. Returns the number of (article, company)
+    pairs inserted.
+    """
     total_extractions = 0
 
-    for idx, chunk_dict in enumerate(chunked_articles, start=1):
-        logger.info(
-            f"Extracting company names for chunk {idx}/{len(chunked_articles)} "
-            f"with {len(chunk_dict)} articles."
-        )
-
-        prompt = (
-            "You are a named-entity recognition AI. For each article, extract all company names mentioned. "
-            "Return only JSON with the format:\n"
-            "{ \"extractions\": [ {\"article_id\": \"...\", \"companies\": [\"CompanyA\", \"CompanyB\"]}, ... ] }\n\n"
-        )
-        # Append the article texts
-        for art_id, text in chunk_dict.items():
-            snippet = text[:5000]  # limit if needed
-            prompt += f"Article ID={art_id}:\n{snippet}\n\n"
-
-        messages = [
+    def build_messages(handled_chunk, chunk_dict):
+        # Append the article texts (already cut to the 'companies' text view)
+        prompt = COMPANY_PROMPT_HEADER + format_handled_articles(handled_chunk)
+        return [
             {
                 "role": "system",
                 "content": "Extract company names from the provided article texts."
@@ -82,46 +129,71 @@ def extract_company_names_for_all_articles(api_key, db_path="db/news.db"):
             }
         ]
 
-        resp = call_gpt_api(messages, api_key, model=MODEL)
-        if not resp:
-            logger.warning("No response from GPT for this chunk.")
-            continue
+    # Chunks are sent concurrently; malformed answers are salvaged / split and re-sent
+    # Chunks a resumed run already had answered are saved from their stored answers
+    results = run.answered_results() + call_gpt_api_chunks(
+        chunked_articles, build_messages, "extractions", api_key, model=MODEL
+    )
+    run.record_answers(results)
 
-        cleaned = resp.strip().strip("```")
-        cleaned = re.sub(r'^json\s+', '', cleaned, flags=re.IGNORECASE)
-        try:
-            data = json.loads(cleaned)
-            extractions = data.get("extractions", [])
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing extraction JSON: {e}\n{cleaned}")
-            extractions = []
+    for idx, (chunk_dict, messages, extractions) in enumerate(results, start=1):
+        logger.info(
+            f"Saving company names for chunk {idx}/{len(results)} "
+            f"with {len(chunk_dict)} articles."
+        )
+
+        if extractions is None:
+            logger.warning("No usable response from GPT for this chunk.")
+            _record_chunk_failure(chunk_dict.keys(), "No usable response from GPT", db_path)
+            run.chunk_saved(chunk_dict)
+            continue
 
         conn = get_connection(db_path)
         c = conn.cursor()
         try:
+            processed = set()
             for item in extractions:
+                if not isinstance(item, dict):
+                    continue
                 article_id = item.get("article_id")
                 companies = item.get("companies", [])
-                if not article_id or not isinstance(companies, list):
+                if article_id not in chunk_dict or not isinstance(companies, list):
                     continue
+                processed.add(article_id)
                 for comp in companies:
-                    comp_name = comp.strip()
+                    comp_name = str(comp).strip()
                     if comp_name:
                         c.execute("""
                             INSERT OR IGNORE INTO article_companies (article_link, company_name)
                             VALUES (?, ?)
                         """, (article_id, comp_name))
                         total_extractions += 1
+
+            # An empty company list is a valid answer: the stage is done either way
+            mark_stage_done(c, processed, "companies")
+            missing = [link for link in chunk_dict if link not in processed]
+            mark_stage_failed(c, missing, "companies", "Missing from LLM response")
             conn.commit()
         except Exception as e:
             conn.rollback()
             logger.error(f"DB error saving company extraction: {e}")
         finally:
             conn.close()
+        run.chunk_saved(chunk_dict)
 
-    logger.info(
-        f"Finished extracting company names. Inserted {total_extractions} new (article, company) pairs."
-    )
+    run.finish()
+    return total_extractions
+
+def _record_chunk_failure(article_links, error, db_path="db/news.db"):
+    """
+    Record a failed 'companies' attempt for every article in a chunk.
+    """
+    conn = get_connection(db_path)
+    try:
+        mark_stage_failed(conn.cursor(), list(article_links), "companies", error)
+        conn.commit()
+    finally:
+        conn.close()
 
 def get_companies_in_article_list(article_links, db_path="db/news.db"):
     """
@@ -167,3 +239,17 @@ def filter_articles_by_company(df_articles, company_name, db_path="db/news.db"):
 
     valid_links = {row[0] for row in matched}
     return df_articles[df_articles["link"].isin(valid_links)].copy()
+
+def get_all_company_names(db_path="db/news.db", include_archive=False):
+    """
+    Return all distinct company names in article_companies, most mentioned first.
+    """
+    conn = get_connection(db_path, include_archive=include_archive)
+    rows = conn.execute("""
+        SELECT company_name, COUNT(*) AS mentions
+        FROM article_companies
+        GROUP BY company_name
+        ORDER BY mentions DESC, company_name ASC
+    """).fetchall()
+    conn.close()
+    return [r[0] for r in rows]
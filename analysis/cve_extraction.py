@@ -7,8 +7,9 @@ import sqlite3
 import math
 from db.database import (
     get_connection,
-    insert_article_cve,
-    insert_or_update_cve_info
+    insert_or_update_cve_info,
+    stage_pending_condition,
+    mark_stage_done
 )
 from utils import extract_cves
 
@@ -19,37 +20,49 @@ CVE_REGEX = r'\bCVE-\d{4}-\d{4,7}\b'
 
 def process_cves_in_articles(db_path="db/news.db"):
     """
-    - For each article in 'articles', extract CVE numbers with a simple regex.
+    - For each article whose 'cves' pipeline stage is pending, extract CVE numbers with a simple regex.
     - Insert each CVE mention into 'article_cves' with (article_link, cve_id, published_date).
+    - Mark the stage done, so each article is only scanned once.
     """
     conn = get_connection(db_path)
     cursor = conn.cursor()
 
-    # Fetch all articles
-    cursor.execute("SELECT link, published_date, content FROM articles")
+    # Fetch only articles not scanned yet
+    cursor.execute(f"""
+        SELECT a.link, a.published_date, a.content
+        FROM article_pipeline_state ps
+        JOIN articles a ON a.link = ps.article_link
+        WHERE ps.stage = 'cves'
+          AND {stage_pending_condition("ps")}
+    """)
     articles = cursor.fetchall()
-    conn.close()
 
     total_found = 0
-    for link, published_date, content in articles:
-        found_cves = extract_cves(content or "")
-        if not found_cves:
-            continue
-        for cve in found_cves:
-            insert_article_cve(link, cve, published_date, db_path=db_path)
-            total_found += 1
-
-    print(f"Finished processing CVEs in articles. Inserted {total_found} new CVE references.")
-
-def build_cve_table(date_hours=None, db_path="db/news.db"):
+    try:
+        for link, published_date, content in articles:
+            for cve in extract_cves(content or ""):
+                cursor.execute("""
+                    INSERT OR IGNORE INTO article_cves (article_link, cve_id, published_date)
+                    VALUES (?, ?, ?)
+                """, (link, cve, published_date))
+                total_found += 1
+        mark_stage_done(cursor, [row[0] for row in articles], "cves")
+        conn.commit()
+    finally:
+        conn.close()
+
+    print(f"Finished processing CVEs in {len(articles)} articles. Inserted {total_found} new CVE references.")
+
+def build_cve_table(date_hours=None, db_path="db/news.db", include_archive=False):
     """
     Return a list or DataFrame with columns from article_cves (times seen, date range)
     plus cve_info (base score, vendor, products, etc.).
     If you use pandas, you can return a DataFrame directly.
+    With include_archive, mentions in archived articles are included.
     """
     import pandas as pd
 
-    conn = get_connection(db_path)
+    conn = get_connection(db_path, include_archive=include_archive)
     c = conn.cursor()
 
     # Filter by date if date_hours is provided
@@ -0,0 +1,344 @@
+# analysis/local_classifier.py
+"""
+Local category classifier: hashed TF-IDF + multinomial logistic regression,
+trained offline on the LLM's own category labels.
+
+Train a new model version (saved under CATEGORY_MODEL_DIR) with:
+
+    python -m analysis.local_classifier train
+
+and see how its confident predictions compare with the LLM's (per confidence
+band, from the audited articles) with:
+
+    python -m analysis.local_classifier report
+
+two_phase_grouping_with_predefined_categories uses the latest version to
+categorize new articles directly when it is confident enough, and only sends
+the rest to the LLM.
+"""
+
+import os
+import re
+import sys
+import json
+import random
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+from db.database import get_connection
+from analysis.taxonomy import get_categories
+from analysis.vectors import HASH_FEATURES, hashed_term_counts, fit_idf, tfidf
+from analysis.text_views import get_stage_text_view, load_text_view
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_MODEL_DIR = os.getenv("CATEGORY_MODEL_DIR", "models")
+# Predictions at or above this probability skip the LLM
+CLASSIFIER_CONFIDENCE_THRESHOLD = float(os.getenv("CLASSIFIER_CONFIDENCE_THRESHOLD", "0.9"))
+# Share of confident predictions still sent to the LLM, to keep measuring agreement
+CLASSIFIER_AUDIT_RATE = float(os.getenv("CLASSIFIER_AUDIT_RATE", "0.05"))
+# Don't train on fewer LLM-labelled articles than this
+MIN_TRAINING_ARTICLES = 500
+HOLDOUT_FRACTION = 0.1
+TRAINING_EPOCHS = 100
+LEARNING_RATE = 0.5
+L2_PENALTY = 1e-6
+# Confidence thresholds reported in the holdout / audit metrics
+REPORT_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.98)
+
+MODEL_FILE_PATTERN = re.compile(r"^category_classifier_v(\d+)\.npz$")
+
+class CategoryClassifier:
+    """A trained model version: idf weights, class weights and metadata."""
+
+    def __init__(self, categories, idf, features, weights, bias, meta=None):
+        self.categories = list(categories)
+        self.idf = idf
+        # Hashed features seen in training (sorted); row j of weights belongs to features[j]
+        self.features = features
+        self.weights = weights
+        self.bias = bias
+        self.meta = meta or {}
+
+    @property
+    def version(self):
+        return self.meta.get("version")
+
+    def predict_proba(self, texts):
+        """(len(texts), n_categories) class probabilities."""
+        rows = tfidf(texts, self.idf, len(self.idf)).restrict(self.features)
+        return _softmax(rows.dot(self.weights) + self.bias)
+
+    def predict(self, texts):
+        """[(category, confidence), ...] for 'texts'."""
+        if not texts:
+            return []
+        probs = self.predict_proba(texts)
+        best = probs.argmax(axis=1)
+        return [(self.categories[i], float(probs[row, i])) for row, i in enumerate(best)]
+
+    def save(self, model_dir=CATEGORY_MODEL_DIR):
+        """Write this model as the next version in model_dir; returns the path."""
+        os.makedirs(model_dir, exist_ok=True)
+        self.meta["version"] = (latest_model_version(model_dir) or 0) + 1
+        path = os.path.join(model_dir, f"category_classifier_v{self.meta['version']}.npz")
+        np.savez_compressed(
+            path,
+            idf=self.idf.astype(np.float32),
+            features=self.features,
+            weights=self.weights.astype(np.float32),
+            bias=self.bias.astype(np.float32),
+            categories=np.array(self.categories),
+            meta=np.array(json.dumps(self.meta))
+        )
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(
+                [str(c) for c in f["categories"]],
+                f["idf"].astype(np.float64),
+                f["features"],
+                f["weights"].astype(np.float64),
+                f["bias"].astype(np.float64),
+                json.loads(str(f["meta"]))
+            )
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def latest_model_version(model_dir=CATEGORY_MODEL_DIR):
+    """Highest saved model version in model_dir, or None."""
+    if not os.path.isdir(model_dir):
+        return None
+    versions = [int(m.group(1)) for m in map(MODEL_FILE_PATTERN.match, os.listdir(model_dir)) if m]
+    return max(versions) if versions else None
+
+_loaded = {}
+
+def load_category_classifier(model_dir=CATEGORY_MODEL_DIR, version=None):
+    """
+    The requested (default: CATEGORY_MODEL_VERSION env, else latest) model
+    version, or None if no model has been trained yet. Cached per version.
+    """
+    version = version or os.getenv("CATEGORY_MODEL_VERSION") or latest_model_version(model_dir)
+    if not version:
+        return None
+    path = os.path.join(model_dir, f"category_classifier_v{int(version)}.npz")
+    if path not in _loaded:
+        if not os.path.exists(path):
+            logger.warning(f"Category model {path} not found; sending all articles to the LLM.")
+            return None
+        _loaded[path] = CategoryClassifier.load(path)
+    return _loaded[path]
+
+def get_llm_labelled_articles(categories, db_path="db/news.db"):
+    """
+    {link: category} for articles the LLM categorized (never the classifier's
+    own assignments, so it doesn't learn from itself).
+    """
+    conn = get_connection(db_path)
+    rows = conn.execute("""
+        SELECT tgm.article_link, tg.main_topic
+        FROM two_phase_article_group_memberships tgm
+        JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
+        JOIN articles a ON a.link = tgm.article_link
+        WHERE COALESCE(tgm.assigned_by, 'llm') = 'llm'
+    """).fetchall()
+    conn.close()
+    return {link: cat for link, cat in rows if cat in categories}
+
+def _fit_softmax(rows, labels, n_classes, epochs=TRAINING_EPOCHS, lr=LEARNING_RATE, l2=L2_PENALTY):
+    """Full-batch Adam on the multinomial logistic loss; returns (weights, bias)."""
+    weights = np.zeros((rows.n_features, n_classes))
+    bias = np.zeros(n_classes)
+    onehot = np.eye(n_classes)[labels]
+    m_w, v_w = np.zeros_like(weights), np.zeros_like(weights)
+    m_b, v_b = np.zeros_like(bias), np.zeros_like(bias)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    for t in range(1, epochs + 1):
+        probs = _softmax(rows.dot(weights) + bias)
+        err = (probs - onehot) / rows.n_rows
+        grad_w = rows.t_dot(err) + l2 * weights
+        grad_b = err.sum(axis=0)
+        for param, grad, m, v in ((weights, grad_w, m_w, v_w), (bias, grad_b, m_b, v_b)):
+            m *= beta1
+            m += (1 - beta1) * grad
+            v *= beta2
+            v += (1 - beta2) * grad ** 2
+            param -= lr * (m / (1 - beta1 ** t)) / (np.sqrt(v / (1 - beta2 ** t)) + eps)
+    return weights, bias
+
+def threshold_metrics(confidences, correct, thresholds=REPORT_THRESHOLDS):
+    """
+    For each threshold: the share of articles at or above it (coverage, i.e.
+    LLM calls saved) and how often those agree with the LLM (accuracy).
+    """
+    confidences = np.asarray(confidences, dtype=float)
+    correct = np.asarray(correct, dtype=bool)
+    metrics = []
+    for threshold in thresholds:
+        covered = confidences >= threshold
+        metrics.append({
+            "threshold": threshold,
+            "coverage": float(covered.mean()) if len(covered) else 0.0,
+            "accuracy": float(correct[covered].mean()) if covered.any() else None,
+        })
+    return metrics
+
+def train_category_classifier(categories=None, db_path="db/news.db", model_dir=CATEGORY_MODEL_DIR, seed=0):
+    """
+    Train a new model version on the LLM-labelled articles (text in the
+    categorization text view), evaluate it on a held-out split and save it.
+    Returns the saved CategoryClassifier, or None if there isn't enough data.
+    """
+    if categories is None:
+        categories = get_categories(db_path=db_path)
+
+    labelled = get_llm_labelled_articles(categories, db_path=db_path)
+    view = get_stage_text_view("categorization", db_path=db_path)
+    texts = load_text_view(list(labelled), view, db_path=db_path)
+    links = sorted(link for link in labelled if texts.get(link))
+    if len(links) < MIN_TRAINING_ARTICLES:
+        logger.info(f"Only {len(links)} LLM-labelled articles; need {MIN_TRAINING_ARTICLES} to train.")
+        return None
+
+    random.Random(seed).shuffle(links)
+    n_holdout = max(1, int(len(links) * HOLDOUT_FRACTION))
+    holdout, train = links[:n_holdout], links[n_holdout:]
+    class_index = {cat: i for i, cat in enumerate(categories)}
+
+    idf = fit_idf(hashed_term_counts([texts[link] for link in train]))
+    rows = tfidf([texts[link] for link in train], idf)
+    # Only features that occur in training get a weight row
+    features = np.unique(rows.indices)
+    weights, bias = _fit_softmax(
+        rows.restrict(features),
+        np.array([class_index[labelled[link]] for link in train]),
+        len(categories)
+    )
+
+    model = CategoryClassifier(categories, idf, features, weights, bias, {
+        "trained_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "text_view": view,
+        "n_features": HASH_FEATURES,
+        "train_size": len(train),
+        "holdout_size": len(holdout),
+    })
+    predictions = model.predict([texts[link] for link in holdout])
+    correct = [cat == labelled[link] for (cat, _), link in zip(predictions, holdout)]
+    model.meta["holdout_accuracy"] = float(np.mean(correct))
+    model.meta["holdout_thresholds"] = threshold_metrics([conf for _, conf in predictions], correct)
+
+    path = model.save(model_dir)
+    logger.info(f"Saved category model v{model.version} to {path} "
+                f"(holdout accuracy {model.meta['holdout_accuracy']:.1%}).")
+    return model
+
+def classify_articles(summaries_dict, threshold=CLASSIFIER_CONFIDENCE_THRESHOLD,
+                      audit_rate=CLASSIFIER_AUDIT_RATE, model=None, categories=None):
+    """
+    Split articles into ones the local model is confident about and ones for
+    the LLM. Returns (confident, for_llm, audits):
+      confident  {link: (category, confidence)} - assign directly
+      for_llm    [link, ...] - low confidence, or picked for audit
+      audits     {link: (category, confidence)} - confident predictions also
+                 sent to the LLM, to record agreement (record_classifier_audits)
+    Without a trained model, or one trained on other 'categories' than the
+    current taxonomy, everything goes to the LLM.
+    """
+    model = model or load_category_classifier()
+    links = list(summaries_dict)
+    if model is None or not links:
+        return {}, links, {}
+    if categories is not None and set(model.categories) != set(categories):
+        logger.info(f"Local classifier v{model.version} predates the current taxonomy; retrain it.")
+        return {}, links, {}
+
+    confident, for_llm, audits = {}, [], {}
+    for link, (category, confidence) in zip(links, model.predict([summaries_dict[l] for l in links])):
+        if confidence < threshold:
+            for_llm.append(link)
+        elif random.random() < audit_rate:
+            for_llm.append(link)
+            audits[link] = (category, confidence)
+        else:
+            confident[link] = (category, confidence)
+    logger.info(f"Local classifier v{model.version}: {len(confident)} of {len(links)} articles "
+                f"categorized locally, {len(audits)} audited.")
+    return confident, for_llm, audits
+
+def record_classifier_audits(audits, llm_assignments, model_version=None, db_path="db/news.db"):
+    """
+    Store the local prediction next to the LLM's category for audited articles.
+    llm_assignments is {link: category}; model_version defaults to the model
+    classify_articles uses.
+    """
+    if model_version is None:
+        model = load_category_classifier()
+        model_version = model.version if model else None
+    rows = [
+        (model_version, link, predicted, llm_assignments[link], confidence)
+        for link, (predicted, confidence) in audits.items() if link in llm_assignments
+    ]
+    if not rows:
+        return
+    conn = get_connection(db_path)
+    try:
+        conn.executemany("""
+            INSERT OR REPLACE INTO classifier_audits
+                (model_version, article_link, predicted_category, llm_category, confidence)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_classifier_agreement(model_version=None, db_path="db/news.db"):
+    """
+    Agreement between the local model and the LLM on audited articles:
+    {"audited": n, "agreement": share, "thresholds": threshold_metrics(...)}.
+    Audits only cover predictions above the threshold in use when they ran.
+    """
+    model_version = model_version or latest_model_version()
+    conn = get_connection(db_path)
+    rows = conn.execute("""
+        SELECT confidence, predicted_category = llm_category
+        FROM classifier_audits
+        WHERE model_version = ?
+    """, (model_version,)).fetchall()
+    conn.close()
+    confidences = [r[0] for r in rows]
+    correct = [bool(r[1]) for r in rows]
+    return {
+        "model_version": model_version,
+        "audited": len(rows),
+        "agreement": float(np.mean(correct)) if rows else None,
+        "thresholds": threshold_metrics(confidences, correct),
+    }
+
+def _print_thresholds(metrics):
+    for m in metrics:
+        acc = f"{m['accuracy']:.1%}" if m["accuracy"] is not None else "-"
+        print(f"  >= {m['threshold']:.2f}: coverage {m['coverage']:.1%}, agreement {acc}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    if command == "train":
+        model = train_category_classifier()
+        if model:
+            print(f"Model v{model.version}: holdout accuracy {model.meta['holdout_accuracy']:.1%}")
+            _print_thresholds(model.meta["holdout_thresholds"])
+    elif command == "report":
+        stats = get_classifier_agreement()
+        print(f"Model v{stats['model_version']}: {stats['audited']} audited articles")
+        _print_thresholds(stats["thresholds"])
+    else:
+        print("usage: python -m analysis.local_classifier [train|report]")
@@ -0,0 +1,131 @@
+# analysis/search.py
+
+import re
+import pandas as pd
+from datetime import datetime, timedelta
+import pytz
+
+from db.database import get_connection, is_archive_attached
+
+SEARCH_RESULT_LIMIT = 50
+# bm25 column weights for (title, content): a hit in the title counts more
+TITLE_WEIGHT = 5.0
+CONTENT_WEIGHT = 1.0
+
+def build_fts_query(user_query: str) -> str:
+    """
+    Turn free-form user input into a safe FTS5 MATCH expression.
+    Every word becomes a quoted term (implicit AND); a trailing '*' keeps
+    prefix matching, e.g. 'ransom*'. Returns '' if nothing searchable remains.
+    """
+    terms = []
+    for word, star in re.findall(r'(\w+)(\*?)', user_query or ""):
+        terms.append(f'"{word}"' + ("*" if star else ""))
+    return " ".join(terms)
+
+def search_articles(user_query,
+                    date_hours=None,
+                    category=None,
+                    source=None,
+                    company=None,
+                    limit=SEARCH_RESULT_LIMIT,
+                    db_path="db/news.db",
+                    include_archive=False):
+    """
+    Full-text search over article titles and content, ranked by bm25.
+    Optional filters: date_hours (published within N hours), category (top-level
+    two-phase category), source and company. '(All)' or empty disables a filter.
+    With include_archive, the archive DB's index is searched as well.
+
+    Returns a DataFrame with link, title, source, published_date, snippet
+    (with <mark> highlights) and score (lower is better).
+    """
+    fts_query = build_fts_query(user_query)
+    if not fts_query:
+        return pd.DataFrame(columns=["link", "title", "source", "published_date", "snippet", "score"])
+
+    conditions = []
+    params = []
+
+    if date_hours is not None:
+        cutoff_utc = datetime.now(pytz.UTC) - timedelta(hours=date_hours)
+        conditions.append("a.published_date >= ?")
+        params.append(cutoff_utc.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+    if source and source != "(All)":
+        conditions.append("a.source = ?")
+        params.append(source)
+
+    if category and category != "(All)":
+        conditions.append("""EXISTS (
+            SELECT 1
+            FROM two_phase_article_group_memberships tgm
+            JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
+            WHERE tgm.article_link = a.link
+              AND tg.main_topic = ?
+        )""")
+        params.append(category)
+
+    if company and company != "(All)":
+        conditions.append("""EXISTS (
+            SELECT 1 FROM article_companies ac
+            WHERE ac.article_link = a.link
+              AND ac.company_name = ?
+        )""")
+        params.append(company)
+
+    conn = get_connection(db_path, include_archive=include_archive)
+    try:
+        schemas = ["main"] + (["archive"] if is_archive_attached(conn) else [])
+        # One ranked query per database; the filter subqueries use the
+        # combined views when the archive is attached. Each ranks its matches
+        # and keeps the top 'limit' rowids first ('top'), so snippet() and the
+        # article columns are only read for those rows, not for every match
+        # (the CROSS JOINs keep 'top' as the outer loop).
+        selects = []
+        all_params = []
+        for schema in schemas:
+            join = f"JOIN {schema}.articles a ON a.rowid = articles_fts.rowid" if conditions else ""
+            where = " AND ".join(["articles_fts MATCH ?"] + conditions)
+            selects.append(f"""
+                SELECT
+                    a.link,
+                    a.title,
+                    a.source,
+                    a.published_date,
+                    snippet(articles_fts, -1, '<mark>', '</mark>', ' … ', 32) AS snippet,
+                    top.score
+                FROM (
+                    SELECT articles_fts.rowid AS rowid,
+                           bm25(articles_fts, {TITLE_WEIGHT}, {CONTENT_WEIGHT}) AS score
+                    FROM {schema}.articles_fts
+                    {join}
+                    WHERE {where}
+                    ORDER BY score
+                    LIMIT ?
+                ) AS top
+                CROSS JOIN {schema}.articles_fts
+                CROSS JOIN {schema}.articles a
+                WHERE articles_fts MATCH ?
+                  AND articles_fts.rowid = top.rowid
+                  AND a.rowid = top.rowid
+            """)
+            all_params += [fts_query] + params + [limit, fts_query]
+        query = " UNION ALL ".join(selects) + " ORDER BY score LIMIT ?"
+        df = pd.read_sql_query(query, conn, params=all_params + [limit])
+    finally:
+        conn.close()
+    return df
+
+def get_article_sources(db_path="db/news.db", include_archive=False):
+    """
+    Return the distinct article sources, for filter dropdowns.
+    """
+    conn = get_connection(db_path, include_archive=include_archive)
+    rows = conn.execute("""
+        SELECT DISTINCT source FROM articles
+        WHERE source IS NOT NULL AND source != ''
+        ORDER BY source ASC
+    """).fetchall()
+    conn.close()
+    return [r[0] for r in rows]
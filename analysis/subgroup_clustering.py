@@ -0,0 +1,157 @@
+# analysis/subgroup_clustering.py
+
+import os
+import numpy as np
+
+from analysis.vectors import hashed_term_counts, fit_idf, tfidf
+
+# Dense size of the article embeddings (count-sketch of hashed TF-IDF)
+EMBEDDING_DIM = 1024
+# Average cosine similarity two clusters need to be merged into one subgroup
+SUBGROUP_SIMILARITY_THRESHOLD = float(os.getenv("SUBGROUP_SIMILARITY_THRESHOLD", "0.2"))
+# Cosine similarity to an existing subgroup's centroid at which a new article
+# is attached to that subgroup instead of being clustered
+SUBGROUP_ASSIGN_THRESHOLD = float(os.getenv("SUBGROUP_ASSIGN_THRESHOLD", "0.35"))
+# Articles per cluster shown to the LLM when naming it
+CLUSTER_REPRESENTATIVES = 3
+
+def embed_texts(texts, idf=None):
+    """
+    (len(texts), EMBEDDING_DIM) unit-length embeddings of 'texts'. The idf is
+    fitted on 'texts' themselves unless given.
+    """
+    if idf is None:
+        idf = fit_idf(hashed_term_counts(texts))
+    vectors = tfidf(texts, idf).sketch(EMBEDDING_DIM)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def agglomerative_clusters(vectors, threshold=SUBGROUP_SIMILARITY_THRESHOLD):
+    """
+    Average-linkage agglomerative clustering on cosine similarity of unit
+    'vectors': keep merging the two most similar clusters while their average
+    pairwise similarity is at least 'threshold'.
+    Returns a list of clusters (lists of row indices), largest first.
+    """
+    n = len(vectors)
+    if n == 0:
+        return []
+    sim = vectors @ vectors.T
+    np.fill_diagonal(sim, -np.inf)
+    sizes = np.ones(n)
+    alive = np.ones(n, dtype=bool)
+    members = {i: [i] for i in range(n)}
+    # Most similar other cluster per row (average linkage never creates a
+    # better pair than the ones it merges, so these only need local updates)
+    best = sim.argmax(axis=1) if n > 1 else np.zeros(1, dtype=int)
+
+    while n > 1:
+        rows = np.flatnonzero(alive)
+        i = rows[np.argmax(sim[rows, best[rows]])]
+        j = best[i]
+        if not alive[j] or sim[i, j] < threshold:
+            break
+
+        # Merge j into i (Lance-Williams update for average linkage)
+        merged = (sizes[i] * sim[i] + sizes[j] * sim[j]) / (sizes[i] + sizes[j])
+        sim[i, :] = merged
+        sim[:, i] = merged
+        sim[i, i] = -np.inf
+        sim[j, :] = -np.inf
+        sim[:, j] = -np.inf
+        sizes[i] += sizes[j]
+        alive[j] = False
+        members[i].extend(members.pop(j))
+
+        if alive.sum() < 2:
+            break
+        # Rows that pointed at i or j, and i itself, need a fresh best partner
+        stale = np.flatnonzero(alive & ((best == i) | (best == j)))
+        stale = np.union1d(stale, [i])
+        best[stale] = sim[stale].argmax(axis=1)
+        # Rows for which the merged cluster is now the best partner
+        better = alive & (sim[:, i] > sim[np.arange(len(best)), best])
+        best[better] = i
+
+    return sorted(members.values(), key=len, reverse=True)
+
+def cluster_centroid(vectors):
+    """Unit-length mean of a cluster's embeddings."""
+    centroid = vectors.mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    return centroid / norm if norm else centroid
+
+def representative_rows(vectors, cluster, count=CLUSTER_REPRESENTATIVES):
+    """The 'count' rows of 'cluster' closest to its centroid, most central first."""
+    centroid = cluster_centroid(vectors[cluster])
+    order = np.argsort(-(vectors[cluster] @ centroid))
+    return [cluster[k] for k in order[:count]]
+
+def nearest_centroids(vectors, centroids, threshold=SUBGROUP_ASSIGN_THRESHOLD):
+    """
+    Index of the most similar row of 'centroids' for every row of 'vectors',
+    or -1 where the best cosine similarity is below 'threshold'.
+    """
+    if len(vectors) == 0 or len(centroids) == 0:
+        return np.full(len(vectors), -1)
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    sims = vectors @ (centroids / norms).T
+    best = sims.argmax(axis=1)
+    return np.where(sims[np.arange(len(vectors)), best] >= threshold, best, -1)
+
+def load_subgroup_centroids(c, category, active_between=None):
+    """
+    (subgroup_ids, centroids, counts) of the subgroups of 'category' that have
+    a stored centroid, read with cursor 'c'. With active_between=(start, end)
+    (julian days), only subgroups with a member published in that range.
+    """
+    condition = ""
+    params = [category]
+    if active_between:
+        condition = """
+          AND EXISTS (
+              SELECT 1 FROM two_phase_subgroup_memberships m
+              JOIN articles a ON a.link = m.article_link
+              WHERE m.subgroup_id = two_phase_subgroups.subgroup_id
+                AND julianday(a.published_date) BETWEEN ? AND ?
+          )"""
+        params += list(active_between)
+    rows = c.execute(f"""
+        SELECT subgroup_id, centroid, centroid_count
+        FROM two_phase_subgroups
+        WHERE category = ? AND centroid IS NOT NULL{condition}
+    """, params).fetchall()
+    ids = [row[0] for row in rows]
+    centroids = np.array([np.frombuffer(row[1], dtype=np.float32) for row in rows]).reshape(len(rows), EMBEDDING_DIM)
+    counts = [row[2] or 0 for row in rows]
+    return ids, centroids, counts
+
+def add_to_subgroup_centroid(c, subgroup_id, vectors, centroid=None, count=0):
+    """
+    Fold the embeddings of newly added members into a subgroup's stored mean
+    ('centroid' and 'count' are its current values; None for a new subgroup).
+    The caller commits.
+    """
+    total = vectors.sum(axis=0)
+    if centroid is not None and count:
+        total = total + centroid * count
+    count += len(vectors)
+    store_subgroup_centroid(c, subgroup_id, total / count, count)
+
+def merge_centroids(centroids, counts):
+    """Mean and member count of the union of subgroups with these centroids."""
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if not total:
+        return np.mean(centroids, axis=0), 0
+    return (centroids * counts[:, None]).sum(axis=0) / total, int(total)
+
+def store_subgroup_centroid(c, subgroup_id, centroid, count):
+    """Write a subgroup's centroid and member count (the caller commits)."""
+    c.execute("""
+        UPDATE two_phase_subgroups
+        SET centroid = ?, centroid_count = ?
+        WHERE subgroup_id = ?
+    """, (np.asarray(centroid, dtype=np.float32).tobytes(), count, subgroup_id))
@@ -0,0 +1,272 @@
+# analysis/subgroup_compaction.py
+
+import os
+import logging
+import numpy as np
+
+from db.database import get_connection, mark_subgroup_summarized
+from llm_calls import call_gpt_api_chunks, format_handled_articles, MODEL
+from utils import pack_summaries
+from tokenizer import count_tokens
+from analysis.vectors import WORD_PATTERN
+from analysis.subgroup_clustering import load_subgroup_centroids, merge_centroids, store_subgroup_centroid
+from analysis.two_phase_grouping import backfill_subgroup_centroids, CLUSTER_NAME_OUTPUT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# How often a category is compacted
+SUBGROUP_COMPACTION_INTERVAL_HOURS = float(os.getenv("SUBGROUP_COMPACTION_INTERVAL_HOURS", "6"))
+# Two subgroups are merged when their members are at most this far apart in time and
+#   - their centroids have at least SUBGROUP_MERGE_SIMILARITY cosine similarity and
+#     their labels share at least SUBGROUP_MERGE_LABEL_SIMILARITY of their words, or
+#   - their centroids have at least SUBGROUP_MERGE_STRONG_SIMILARITY cosine similarity
+SUBGROUP_MERGE_MAX_GAP_HOURS = 72
+SUBGROUP_MERGE_SIMILARITY = 0.5
+SUBGROUP_MERGE_LABEL_SIMILARITY = 0.3
+SUBGROUP_MERGE_STRONG_SIMILARITY = 0.8
+
+MERGE_PROMPT_HEADER = (
+    "Each numbered item below lists subgroups of news articles (label: summary) "
+    "that cover the same story and are being merged into one. For each item, return:\n"
+    "  - group_label: a short descriptive title for the merged subgroup\n"
+    "  - summary: a 2-3 sentence summary of the merged subgroup\n\n"
+    "Return JSON only, with the structure:\n"
+    "{ \"subgroups\": [ {\"subgroup_id\": 1, \"group_label\": \"...\", \"summary\": \"...\"}, ... ] }\n\n"
+)
+
+def label_similarity(a, b):
+    """Jaccard similarity of the words of two labels."""
+    words_a = set(WORD_PATTERN.findall((a or "").lower()))
+    words_b = set(WORD_PATTERN.findall((b or "").lower()))
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+def _time_compatible(span_a, span_b, max_gap_hours=SUBGROUP_MERGE_MAX_GAP_HOURS):
+    """
+    True if two (first, last) publish julian days are at most max_gap_hours
+    apart (unknown dates never block a merge).
+    """
+    if None in span_a or None in span_b:
+        return True
+    gap_days = max(span_b[0] - span_a[1], span_a[0] - span_b[1], 0)
+    return gap_days * 24 <= max_gap_hours
+
+def find_mergeable_subgroups(subgroups, centroids, changed):
+    """
+    Groups of subgroups to merge, as lists of row indices into 'subgroups'
+    (dicts with group_label and span) and 'centroids'. Only pairs involving
+    at least one 'changed' row are considered; rows are joined transitively.
+    """
+    n = len(subgroups)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    unit = centroids / norms
+    for i in np.flatnonzero(changed):
+        sims = unit @ unit[i]
+        for j in np.flatnonzero(sims >= SUBGROUP_MERGE_SIMILARITY):
+            if j == i or find(i) == find(j):
+                continue
+            if not _time_compatible(subgroups[i]["span"], subgroups[j]["span"]):
+                continue
+            if (sims[j] >= SUBGROUP_MERGE_STRONG_SIMILARITY or
+                    label_similarity(subgroups[i]["group_label"], subgroups[j]["group_label"])
+                    >= SUBGROUP_MERGE_LABEL_SIMILARITY):
+                parent[find(j)] = find(i)
+
+    components = {}
+    for i in range(n):
+        components.setdefault(find(i), []).append(i)
+    return [rows for rows in components.values() if len(rows) > 1]
+
+def _load_subgroups(c, category, subgroup_ids):
+    """
+    {subgroup_id: {group_label, summary, updated_at, summarized_through, span}}
+    for the hot subgroups of 'category', with span = (first, last) member
+    publish julian day.
+    """
+    rows = c.execute("""
+        SELECT s.subgroup_id, s.group_label, s.summary, s.updated_at, s.summarized_through,
+               MIN(julianday(a.published_date)), MAX(julianday(a.published_date))
+        FROM two_phase_subgroups s
+        LEFT JOIN two_phase_subgroup_memberships m ON m.subgroup_id = s.subgroup_id
+        LEFT JOIN articles a ON a.link = m.article_link
+        WHERE s.category = ?
+        GROUP BY s.subgroup_id
+    """, (category,)).fetchall()
+    wanted = set(subgroup_ids)
+    return {
+        row[0]: {"group_label": row[1], "summary": row[2], "updated_at": row[3],
+                 "summarized_through": row[4], "span": (row[5], row[6])}
+        for row in rows if row[0] in wanted
+    }
+
+def _last_compaction(c, category):
+    row = c.execute(
+        "SELECT compacted_at FROM subgroup_compaction_runs WHERE category = ?", (category,)
+    ).fetchone()
+    return row[0] if row else None
+
+def compaction_due(category, db_path="db/news.db"):
+    """True if 'category' was never compacted or not within the interval."""
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute("""
+            SELECT 1 FROM subgroup_compaction_runs
+            WHERE category = ? AND compacted_at > datetime('now', ?)
+        """, (category, f"-{SUBGROUP_COMPACTION_INTERVAL_HOURS} hours")).fetchone()
+    finally:
+        conn.close()
+    return row is None
+
+def _name_merged_subgroups(merges, subgroups, category, api_key):
+    """
+    {survivor_id: (group_label, summary)} for each merge, written by the LLM
+    from the merged subgroups' labels and summaries (no article text).
+    """
+    texts = {
+        survivor: f"Category: {category}\n" + "\n".join(
+            f"- {subgroups[sid]['group_label']}: {subgroups[sid]['summary'] or ''}" for sid in members
+        )
+        for survivor, members in merges.items()
+    }
+    chunks = list(pack_summaries(
+        texts,
+        model=MODEL,
+        prompt_tokens=count_tokens(MERGE_PROMPT_HEADER, MODEL),
+        output_tokens_per_article=CLUSTER_NAME_OUTPUT_TOKENS
+    ))
+
+    def build_messages(handled_chunk, chunk_dict):
+        return [
+            {
+                "role": "system",
+                "content": "You merge duplicate news subgroups. Return valid JSON only."
+            },
+            {
+                "role": "user",
+                "content": MERGE_PROMPT_HEADER + format_handled_articles(handled_chunk)
+            }
+        ]
+
+    names = {}
+    for chunk_dict, messages, items in call_gpt_api_chunks(
+            chunks, build_messages, "subgroups", api_key, id_field="subgroup_id"):
+        for item in items or []:
+            if item.get("subgroup_id") in chunk_dict and item.get("group_label"):
+                names[item["subgroup_id"]] = (str(item["group_label"]), str(item.get("summary", "")))
+    return names
+
+def compact_category_subgroups(category, api_key, db_path="db/news.db"):
+    """
+    Merge the subgroups of 'category' that cover the same story (see
+    find_mergeable_subgroups) into the largest of them: memberships are moved,
+    the others are deleted and the survivor's centroid is combined, all in one
+    transaction. Only merged survivors get a new label and summary. Only
+    subgroups updated since the previous compaction are compared against the
+    rest, and only hot (non-archived) memberships are moved.
+    Returns the number of subgroups removed.
+    """
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        backfill_subgroup_centroids(c, category, db_path=db_path)
+        conn.commit()
+        subgroup_ids, centroids, counts = load_subgroup_centroids(c, category)
+        subgroups = _load_subgroups(c, category, subgroup_ids)
+        since = _last_compaction(c, category)
+    finally:
+        conn.close()
+
+    keep = [k for k, sid in enumerate(subgroup_ids) if sid in subgroups]
+    subgroup_ids = [subgroup_ids[k] for k in keep]
+    centroids, counts = centroids[keep], [counts[k] for k in keep]
+    rows = [subgroups[sid] for sid in subgroup_ids]
+    changed = np.array([since is None or (row["updated_at"] or "") > since for row in rows], dtype=bool)
+
+    merges = {}  # survivor id -> [subgroup ids, survivor first]
+    merged_rows = {}
+    for component in find_mergeable_subgroups(rows, centroids, changed):
+        component.sort(key=lambda k: (-counts[k], subgroup_ids[k]))
+        survivor = subgroup_ids[component[0]]
+        merges[survivor] = [subgroup_ids[k] for k in component]
+        merged_rows[survivor] = component
+
+    names = _name_merged_subgroups(merges, subgroups, category, api_key) if merges else {}
+
+    removed = 0
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        for survivor, members in merges.items():
+            others = members[1:]
+            placeholders = ",".join("?" for _ in others)
+            c.execute(f"""
+                INSERT OR IGNORE INTO two_phase_subgroup_memberships (article_link, subgroup_id, added_at)
+                SELECT article_link, ?, added_at FROM two_phase_subgroup_memberships
+                WHERE subgroup_id IN ({placeholders})
+            """, [survivor] + others)
+            c.execute(f"""
+                DELETE FROM two_phase_subgroup_memberships WHERE subgroup_id IN ({placeholders})
+            """, others)
+            c.execute(f"""
+                DELETE FROM two_phase_subgroups WHERE subgroup_id IN ({placeholders})
+            """, others)
+
+            if survivor in names:
+                label, summary = names[survivor]
+                c.execute("""
+                    UPDATE two_phase_subgroups
+                    SET group_label = ?, summary = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE subgroup_id = ?
+                """, (label, summary, survivor))
+                mark_subgroup_summarized(c, survivor)
+            else:
+                # Not renamed: the summary only covers the survivor's own members,
+                # at most up to the oldest summarized_through of the merged subgroups
+                c.execute("""
+                    UPDATE two_phase_subgroups
+                    SET summarized_through = MIN(COALESCE(summarized_through, ''), ?),
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE subgroup_id = ?
+                """, (min(subgroups[sid]["summarized_through"] or "" for sid in members), survivor))
+            component = merged_rows[survivor]
+            centroid, count = merge_centroids(centroids[component], [counts[k] for k in component])
+            store_subgroup_centroid(c, survivor, centroid, count)
+            removed += len(others)
+
+        c.execute("""
+            INSERT INTO subgroup_compaction_runs (category, compacted_at)
+            VALUES (?, CURRENT_TIMESTAMP)
+            ON CONFLICT(category) DO UPDATE SET compacted_at = excluded.compacted_at
+        """, (category,))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error compacting subgroups of '{category}': {e}")
+        return 0
+    finally:
+        conn.close()
+
+    if removed:
+        logger.info(f"Merged {removed} duplicate subgroups into {len(merges)} in '{category}'.")
+    return removed
+
+def compact_subgroups(categories, api_key, db_path="db/news.db", force=False):
+    """
+    Compact every category in 'categories' that is due (or all, with force).
+    Returns {category: number of subgroups removed} for the compacted ones.
+    """
+    return {
+        category: compact_category_subgroups(category, api_key, db_path=db_path)
+        for category in categories
+        if force or compaction_due(category, db_path=db_path)
+    }
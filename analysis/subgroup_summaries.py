@@ -0,0 +1,146 @@
+# analysis/subgroup_summaries.py
+
+import logging
+
+from db.database import get_connection
+from llm_calls import call_gpt_api_chunks, format_handled_articles, MODEL
+from utils import pack_summaries
+from tokenizer import count_tokens, truncate_to_tokens
+from analysis.text_views import get_stage_text_view, text_view_sql, apply_text_view
+
+logger = logging.getLogger(__name__)
+
+# Tokens of each newly added article sent with a summary update
+SUMMARY_UPDATE_ARTICLE_TOKENS = 300
+# Newly added articles sent per subgroup and update (oldest first); the rest
+# are left for the next run, so one update always fits in a request
+SUMMARY_UPDATE_MAX_ARTICLES = 20
+SUMMARY_UPDATE_OUTPUT_TOKENS = 150
+
+SUMMARY_UPDATE_PROMPT_HEADER = (
+    "Each numbered item below is a subgroup of news articles: its current summary, "
+    "followed by articles that were added to it since. For each item, return an updated "
+    "2-3 sentence summary that keeps what still matters and adds what the new articles report.\n\n"
+    "Return JSON only, with the structure:\n"
+    "{ \"subgroups\": [ {\"subgroup_id\": 1, \"summary\": \"...\"}, ... ] }\n\n"
+)
+
+def get_subgroups_with_new_members(db_path="db/news.db", max_articles=SUMMARY_UPDATE_MAX_ARTICLES):
+    """
+    Subgroups with members added after their summary was written
+    (added_at > summarized_through), with the text of the oldest
+    'max_articles' of those members:
+    {subgroup_id: {category, group_label, summary, through, new_articles}},
+    where 'through' is the added_at of the last member included.
+    Members added together share an added_at, so a batch is taken whole or
+    left for later; only a batch that alone exceeds max_articles is cut, and
+    its remaining members count as summarized.
+    """
+    view = get_stage_text_view("subgrouping", db_path=db_path)
+    conn = get_connection(db_path)
+    rows = conn.execute(f"""
+        SELECT s.subgroup_id, s.category, s.group_label, s.summary, m.added_at,
+               {text_view_sql(view)}
+        FROM two_phase_subgroups s
+        JOIN two_phase_subgroup_memberships m ON m.subgroup_id = s.subgroup_id
+        JOIN articles a ON a.link = m.article_link
+        WHERE m.added_at > COALESCE(s.summarized_through, '')
+        ORDER BY s.subgroup_id, m.added_at
+    """).fetchall()
+    conn.close()
+
+    subgroups = {}
+    batches = {}  # subgroup_id -> [(added_at, [texts])], oldest first
+    for subgroup_id, category, label, summary, added_at, text in rows:
+        subgroups.setdefault(subgroup_id, {
+            "category": category,
+            "group_label": label,
+            "summary": summary,
+            "through": None,
+            "new_articles": []
+        })
+        added = batches.setdefault(subgroup_id, [])
+        if not added or added[-1][0] != added_at:
+            added.append((added_at, []))
+        if text:
+            text = apply_text_view(text, view)
+            added[-1][1].append(truncate_to_tokens(text, SUMMARY_UPDATE_ARTICLE_TOKENS, MODEL))
+
+    for subgroup_id, added in batches.items():
+        entry = subgroups[subgroup_id]
+        for added_at, texts in added:
+            room = max_articles - len(entry["new_articles"])
+            if entry["through"] is not None and len(texts) > room:
+                break
+            entry["new_articles"].extend(texts[:room])
+            entry["through"] = added_at
+    return subgroups
+
+def update_subgroup_summaries(api_key, db_path="db/news.db"):
+    """
+    Roll the summary of every subgroup that gained members forward: the LLM
+    gets the previous summary plus only the articles added since
+    summarized_through (at most SUMMARY_UPDATE_MAX_ARTICLES per run), so the
+    cost follows the new content, not the subgroup's size. Subgroups without an answer keep their marker and are
+    retried next run. Returns the number of summaries updated.
+    """
+    subgroups = get_subgroups_with_new_members(db_path=db_path)
+    if not subgroups:
+        logger.info("No subgroup summaries to update.")
+        return 0
+
+    texts = {
+        subgroup_id: (
+            f"Category: {entry['category']}\n"
+            f"Subgroup: {entry['group_label']}\n"
+            f"Current summary: {entry['summary'] or '(none)'}\n"
+            "New articles:\n" + "\n".join(f"- {text}" for text in entry["new_articles"])
+        )
+        for subgroup_id, entry in subgroups.items()
+    }
+    chunks = list(pack_summaries(
+        texts,
+        model=MODEL,
+        prompt_tokens=count_tokens(SUMMARY_UPDATE_PROMPT_HEADER, MODEL),
+        output_tokens_per_article=SUMMARY_UPDATE_OUTPUT_TOKENS
+    ))
+
+    def build_messages(handled_chunk, chunk_dict):
+        return [
+            {
+                "role": "system",
+                "content": "You keep summaries of news story subgroups up to date. Return valid JSON only."
+            },
+            {
+                "role": "user",
+                "content": SUMMARY_UPDATE_PROMPT_HEADER + format_handled_articles(handled_chunk)
+            }
+        ]
+
+    logger.info(f"Updating {len(subgroups)} subgroup summaries in {len(chunks)} requests.")
+    updates = []
+    for chunk_dict, messages, items in call_gpt_api_chunks(
+            chunks, build_messages, "subgroups", api_key, id_field="subgroup_id"):
+        for item in items or []:
+            subgroup_id = item.get("subgroup_id")
+            if subgroup_id in chunk_dict and item.get("summary"):
+                updates.append((str(item["summary"]), subgroups[subgroup_id]["through"], subgroup_id))
+
+    conn = get_connection(db_path)
+    try:
+        # Only up to the members that were sent: later additions stay "new"
+        conn.executemany("""
+            UPDATE two_phase_subgroups
+            SET summary = ?, summarized_through = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE subgroup_id = ?
+        """, updates)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error saving subgroup summaries: {e}")
+        return 0
+    finally:
+        conn.close()
+
+    logger.info(f"Updated {len(updates)} of {len(subgroups)} subgroup summaries.")
+    return len(updates)
@@ -0,0 +1,162 @@
+# analysis/taxonomy.py
+"""
+Versioned category taxonomy, stored in taxonomy_versions / taxonomy_categories.
+Adding or splitting a category creates a new version and queues only the
+articles of the affected categories (plus "Other") for re-categorization;
+the regular categorization stage then works through them in batches, and
+the per-article pipeline state makes that resumable.
+
+    python -m analysis.taxonomy list
+    python -m analysis.taxonomy add "New Category" [Parent ...]
+    python -m analysis.taxonomy split Parent "Child A" "Child B" ...
+"""
+
+import sys
+import sqlite3
+import logging
+
+from db.database import get_connection, reset_stage
+
+logger = logging.getLogger(__name__)
+
+# Version 1 of the taxonomy
+SEED_CATEGORIES = [
+    "Science & Environment",
+    "Business, Finance & Trade",
+    "Artificial Intelligence & Machine Learning",
+    "Software Development & Open Source",
+    "Cybersecurity & Data Privacy",
+    "Politics & Government",
+    "Consumer Technology & Gadgets",
+    "Automotive, Space & Transportation",
+    "Enterprise Technology & Cloud Computing",
+    "Other"
+]
+FALLBACK_CATEGORY = "Other"
+
+def get_taxonomy_version(db_path="db/news.db"):
+    """Current taxonomy version (0 if none was stored yet: SEED_CATEGORIES)."""
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute("SELECT MAX(version) FROM taxonomy_versions").fetchone()
+    finally:
+        conn.close()
+    return row[0] or 0
+
+def get_categories(db_path="db/news.db", version=None):
+    """
+    Category names of the current (or given) taxonomy version, "Other" last.
+    """
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute("""
+            SELECT name FROM taxonomy_categories
+            WHERE version = COALESCE(?, (SELECT MAX(version) FROM taxonomy_versions))
+            ORDER BY position
+        """, (version,)).fetchall()
+    except sqlite3.OperationalError:
+        # A dashboard snapshot published before the taxonomy tables existed
+        rows = []
+    finally:
+        conn.close()
+    return [row[0] for row in rows] or list(SEED_CATEGORIES)
+
+def _create_version(c, categories, derived_from, note):
+    """Insert a new taxonomy version with cursor 'c'; returns its number."""
+    version = (c.execute("SELECT MAX(version) FROM taxonomy_versions").fetchone()[0] or 0) + 1
+    c.execute("INSERT INTO taxonomy_versions (version, note) VALUES (?, ?)", (version, note))
+    c.executemany("""
+        INSERT INTO taxonomy_categories (version, name, position, derived_from)
+        VALUES (?, ?, ?, ?)
+    """, [(version, name, pos, derived_from.get(name)) for pos, name in enumerate(categories)])
+    return version
+
+def _queue_reclassification(c, categories):
+    """
+    Put the categorization stage of every article currently in 'categories'
+    back to pending. Returns the number of queued articles.
+    """
+    placeholders = ",".join("?" for _ in categories)
+    links = [row[0] for row in c.execute(f"""
+        SELECT tgm.article_link
+        FROM two_phase_article_group_memberships tgm
+        JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
+        WHERE tg.main_topic IN ({placeholders})
+    """, list(categories))]
+    reset_stage(c, links, "categorization")
+    return len(links)
+
+def _change_taxonomy(categories, derived_from, affected, note, db_path):
+    """
+    Store 'categories' as a new version (the current one is stored first if it
+    only exists as SEED_CATEGORIES) and queue the articles of 'affected' and
+    "Other" for re-categorization, in one transaction.
+    Returns (version, number of queued articles).
+    """
+    current = get_categories(db_path=db_path)
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        if not c.execute("SELECT 1 FROM taxonomy_versions").fetchone():
+            _create_version(c, current, {}, "initial categories")
+        version = _create_version(c, categories, derived_from, note)
+        queued = _queue_reclassification(c, set(affected) | {FALLBACK_CATEGORY})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logger.info(f"Taxonomy v{version}: {note}; {queued} articles queued for re-categorization.")
+    return version, queued
+
+def add_category(name, parents=(), db_path="db/news.db"):
+    """
+    Add category 'name'. Articles in 'parents' (categories it takes articles
+    from) and in "Other" are re-categorized. Returns (version, queued articles).
+    """
+    categories = get_categories(db_path=db_path)
+    if name in categories:
+        raise ValueError(f"Category already exists: {name!r}")
+    unknown = [p for p in parents if p not in categories]
+    if unknown:
+        raise ValueError(f"Unknown parent categories: {unknown}")
+
+    new_categories = [cat for cat in categories if cat != FALLBACK_CATEGORY] + [name, FALLBACK_CATEGORY]
+    derived_from = {name: parents[0]} if len(parents) == 1 else {}
+    return _change_taxonomy(new_categories, derived_from, parents, f"added {name}", db_path)
+
+def split_category(parent, children, db_path="db/news.db"):
+    """
+    Replace category 'parent' with 'children' (the parent may be one of them to
+    keep it). Only the parent's and "Other"'s articles are re-categorized.
+    Returns (version, queued articles).
+    """
+    categories = get_categories(db_path=db_path)
+    if parent not in categories or parent == FALLBACK_CATEGORY:
+        raise ValueError(f"Cannot split category {parent!r}")
+    clashes = [child for child in children if child in categories and child != parent]
+    if clashes or len(children) < 2:
+        raise ValueError(f"A split needs at least two new children, got {list(children)}")
+
+    idx = categories.index(parent)
+    new_categories = categories[:idx] + list(children) + categories[idx + 1:]
+    derived_from = {child: parent for child in children if child != parent}
+    return _change_taxonomy(new_categories, derived_from, [parent],
+                            f"split {parent} into {', '.join(children)}", db_path)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("", [])
+    if command == "list":
+        print(f"Taxonomy v{get_taxonomy_version()}:")
+        for cat in get_categories():
+            print(f"  {cat}")
+    elif command == "add" and args:
+        version, queued = add_category(args[0], parents=args[1:])
+        print(f"Taxonomy v{version}: {queued} articles queued for re-categorization.")
+    elif command == "split" and len(args) >= 3:
+        version, queued = split_category(args[0], args[1:])
+        print(f"Taxonomy v{version}: {queued} articles queued for re-categorization.")
+    else:
+        print("usage: python -m analysis.taxonomy [list | add NAME [PARENT ...] | split PARENT CHILD CHILD ...]")
@@ -0,0 +1,203 @@
+# analysis/text_views.py
+
+import os
+import logging
+
+from db.database import get_connection, LEAD_TEXT_CHARS
+from llm_calls import MODEL
+from tokenizer import truncate_to_tokens
+from analysis.taxonomy import get_categories
+
+logger = logging.getLogger(__name__)
+
+# How much of an article each LLM stage sends:
+#   "title"        the title only
+#   "lead:<N>"     title + the first N tokens of the body
+#   "full"         title + the whole body
+# Override per stage with STAGE_TEXT_VIEW_<STAGE>, e.g. STAGE_TEXT_VIEW_CATEGORIZATION=lead:200.
+DEFAULT_STAGE_TEXT_VIEWS = {
+    "companies": "lead:1200",
+    "categorization": "lead:300",
+    "subgrouping": "full",
+}
+# Cheapest first; measure_categorization_views picks the first that is accurate enough
+CATEGORIZATION_VIEW_CANDIDATES = ("title", "lead:100", "lead:200", "lead:400", "full")
+TEXT_VIEW_ACCURACY_TARGET = 0.95
+TEXT_VIEW_SAMPLE_SIZE = 200
+# A measurement that got no reference answers is retried after this long
+TEXT_VIEW_RETRY_HOURS = 24
+# lead_text holds LEAD_TEXT_CHARS characters; assume at most this many per token
+# when deciding whether a lead view can be served from it
+MAX_CHARS_PER_TOKEN = 5
+
+def parse_text_view(spec):
+    """
+    'title' / 'full' / 'lead:<N>' -> (kind, N or None). Raises ValueError otherwise.
+    """
+    kind, _, tokens = spec.strip().partition(":")
+    if kind in ("title", "full") and not tokens:
+        return kind, None
+    if kind == "lead" and tokens.isdigit() and int(tokens) > 0:
+        return kind, int(tokens)
+    raise ValueError(f"Invalid text view: {spec!r}")
+
+def text_view_sql(spec, alias="a"):
+    """
+    SQL expression selecting the article text for view 'spec'. Lead views are
+    read from the pre-computed lead_text column when it is long enough
+    (apply_text_view then trims them to N tokens).
+    """
+    kind, tokens = parse_text_view(spec)
+    if kind == "title":
+        return f"{alias}.title"
+    if kind == "lead" and tokens * MAX_CHARS_PER_TOKEN <= LEAD_TEXT_CHARS:
+        return f"{alias}.title || ' - ' || COALESCE({alias}.lead_text, {alias}.content)"
+    return f"{alias}.title || ' - ' || {alias}.content"
+
+def apply_text_view(text, spec, model=MODEL):
+    """
+    Trim text selected with text_view_sql(spec) to the view's token budget.
+    """
+    kind, tokens = parse_text_view(spec)
+    if kind != "lead" or not text:
+        return text
+    return truncate_to_tokens(text, tokens, model)
+
+def get_stage_text_view(stage, db_path="db/news.db"):
+    """
+    Text view used by 'stage': the STAGE_TEXT_VIEW_<STAGE> environment
+    variable if set, else the view last chosen by measurement (stage_text_views),
+    else DEFAULT_STAGE_TEXT_VIEWS.
+    """
+    override = os.getenv(f"STAGE_TEXT_VIEW_{stage.upper()}")
+    if override:
+        parse_text_view(override)
+        return override
+
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute(
+            "SELECT text_view FROM stage_text_views WHERE stage = ?", (stage,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else DEFAULT_STAGE_TEXT_VIEWS.get(stage, "full")
+
+def needs_view_measurement(stage, db_path="db/news.db"):
+    """
+    True if 'stage' has neither an environment override nor a measured view
+    yet. A failed measurement (recorded with sample_size 0) is retried once it
+    is TEXT_VIEW_RETRY_HOURS old.
+    """
+    if os.getenv(f"STAGE_TEXT_VIEW_{stage.upper()}"):
+        return False
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute("""
+            SELECT 1 FROM stage_text_views
+            WHERE stage = ?
+              AND (sample_size IS NULL OR sample_size > 0
+                   OR measured_at > datetime('now', ?))
+        """, (stage, f"-{TEXT_VIEW_RETRY_HOURS} hours")).fetchone()
+    finally:
+        conn.close()
+    return row is None
+
+def save_stage_text_view(stage, spec, accuracy=None, sample_size=None, db_path="db/news.db"):
+    """
+    Record the text view 'stage' should use from now on.
+    """
+    parse_text_view(spec)
+    conn = get_connection(db_path)
+    try:
+        conn.execute("""
+            INSERT INTO stage_text_views (stage, text_view, accuracy, sample_size, measured_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(stage) DO UPDATE SET
+                text_view = excluded.text_view,
+                accuracy = excluded.accuracy,
+                sample_size = excluded.sample_size,
+                measured_at = excluded.measured_at
+        """, (stage, spec, accuracy, sample_size))
+        conn.commit()
+    finally:
+        conn.close()
+
+def load_text_view(links, spec, db_path="db/news.db"):
+    """
+    {link: text} for 'links' under view 'spec'.
+    """
+    if not links:
+        return {}
+    conn = get_connection(db_path)
+    placeholders = ",".join("?" for _ in links)
+    rows = conn.execute(f"""
+        SELECT a.link, {text_view_sql(spec)}
+        FROM articles a
+        WHERE a.link IN ({placeholders})
+    """, list(links)).fetchall()
+    conn.close()
+    return {link: apply_text_view(text, spec) for link, text in rows if text}
+
+def measure_categorization_views(api_key,
+                                 candidates=CATEGORIZATION_VIEW_CANDIDATES,
+                                 target=TEXT_VIEW_ACCURACY_TARGET,
+                                 sample_size=TEXT_VIEW_SAMPLE_SIZE,
+                                 db_path="db/news.db"):
+    """
+    Categorize a random sample of already-categorized articles under every
+    candidate view, score each view by its agreement with the 'full' view's
+    categories, and store the cheapest view that reaches 'target' as the
+    categorization view. Every view is categorized by the LLM alone (no local
+    classifier, so no classifier audits are recorded), and nothing is written
+    to the grouping tables.
+
+    Returns {view: accuracy}.
+    """
+    # Imported here: two_phase_grouping itself reads the stage views
+    from analysis.two_phase_grouping import _category_chunks, _llm_category_assignments, _valid_category
+
+    conn = get_connection(db_path)
+    links = [row[0] for row in conn.execute("""
+        SELECT article_link FROM article_pipeline_state
+        WHERE stage = 'categorization' AND status = 'done'
+        ORDER BY random()
+        LIMIT ?
+    """, (sample_size,))]
+    conn.close()
+    if not links:
+        logger.info("No categorized articles to measure text views on.")
+        return {}
+
+    categories = get_categories(db_path=db_path)
+
+    def categorize(spec):
+        chunks = _category_chunks(load_text_view(links, spec, db_path=db_path), categories)
+        assignments, _ = _llm_category_assignments(chunks, categories, api_key)
+        return {assn["article_id"]: _valid_category(assn.get("category"), categories) for assn in assignments}
+
+    reference = categorize("full")
+    if not reference:
+        # Keep the current view, but record the attempt so the measurement
+        # calls are not re-sent every cycle (see needs_view_measurement)
+        current = get_stage_text_view("categorization", db_path=db_path)
+        save_stage_text_view("categorization", current, None, 0, db_path=db_path)
+        logger.warning(f"No reference categories from the full view; keeping '{current}' "
+                       f"and retrying in {TEXT_VIEW_RETRY_HOURS} hours.")
+        return {}
+
+    accuracies = {}
+    chosen = None
+    for spec in candidates:
+        answers = reference if spec == "full" else categorize(spec)
+        agree = sum(1 for link, cat in reference.items() if answers.get(link) == cat)
+        accuracies[spec] = agree / len(reference)
+        logger.info(f"Categorization view {spec}: {accuracies[spec]:.1%} agreement with full text.")
+        if accuracies[spec] >= target:
+            chosen = spec
+            break
+
+    chosen = chosen or "full"
+    save_stage_text_view("categorization", chosen, accuracies.get(chosen, 1.0), len(reference), db_path=db_path)
+    logger.info(f"Categorization now uses the '{chosen}' text view.")
+    return accuracies
@@ -1,57 +1,84 @@
 # analysis/two_phase_grouping.py
 
-import sqlite3
+import os
 import json
-import re
 import pandas as pd
-from datetime import datetime, timedelta
-import pytz
-
-from db.database import get_connection
-from llm_calls import call_gpt_api
-from utils import chunk_summaries, MAX_TOKEN_CHUNK
-
-# Predefined categories, as in original code
-PREDEFINED_CATEGORIES = [
-    "Science & Environment",
-    "Business, Finance & Trade",
-    "Artificial Intelligence & Machine Learning",
-    "Software Development & Open Source",
-    "Cybersecurity & Data Privacy",
-    "Politics & Government",
-    "Consumer Technology & Gadgets",
-    "Automotive, Space & Transportation",
-    "Enterprise Technology & Cloud Computing",
-    "Other"
-]
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from db.database import (
+    get_connection,
+    iter_query,
+    stage_pending_condition,
+    mark_stage_done,
+    mark_stage_failed,
+    reset_stage,
+    mark_subgroup_summarized,
+    MEMBERSHIP_ADDED_AT_SQL
+)
+from db.checkpoints import ChunkRun
+from llm_calls import call_gpt_api_chunks, format_handled_articles, MODEL
+from utils import pack_summaries, batch_summaries
+from tokenizer import count_tokens, truncate_to_tokens
+from analysis.text_views import get_stage_text_view, text_view_sql, apply_text_view, load_text_view
+from analysis.local_classifier import classify_articles, record_classifier_audits
+from analysis.taxonomy import get_categories, SEED_CATEGORIES
+from analysis.subgroup_clustering import (
+    embed_texts,
+    agglomerative_clusters,
+    representative_rows,
+    nearest_centroids,
+    load_subgroup_centroids,
+    add_to_subgroup_centroid
+)
+
+# Initial categories; the current taxonomy is stored in the DB (get_categories)
+PREDEFINED_CATEGORIES = SEED_CATEGORIES
+
+# Expected answer size per article, reserved when packing chunks
+CATEGORY_OUTPUT_TOKENS_PER_ARTICLE = 15
+SUBGROUP_OUTPUT_TOKENS_PER_ARTICLE = 20
+CLUSTER_NAME_OUTPUT_TOKENS = 120
+
+# 'local': cluster locally, the LLM only names clusters; 'llm': the LLM clusters chunks itself
+SUBGROUP_CLUSTERING = os.getenv("SUBGROUP_CLUSTERING", "local")
+# Tokens of each representative article shown when naming a cluster
+REPRESENTATIVE_TOKENS = 200
+# Categories sub-grouped at the same time (the LLM calls within a category are concurrent too)
+SUBGROUP_WORKERS = int(os.getenv("SUBGROUP_WORKERS", "4"))
+# Pending articles are sub-grouped in publish-time windows of this many hours,
+# newest first; existing subgroups active within the overlap of a window's
+# edges can still take its articles
+SUBGROUP_WINDOW_HOURS = float(os.getenv("SUBGROUP_WINDOW_HOURS", "72"))
+SUBGROUP_WINDOW_OVERLAP_HOURS = float(os.getenv("SUBGROUP_WINDOW_OVERLAP_HOURS", "12"))
+# Window of the articles whose publish date cannot be parsed
+UNDATED_WINDOW = (None, None)
 
 def get_ungrouped_articles_two_phase(db_path="db/news.db"):
     """
-    Articles not assigned to any two-phase category.
+    Yields (link, text) for articles whose 'categorization' pipeline stage is
+    due, streamed from the cursor (see iter_query), with the text in the
+    categorization text view (see analysis/text_views.py).
     """
-    conn = get_connection(db_path)
-    query = """
+    view = get_stage_text_view("categorization", db_path=db_path)
+    query = f"""
         SELECT 
             a.link as article_link,
-            a.title || ' - ' || a.content as expanded_summary,
-            a.published_date as created_at
-        FROM articles a
-        WHERE NOT EXISTS (
-            SELECT 1 FROM two_phase_article_group_memberships tgm
-            WHERE tgm.article_link = a.link
-        )
+            {text_view_sql(view)} as expanded_summary
+        FROM article_pipeline_state ps
+        JOIN articles a ON a.link = ps.article_link
+        WHERE ps.stage = 'categorization'
+          AND {stage_pending_condition("ps")}
         ORDER BY a.published_date DESC
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    return df
+    for link, text in iter_query(query, db_path=db_path):
+        yield link, apply_text_view(text, view)
 
-def get_existing_groups_two_phase(db_path="db/news.db"):
+def get_existing_groups_two_phase(db_path="db/news.db", include_archive=False):
     """
     Fetch all first-level categories (two_phase_article_groups),
     along with the articles that belong to each group.
     """
-    conn = get_connection(db_path)
+    conn = get_connection(db_path, include_archive=include_archive)
     query = """
         SELECT 
             tpg.group_id,
@@ -78,11 +105,11 @@ def get_existing_groups_two_phase(db_path="db/news.db"):
         )
     return df
 
-def get_articles_for_group_two_phase(group_id, db_path="db/news.db"):
+def get_articles_for_group_two_phase(group_id, db_path="db/news.db", include_archive=False):
     """
     Return all articles for a top-level two_phase group_id.
     """
-    conn = get_connection(db_path)
+    conn = get_connection(db_path, include_archive=include_archive)
     query = """
         SELECT 
             a.link,
@@ -99,39 +126,84 @@ def get_articles_for_group_two_phase(group_id, db_path="db/news.db"):
     conn.close()
     return df
 
-def get_articles_in_category_not_subgrouped(category: str, db_path="db/news.db"):
+def _window_condition(window, alias="a"):
     """
-    Return articles assigned to 'category' but NOT in any subgroups for that category.
+    SQL condition (and params) selecting the articles published in 'window'
+    ((start, end) julian days, end exclusive; UNDATED_WINDOW; or None for all).
+    """
+    if window is None:
+        return "", []
+    if window == UNDATED_WINDOW:
+        return f"AND julianday({alias}.published_date) IS NULL", []
+    return (f"AND julianday({alias}.published_date) >= ? AND julianday({alias}.published_date) < ?",
+            list(window))
+
+def get_subgroup_windows(category: str, window_hours=SUBGROUP_WINDOW_HOURS, db_path="db/news.db"):
+    """
+    Publish-time windows covering the articles of 'category' whose
+    'subgrouping' stage is due, newest first: each window spans window_hours
+    back from its newest article, and empty stretches get no window.
+    Articles without a parseable date are in UNDATED_WINDOW, last.
     """
     conn = get_connection(db_path)
-    query = """
+    query = f"""
+        SELECT julianday(a.published_date) AS day
+        FROM article_pipeline_state ps
+        JOIN articles a ON a.link = ps.article_link
+        JOIN two_phase_article_group_memberships tgm ON tgm.article_link = a.link
+        JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
+        WHERE ps.stage = 'subgrouping'
+          AND {stage_pending_condition("ps")}
+          AND tg.main_topic = ?
+        ORDER BY day DESC
+    """
+    days = [row[0] for row in conn.execute(query, (category,))]
+    conn.close()
+
+    windows = []
+    span = window_hours / 24
+    for day in days:
+        if day is None:
+            if UNDATED_WINDOW not in windows:
+                windows.append(UNDATED_WINDOW)
+        elif not windows or day < windows[-1][0]:
+            # Just past the newest remaining article, so it is inside (end is exclusive)
+            end = day + 1e-6
+            windows.append((end - span, end))
+    return sorted(windows, key=lambda w: w[1] is None)
+
+def get_articles_in_category_not_subgrouped(category: str, db_path="db/news.db", window=None):
+    """
+    Yields (link, text) for articles assigned to 'category' whose 'subgrouping'
+    pipeline stage is due, streamed from the cursor (see iter_query), with the
+    text in the subgrouping text view (only those published in 'window', see
+    get_subgroup_windows, if given).
+    """
+    view = get_stage_text_view("subgrouping", db_path=db_path)
+    window_sql, window_params = _window_condition(window)
+    query = f"""
         SELECT 
             a.link, 
-            a.title || ' - ' || a.content AS expanded_summary, 
-            a.published_date
-        FROM articles a
+            {text_view_sql(view)} AS expanded_summary
+        FROM article_pipeline_state ps
+        JOIN articles a ON a.link = ps.article_link
         JOIN two_phase_article_group_memberships tgm ON tgm.article_link = a.link
         JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
-        WHERE tg.main_topic = ?
-          AND NOT EXISTS (
-              SELECT 1 
-              FROM two_phase_subgroup_memberships tsgm
-              JOIN two_phase_subgroups tsg ON tsg.subgroup_id = tsgm.subgroup_id
-              WHERE tsgm.article_link = a.link
-                AND tsg.category = ?
-          )
+        WHERE ps.stage = 'subgrouping'
+          AND {stage_pending_condition("ps")}
+          AND tg.main_topic = ?
+          {window_sql}
         ORDER BY a.published_date DESC
     """
-    df = pd.read_sql_query(query, conn, params=(category, category))
-    conn.close()
-    return df
+    for link, text in iter_query(query, [category] + window_params, db_path=db_path):
+        yield link, apply_text_view(text, view)
 
-def get_subgroups_for_category(category: str, db_path="db/news.db"):
+def get_subgroups_for_category(category: str, db_path="db/news.db", include_archive=False):
     """
     Fetch subgroups in a given category from two_phase_subgroups,
     along with a count of assigned articles.
     """
-    conn = get_connection(db_path)
+    conn = get_connection(db_path, include_archive=include_archive)
     query = """
         SELECT 
             tsg.subgroup_id,
@@ -152,11 +224,11 @@ def get_subgroups_for_category(category: str, db_path="db/news.db"):
     conn.close()
     return df
 
-def get_articles_for_subgroup(subgroup_id: int, db_path="db/news.db"):
+def get_articles_for_subgroup(subgroup_id: int, db_path="db/news.db", include_archive=False):
     """
     Return articles for a given subgroup.
     """
-    conn = get_connection(db_path)
+    conn = get_connection(db_path, include_archive=include_archive)
     query = """
         SELECT 
             a.link, 
@@ -172,9 +244,15 @@ def get_articles_for_subgroup(subgroup_id: int, db_path="db/news.db"):
     conn.close()
     return df
 
-def two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_path="db/news.db"):
+def two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_path="db/news.db",
+                                                  checkpoint=False):
     """
-    Assign articles to one of the PREDEFINED_CATEGORIES or 'Other'.
+    Assign articles to one of the current categories (see analysis/taxonomy.py) or 'Other'.
+    Articles the local classifier is confident about are assigned directly;
+    only the rest (plus a small audit sample) go to the LLM.
+    With checkpoint, the LLM chunks are recorded as a 'categorization' run
+    (see db/checkpoints.py), returned as "run" for the caller to finish
+    once the result is saved.
     Returns a dict like:
     {
       "groups": [
@@ -185,20 +263,65 @@ def two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_pa
            "articles": [...]
          },
          ...
-      ]
+      ],
+      "failed": {article_link: error, ...}
     }
     """
     if not summaries_dict:
-        return {"groups": []}
+        return {"groups": [], "failed": {}}
+
+    categories = get_categories(db_path=db_path)
+
+    # Local pre-pass: confident predictions skip the LLM
+    confident, for_llm, audits = classify_articles(summaries_dict, categories=categories)
+    llm_summaries = {link: summaries_dict[link] for link in for_llm}
+
+    chunks = _category_chunks(llm_summaries, categories)
+    run = ChunkRun.start("categorization", chunks, db_path=db_path) if checkpoint else None
+    all_assignments, failed = _llm_category_assignments(chunks, categories, api_key, run=run)
+
+    if audits:
+        record_classifier_audits(audits, {
+            assn["article_id"]: _valid_category(assn.get("category"), categories) for assn in all_assignments
+        }, db_path=db_path)
+
+    local_assignments = [
+        {"article_id": link, "category": category} for link, (category, _) in confident.items()
+    ]
+    result = {
+        "groups": group_assignments_by_category(all_assignments, categories=categories)
+                  + group_assignments_by_category(local_assignments, assigned_by="classifier",
+                                                  categories=categories),
+        "failed": failed
+    }
+    if run:
+        result["run"] = run
+    return result
+
+def _categories_text(categories):
+    return "\n".join(f"- {cat}" for cat in categories)
 
+def _category_chunks(summaries_dict, categories):
+    """Pack articles into as few categorization requests as fit the model's context budget."""
+    return list(pack_summaries(
+        summaries_dict,
+        model=MODEL,
+        prompt_tokens=count_tokens(_categories_text(categories), MODEL) + 150,
+        output_tokens_per_article=CATEGORY_OUTPUT_TOKENS_PER_ARTICLE
+    ))
+
+def _llm_category_assignments(chunks, categories, api_key, run=None):
+    """
+    Ask the LLM for the category of every article in 'chunks' (all sent
+    concurrently; answers are recorded in 'run', a ChunkRun, if given).
+    Returns (assignments, {article_link: error} for articles without one).
+    """
     all_assignments = []
+    failed = {}
+    categories_text = _categories_text(categories)
 
-    # Split into large chunks so we don't exceed token limits
-    for chunk_dict in chunk_summaries(summaries_dict, max_token_chunk=MAX_TOKEN_CHUNK):
-        categories_text = "\n".join(f"- {cat}" for cat in PREDEFINED_CATEGORIES)
-        snippet_text = ""
-        for link, summary in chunk_dict.items():
-            snippet_text += f"Article ID={link}:\n{summary}\n\n"
+    def build_messages(handled_chunk, chunk_dict):
+        snippet_text = format_handled_articles(handled_chunk)
 
         system_msg = {
             "role": "system",
@@ -213,32 +336,53 @@ def two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_pa
                 f"Here is the list of valid categories:\n\n{categories_text}\n\n"
                 "Below are article summaries. For each article, pick one category (or 'Other'). "
                 "Return JSON only, in this format:\n"
-                "{ \"assignments\": [ {\"article_id\": \"...\", \"category\": \"...\"}, ... ] }\n\n"
+                "{ \"assignments\": [ {\"article_id\": 1, \"category\": \"...\"}, ... ] }\n"
+                "where article_id is the article's number.\n\n"
                 f"{snippet_text}"
             )
         }
-
-        from llm_calls import call_gpt_api  # local import to avoid circular references
-        response = call_gpt_api([system_msg, user_msg], api_key)
-        if not response:
+        return [system_msg, user_msg]
+
+    # All chunks are sent concurrently; malformed answers are salvaged / split and re-sent
+    results = call_gpt_api_chunks(chunks, build_messages, "assignments", api_key)
+    if run:
+        # Chunks a resumed run already had answered are taken from their stored answers
+        results = run.answered_results() + results
+        run.record_answers(results)
+
+    for chunk_dict, messages, chunk_assignments in results:
+        if chunk_assignments is None:
+            failed.update({link: "No usable response from GPT" for link in chunk_dict})
             continue
 
-        cleaned = response.strip().strip("```")
-        cleaned = re.sub(r'^json\s+', '', cleaned, flags=re.IGNORECASE)
-        try:
-            data = json.loads(cleaned)
-            chunk_assignments = data.get("assignments", [])
-        except Exception:
-            chunk_assignments = []
-
+        # Only accept IDs that were actually in this chunk
+        chunk_assignments = [
+            assn for assn in chunk_assignments
+            if isinstance(assn, dict) and assn.get("article_id") in chunk_dict
+        ]
+        assigned = {assn["article_id"] for assn in chunk_assignments}
+        failed.update({
+            link: "Missing from LLM response" for link in chunk_dict if link not in assigned
+        })
         all_assignments.extend(chunk_assignments)
+    return all_assignments, failed
+
+def _valid_category(category, categories):
+    return category if category in categories else "Other"
 
-    grouped_data = {cat: [] for cat in PREDEFINED_CATEGORIES}
+def group_assignments_by_category(assignments, assigned_by="llm", categories=PREDEFINED_CATEGORIES):
+    """
+    Turn [{"article_id": ..., "category": ...}, ...] into the "groups" list
+    saved by save_two_phase_groups. Categories not in 'categories' (normally
+    get_categories()) fall back to 'Other'.
+    assigned_by ('llm' or 'classifier') is stored with the memberships.
+    """
+    grouped_data = {cat: [] for cat in categories}
     # fallback 'Other' category
     if "Other" not in grouped_data:
         grouped_data["Other"] = []
 
-    for assn in all_assignments:
+    for assn in assignments:
         art_id = assn.get("article_id")
         cat = assn.get("category", "Other")
         if cat not in grouped_data:
@@ -246,158 +390,577 @@ def two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_pa
         if art_id:
             grouped_data[cat].append(art_id)
 
-    result = {"groups": []}
-    for cat in PREDEFINED_CATEGORIES:
+    groups = []
+    for cat in categories:
         articles = grouped_data[cat]
         if articles:
-            result["groups"].append({
+            groups.append({
                 "main_topic": cat,
                 "sub_topic": "",
                 "group_label": cat,
-                "articles": articles
+                "articles": articles,
+                "assigned_by": assigned_by
             })
-    if grouped_data["Other"]:
-        result["groups"].append({
+    if "Other" not in categories and grouped_data["Other"]:
+        groups.append({
             "main_topic": "Other",
             "sub_topic": "",
             "group_label": "Other",
-            "articles": grouped_data["Other"]
+            "articles": grouped_data["Other"],
+            "assigned_by": assigned_by
         })
-    return result
+    return groups
+
+def save_category_assignments(c, grouped_results):
+    """
+    Write top-level category memberships with cursor 'c' (the caller commits).
+    'grouped_results' is shaped like the output of
+    two_phase_grouping_with_predefined_categories.
+    """
+    for grp in grouped_results["groups"]:
+        assigned = [art_id for art_id in grp["articles"] if art_id]
+        if not assigned:
+            continue
+
+        # One canonical row per category
+        c.execute("""
+            INSERT INTO two_phase_article_groups (main_topic, sub_topic, group_label)
+            VALUES (?, ?, ?)
+            ON CONFLICT(main_topic) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+        """, (grp["main_topic"], grp["sub_topic"], grp["group_label"]))
+        group_id = c.execute(
+            "SELECT group_id FROM two_phase_article_groups WHERE main_topic = ?", (grp["main_topic"],)
+        ).fetchone()[0]
+
+        # Articles new to this category leave their subgroups in the old one
+        links_json = json.dumps(assigned)
+        moved = [row[0] for row in c.execute("""
+            SELECT value FROM json_each(?)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM two_phase_article_group_memberships
+                WHERE article_link = value AND group_id = ?
+            )
+        """, (links_json, group_id))]
+        c.execute("""
+            DELETE FROM two_phase_subgroup_memberships
+            WHERE article_link IN (SELECT value FROM json_each(?))
+              AND subgroup_id IN (SELECT subgroup_id FROM two_phase_subgroups WHERE category != ?)
+        """, (json.dumps(moved), grp["main_topic"]))
+
+        # Replace the articles' memberships in other categories, as set-based statements
+        c.execute("""
+            DELETE FROM two_phase_article_group_memberships
+            WHERE article_link IN (SELECT value FROM json_each(?))
+              AND group_id != ?
+        """, (links_json, group_id))
+        c.execute("""
+            INSERT INTO two_phase_article_group_memberships (article_link, group_id, assigned_by)
+            SELECT value, ?, ? FROM json_each(?) WHERE true
+            ON CONFLICT(article_link, group_id) DO UPDATE SET assigned_by = excluded.assigned_by
+        """, (group_id, grp.get("assigned_by", "llm"), links_json))
+
+        # Categorized now; (re)subgroup the moved ones within the new category
+        mark_stage_done(c, assigned, "categorization")
+        reset_stage(c, moved, "subgrouping")
+
+    failed = grouped_results.get("failed", {})
+    for art_id, error in failed.items():
+        mark_stage_failed(c, [art_id], "categorization", error)
 
 def save_two_phase_groups(grouped_results, db_path="db/news.db"):
     conn = get_connection(db_path)
     c = conn.cursor()
     try:
-        for grp in grouped_results["groups"]:
-            # Insert a new row in 'two_phase_article_groups' for this group
-            c.execute("""
-                INSERT INTO two_phase_article_groups (main_topic, sub_topic, group_label)
-                VALUES (?, ?, ?)
-            """, (grp["main_topic"], grp["sub_topic"], grp["group_label"]))
-            new_gid = c.lastrowid
-
-            # For each article in this group, delete any old membership first,
-            # then insert the new membership
-            for art_id in grp["articles"]:
-                if art_id:
-                    c.execute("""
-                        DELETE FROM two_phase_article_group_memberships
-                        WHERE article_link = ?
-                    """, (art_id,))
-
-                    c.execute("""
-                        INSERT OR IGNORE INTO two_phase_article_group_memberships (article_link, group_id)
-                        VALUES (?, ?)
-                    """, (art_id, new_gid))
-
+        save_category_assignments(c, grouped_results)
         conn.commit()
         print("Saved two-phase groups to DB with reassignment logic.")
+        return True
     except Exception as e:
         conn.rollback()
         print(f"Error saving two-phase groups: {e}")
+        return False
     finally:
         conn.close()
 
-
-def group_articles_within_category(category: str, api_key: str, db_path="db/news.db"):
+def categorize_pending_articles(api_key, db_path="db/news.db"):
     """
-    Gather articles that belong to this category but have NOT been subgrouped yet,
-    then cluster them by sub-topic using GPT, and insert the subgroups into DB.
+    Categorize every article whose 'categorization' stage is due: first the
+    remaining chunks of runs a killed process left unfinished (see
+    db/checkpoints.py), then the pending articles, streamed in batches (see
+    batch_summaries). Each batch is one checkpointed run, saved as a whole.
+    Returns the number of articles categorized or sent to the LLM.
+    """
+    categories = get_categories(db_path=db_path)
+    view = get_stage_text_view("categorization", db_path=db_path)
+    sent = 0
+    for run in ChunkRun.unfinished("categorization", db_path=db_path):
+        chunks = run.pending_chunks(load_text_view(run.pending_links(), view, db_path=db_path))
+        assignments, failed = _llm_category_assignments(chunks, categories, api_key, run=run)
+        result = {"groups": group_assignments_by_category(assignments, categories=categories), "failed": failed}
+        if save_two_phase_groups(result, db_path=db_path):
+            run.finish()
+        sent += sum(len(chunk) for chunk in chunks)
+
+    batches = batch_summaries(
+        ((link, text.strip()) for link, text in get_ungrouped_articles_two_phase(db_path=db_path)
+         if text and text.strip()),
+        model=MODEL,
+        prompt_tokens=count_tokens(_categories_text(categories), MODEL) + 150,
+        output_tokens_per_article=CATEGORY_OUTPUT_TOKENS_PER_ARTICLE
+    )
+    for summaries_dict in batches:
+        print(f"Categorizing {len(summaries_dict)} articles.")
+        result = two_phase_grouping_with_predefined_categories(
+            summaries_dict, api_key, db_path=db_path, checkpoint=True
+        )
+        # An unsaved run is resumed next time, from its stored answers
+        if save_two_phase_groups(result, db_path=db_path):
+            result["run"].finish()
+        sent += len(summaries_dict)
+    return sent
+
+
+SUBGROUP_PROMPT_HEADER = (
+    "Below are articles assigned to this category. Group them by specific sub-topic.\n"
+    "For each subgroup, return:\n"
+    "  - group_label: a short descriptive title\n"
+    "  - summary: a 2-3 sentence summary of these articles\n"
+    "  - articles: an array of article numbers\n\n"
+    "Return JSON only, with the structure:\n"
+    "{ \"groups\": [ {\"group_label\": \"...\", \"summary\": \"...\", \"articles\": [1, 2, ...]}, ... ] }\n\n"
+)
+
+def _get_unsubgrouped_summaries(category: str, db_path="db/news.db", window=None):
+    """
+    {link: summary} for articles that belong to this category but have NOT
+    been subgrouped yet (published in 'window', if given). A window is
+    clustered as a whole, so its articles are collected; its span bounds them.
     """
-    df = get_articles_in_category_not_subgrouped(category, db_path=db_path)
-    if df.empty:
-        print(f"No un-subgrouped articles found for category '{category}'.")
-        return
-
     summaries_dict = {}
-    for _, row in df.iterrows():
-        link = row["link"]
-        summary = row["expanded_summary"]
+    found = False
+    for link, summary in get_articles_in_category_not_subgrouped(category, db_path=db_path, window=window):
+        found = True
         if summary:
             summaries_dict[link] = summary.strip()
+    if not found:
+        print(f"No un-subgrouped articles found for category '{category}'.")
+        return {}
 
     if not summaries_dict:
         print("No valid summaries for these articles.")
+    return summaries_dict
+
+def backfill_subgroup_centroids(c, category: str, db_path="db/news.db"):
+    """
+    Store centroids for the subgroups of 'category' that were created before
+    centroids were kept, from their members' text (cursor 'c', caller commits).
+    """
+    view = get_stage_text_view("subgrouping", db_path=db_path)
+    rows = c.execute(f"""
+        SELECT m.subgroup_id, {text_view_sql(view)}
+        FROM two_phase_subgroups s
+        JOIN two_phase_subgroup_memberships m ON m.subgroup_id = s.subgroup_id
+        JOIN articles a ON a.link = m.article_link
+        WHERE s.category = ? AND s.centroid IS NULL
+    """, (category,)).fetchall()
+    if not rows:
         return
+    vectors = embed_texts([apply_text_view(text, view) or "" for _, text in rows])
+    members = {}
+    for row, (subgroup_id, _) in enumerate(rows):
+        members.setdefault(subgroup_id, []).append(row)
+    for subgroup_id, member_rows in members.items():
+        add_to_subgroup_centroid(c, subgroup_id, vectors[member_rows])
+    print(f"Stored centroids for {len(members)} existing subgroups in '{category}'.")
+
+def _attach_to_existing_subgroups(category: str, summaries_dict, db_path="db/news.db", window=None):
+    """
+    Attach every article whose embedding is close enough to the centroid of an
+    existing subgroup of 'category' (SUBGROUP_ASSIGN_THRESHOLD) to that
+    subgroup, so recurring stories do not get a new subgroup every run.
+    For articles of a dated 'window', only subgroups active in the window or
+    within SUBGROUP_WINDOW_OVERLAP_HOURS of it are candidates.
+    Windows are attached concurrently, so the centroids are read and updated
+    under one write lock (BEGIN IMMEDIATE) and no update is lost.
+    Returns the {link: summary} of the articles left to group.
+    """
+    if not summaries_dict:
+        return summaries_dict
+
+    links = list(summaries_dict)
+    vectors = embed_texts([summaries_dict[link] for link in links])
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        backfill_subgroup_centroids(c, category, db_path=db_path)
+        active_between = None
+        if window not in (None, UNDATED_WINDOW):
+            margin = SUBGROUP_WINDOW_OVERLAP_HOURS / 24
+            active_between = (window[0] - margin, window[1] + margin)
+        subgroup_ids, centroids, counts = load_subgroup_centroids(c, category, active_between)
+        attached = {}
+        if subgroup_ids:
+            for row, k in enumerate(nearest_centroids(vectors, centroids)):
+                if k >= 0:
+                    attached.setdefault(k, []).append(row)
+
+        for k, rows in attached.items():
+            c.executemany(f"""
+                INSERT OR IGNORE INTO two_phase_subgroup_memberships (article_link, subgroup_id, added_at)
+                VALUES (?, ?, {MEMBERSHIP_ADDED_AT_SQL})
+            """, [(links[row], subgroup_ids[k]) for row in rows])
+            c.execute("""
+                UPDATE two_phase_subgroups SET updated_at = CURRENT_TIMESTAMP
+                WHERE subgroup_id = ?
+            """, (subgroup_ids[k],))
+            add_to_subgroup_centroid(c, subgroup_ids[k], vectors[rows], centroids[k], counts[k])
+
+        done = {links[row] for rows in attached.values() for row in rows}
+        mark_stage_done(c, done, "subgrouping")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error attaching articles to existing subgroups: {e}")
+        return summaries_dict
+    finally:
+        conn.close()
 
-    total_new_subgroups = 0
-    chunked = list(chunk_summaries(summaries_dict, max_token_chunk=MAX_TOKEN_CHUNK))
+    if done:
+        print(f"Attached {len(done)} articles to {len(attached)} existing subgroups in '{category}'.")
+    return {link: text for link, text in summaries_dict.items() if link not in done}
 
-    from llm_calls import call_gpt_api
+def _build_subgroup_chunks(category: str, db_path="db/news.db", window=None):
+    """
+    Gather articles that belong to this category but have NOT been subgrouped yet
+    (published in 'window', if given), attach those matching an existing
+    subgroup, and pack the rest into request-sized chunks ({link: summary} dicts).
+    """
+    summaries_dict = _get_unsubgrouped_summaries(category, db_path=db_path, window=window)
+    summaries_dict = _attach_to_existing_subgroups(category, summaries_dict, db_path=db_path, window=window)
+    if not summaries_dict:
+        return []
 
-    for i, chunk_dict in enumerate(chunked, start=1):
-        print(f"Processing chunk {i}/{len(chunked)} for category: {category}")
+    return list(pack_summaries(
+        summaries_dict,
+        model=MODEL,
+        prompt_tokens=count_tokens(SUBGROUP_PROMPT_HEADER, MODEL),
+        output_tokens_per_article=SUBGROUP_OUTPUT_TOKENS_PER_ARTICLE
+    ))
 
-        prompt_text = (
-            "Below are articles assigned to this category. Group them by specific sub-topic.\n"
-            "For each subgroup, return:\n"
-            "  - group_label: a short descriptive title\n"
-            "  - summary: a 2-3 sentence summary of these articles\n"
-            "  - articles: an array of article IDs\n\n"
-            "Return JSON only, with the structure:\n"
-            "{ \"groups\": [ {\"group_label\": \"...\", \"summary\": \"...\", \"articles\": [ ... ]}, ... ] }\n\n"
-        )
-        for art_id, art_summary in chunk_dict.items():
-            prompt_text += f"Article {art_id}: {art_summary}\n\n"
+def _build_subgroup_messages(category: str, handled_chunk):
+    """
+    The GPT request that sub-groups one chunk of a category's articles
+    ({handle: summary}, see call_gpt_api_chunks).
+    """
+    prompt_text = SUBGROUP_PROMPT_HEADER + format_handled_articles(handled_chunk)
+
+    return [
+        {
+            "role": "system",
+            "content": f"You are grouping articles specifically for category '{category}'."
+        },
+        {
+            "role": "user",
+            "content": prompt_text
+        }
+    ]
+
+def _save_subgroup_response(category: str, chunk_dict, groups, db_path="db/news.db"):
+    """
+    Insert the subgroups parsed from one chunk's GPT response into DB
+    (groups is None when there was no usable response).
+    Returns the number of new subgroups.
+    """
+    if groups is None:
+        print("No usable response from GPT for this chunk.")
+        _record_subgroup_failure(chunk_dict.keys(), "No usable response from GPT", db_path)
+        return 0
+
+    groups = [grp for grp in groups if isinstance(grp, dict)]
+    if not groups:
+        print("No subgroups returned for this chunk.")
+        _record_subgroup_failure(chunk_dict.keys(), "No subgroups returned", db_path)
+        return 0
+
+    links = list(chunk_dict)
+    vectors = embed_texts([chunk_dict[link] for link in links])
+    new_subgroups = 0
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        subgrouped = set()
+        for grp in groups:
+            label = grp.get("group_label", "Untitled Subgroup")
+            summary = grp.get("summary", "")
+            articles = grp.get("articles", [])
+            if not isinstance(articles, list):
+                continue
+            articles = [art for art in articles if art in chunk_dict and art not in subgrouped]
+            if not articles:
+                continue
+            subgrouped.update(articles)
+
+            c.execute("""
+                INSERT INTO two_phase_subgroups (category, group_label, summary)
+                VALUES (?, ?, ?)
+            """, (category, label, summary))
+            new_subgroup_id = c.lastrowid
+
+            for art_link in articles:
+                c.execute(f"""
+                    INSERT OR IGNORE INTO two_phase_subgroup_memberships (article_link, subgroup_id, added_at)
+                    VALUES (?, ?, {MEMBERSHIP_ADDED_AT_SQL})
+                """, (art_link, new_subgroup_id))
+            mark_subgroup_summarized(c, new_subgroup_id)
+            add_to_subgroup_centroid(c, new_subgroup_id, vectors[[links.index(art) for art in articles]])
+
+            new_subgroups += 1
+
+        mark_stage_done(c, subgrouped, "subgrouping")
+        missing = [link for link in chunk_dict if link not in subgrouped]
+        mark_stage_failed(c, missing, "subgrouping", "Missing from LLM response")
+        conn.commit()
+        print(f"Saved {new_subgroups} new subgroups in category '{category}'.")
+    except Exception as e:
+        conn.rollback()
+        new_subgroups = 0
+        print(f"Error saving subgroups: {e}")
+    finally:
+        conn.close()
+    return new_subgroups
+
+def group_articles_within_categories(categories, api_key: str, db_path="db/news.db", workers=SUBGROUP_WORKERS):
+    """
+    Sub-group the un-subgrouped articles of every category in 'categories'.
+    Each category's pending articles are split into publish-time windows (see
+    get_subgroup_windows) and every (category, window) is one task on a pool
+    of 'workers' threads, newest windows first, so fresh stories are grouped
+    first after a backlog and no task sees more than one window of articles.
+    Tasks share nothing but the DB, which each reads and writes through its
+    own connections, so a failing task does not hold up or roll back others.
+    Sub-grouping runs a killed process left unfinished are resumed first.
+    Returns {category: number of new subgroups, or None if a window failed}.
+    """
+    resumed = resume_subgroup_runs(api_key, db_path=db_path)
+    tasks = [
+        (category, window)
+        for category in categories
+        for window in get_subgroup_windows(category, db_path=db_path)
+    ]
+    # Newest windows first across categories; undated articles last
+    tasks.sort(key=lambda task: -task[1][1] if task[1][1] is not None else float("inf"))
+
+    totals = {category: resumed.get(category, 0) for category in categories}
+    remaining = {category: 0 for category in categories}
+    for category, _ in tasks:
+        remaining[category] += 1
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(group_articles_within_category, category, api_key, db_path, window): category
+            for category, window in tasks
+        }
+        for future in as_completed(futures):
+            category = futures[future]
+            remaining[category] -= 1
+            try:
+                new_subgroups = future.result()
+                if totals[category] is not None:
+                    totals[category] += new_subgroups
+            except Exception as e:
+                totals[category] = None
+                print(f"Sub-grouping failed for a window of category '{category}': {e}")
+            if not remaining[category]:
+                print(f"Sub-grouping of category '{category}' done: "
+                      f"{'FAILED' if totals[category] is None else totals[category]} new subgroups.")
+    return totals
+
+def group_articles_within_category(category: str, api_key: str, db_path="db/news.db", window=None):
+    """
+    Gather articles that belong to this category but have NOT been subgrouped yet
+    (published in 'window', if given), group them by sub-topic (locally
+    clustered and LLM-named, or clustered by the LLM, see SUBGROUP_CLUSTERING)
+    and insert the subgroups into DB.
+    Returns the number of new subgroups.
+    """
+    if SUBGROUP_CLUSTERING == "llm":
+        return _llm_group_articles_within_categories([category], api_key, db_path=db_path, window=window)[category]
+    return _cluster_articles_within_categories([category], api_key, db_path=db_path, window=window)[category]
+
+CLUSTER_NAMING_PROMPT_HEADER = (
+    "Each numbered cluster below is a group of related news articles; a few representative "
+    "articles of each are shown. For each cluster, return:\n"
+    "  - group_label: a short descriptive title for the story or topic\n"
+    "  - summary: a 2-3 sentence summary of the cluster\n\n"
+    "Return JSON only, with the structure:\n"
+    "{ \"clusters\": [ {\"cluster_id\": 1, \"group_label\": \"...\", \"summary\": \"...\"}, ... ] }\n\n"
+)
+
+def _cluster_articles_within_categories(categories, api_key: str, db_path="db/news.db", window=None):
+    """
+    Attach each category's un-subgrouped articles to matching existing
+    subgroups and cluster the rest locally (see analysis/subgroup_clustering.py),
+    so clusters are not limited to one prompt. The LLM is only asked for a
+    label and summary per cluster, from a few representative articles; all
+    naming requests are sent concurrently.
+    """
+    totals = {category: 0 for category in categories}
+    clusters = {}   # key -> (category, [links], member embeddings)
+    cluster_texts = {}  # key -> representative text shown to the LLM
+    for category in categories:
+        summaries_dict = _get_unsubgrouped_summaries(category, db_path=db_path, window=window)
+        summaries_dict = _attach_to_existing_subgroups(category, summaries_dict, db_path=db_path, window=window)
+        if not summaries_dict:
+            continue
+        links = list(summaries_dict)
+        vectors = embed_texts([summaries_dict[link] for link in links])
+        for n, cluster in enumerate(agglomerative_clusters(vectors)):
+            key = f"{category}#{n}"
+            clusters[key] = (category, [links[row] for row in cluster], vectors[cluster])
+            reps = "\n".join(
+                f"- {truncate_to_tokens(summaries_dict[links[row]], REPRESENTATIVE_TOKENS, MODEL)}"
+                for row in representative_rows(vectors, cluster)
+            )
+            cluster_texts[key] = f"Category: {category} ({len(cluster)} articles)\n{reps}"
+        print(f"Clustered {len(links)} articles in '{category}' locally.")
 
-        messages = [
+    if not clusters:
+        return totals
+
+    chunks = list(pack_summaries(
+        cluster_texts,
+        model=MODEL,
+        prompt_tokens=count_tokens(CLUSTER_NAMING_PROMPT_HEADER, MODEL),
+        output_tokens_per_article=CLUSTER_NAME_OUTPUT_TOKENS
+    ))
+
+    def build_messages(handled_chunk, chunk_dict):
+        return [
             {
                 "role": "system",
-                "content": f"You are grouping articles specifically for category '{category}'."
+                "content": "You name clusters of related news articles. Return valid JSON only."
             },
             {
                 "role": "user",
-                "content": prompt_text
+                "content": CLUSTER_NAMING_PROMPT_HEADER + format_handled_articles(handled_chunk)
             }
         ]
 
-        response = call_gpt_api(messages, api_key)
-        if not response:
-            print("No response from GPT for this chunk.")
-            continue
+    print(f"Naming {len(clusters)} clusters in {len(chunks)} requests.")
+    results = call_gpt_api_chunks(chunks, build_messages, "clusters", api_key, id_field="cluster_id")
 
-        cleaned = response.strip().strip("```")
-        cleaned = re.sub(r'^json\s+', '', cleaned, flags=re.IGNORECASE)
-        try:
-            data = json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            print(f"Could not parse JSON for subgrouping:\n{cleaned}\nError: {e}")
-            continue
+    names = {}
+    for chunk_dict, messages, items in results:
+        for item in items or []:
+            if item.get("cluster_id") in chunk_dict and item.get("group_label"):
+                names[item["cluster_id"]] = (str(item["group_label"]), str(item.get("summary", "")))
 
-        groups = data.get("groups", [])
-        if not groups:
-            print("No subgroups returned for this chunk.")
-            continue
+    conn = get_connection(db_path)
+    c = conn.cursor()
+    try:
+        for key, (category, links, vectors) in clusters.items():
+            if key not in names:
+                mark_stage_failed(c, links, "subgrouping", "Cluster not named by LLM")
+                continue
+            label, summary = names[key]
+            c.execute("""
+                INSERT INTO two_phase_subgroups (category, group_label, summary)
+                VALUES (?, ?, ?)
+            """, (category, label, summary))
+            new_subgroup_id = c.lastrowid
+            c.executemany(f"""
+                INSERT OR IGNORE INTO two_phase_subgroup_memberships (article_link, subgroup_id, added_at)
+                VALUES (?, ?, {MEMBERSHIP_ADDED_AT_SQL})
+            """, [(link, new_subgroup_id) for link in links])
+            mark_subgroup_summarized(c, new_subgroup_id)
+            add_to_subgroup_centroid(c, new_subgroup_id, vectors)
+            mark_stage_done(c, links, "subgrouping")
+            totals[category] += 1
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error saving subgroups: {e}")
+        raise
+    finally:
+        conn.close()
 
-        conn = get_connection(db_path)
-        c = conn.cursor()
-        try:
-            for grp in groups:
-                label = grp.get("group_label", "Untitled Subgroup")
-                summary = grp.get("summary", "")
-                articles = grp.get("articles", [])
-
-                c.execute("""
-                    INSERT INTO two_phase_subgroups (category, group_label, summary)
-                    VALUES (?, ?, ?)
-                """, (category, label, summary))
-                new_subgroup_id = c.lastrowid
-
-                for art_link in articles:
-                    c.execute("""
-                        INSERT OR IGNORE INTO two_phase_subgroup_memberships (article_link, subgroup_id)
-                        VALUES (?, ?)
-                    """, (art_link, new_subgroup_id))
-
-                total_new_subgroups += 1
-            conn.commit()
-            print(f"Saved {len(groups)} new subgroups for chunk {i} in category '{category}'.")
-        except Exception as e:
-            conn.rollback()
-            print(f"Error saving subgroups: {e}")
-        finally:
-            conn.close()
-
-    print(f"Done grouping articles for category '{category}'. "
-          f"Total new subgroups created: {total_new_subgroups}.")
+    for category, total_new_subgroups in totals.items():
+        print(f"Done grouping articles for category '{category}'. "
+              f"Total new subgroups created: {total_new_subgroups}.")
+    return totals
+
+def _llm_group_articles_within_categories(categories, api_key: str, db_path="db/news.db", window=None):
+    """
+    Sub-group by asking the LLM to cluster each chunk of articles itself.
+    Each category's chunks are a checkpointed run (see db/checkpoints.py);
+    see _send_subgroup_chunks.
+    """
+    runs = {}
+    for category in categories:
+        chunks = _build_subgroup_chunks(category, db_path=db_path, window=window)
+        if chunks:
+            runs[category] = (ChunkRun.start("subgrouping", chunks, scope=category, db_path=db_path), chunks)
+    return _send_subgroup_chunks(runs, categories, api_key, db_path=db_path)
+
+def resume_subgroup_runs(api_key: str, db_path="db/news.db"):
+    """
+    Finish the sub-grouping runs a killed process left unfinished, from their
+    first incomplete chunk. Returns {category: number of new subgroups}.
+    """
+    view = get_stage_text_view("subgrouping", db_path=db_path)
+    totals = {}
+    for run in ChunkRun.unfinished("subgrouping", scope=None, db_path=db_path):
+        chunks = run.pending_chunks(load_text_view(run.pending_links(), view, db_path=db_path))
+        new_subgroups = _send_subgroup_chunks({run.scope: (run, chunks)}, [run.scope], api_key, db_path=db_path)
+        totals[run.scope] = totals.get(run.scope, 0) + new_subgroups[run.scope]
+    return totals
+
+def _send_subgroup_chunks(runs, categories, api_key: str, db_path="db/news.db"):
+    """
+    Send the chunks of every category's run ({category: (ChunkRun, chunks)})
+    to GPT concurrently (see call_gpt_api_chunks) and save the results per
+    chunk as they are processed, checkpointing each saved chunk.
+    """
+    chunks = []
+    answered = []  # chunks a resumed run already had answered, saved from their stored answers
+    link_category = {}
+    for category, (run, run_chunks) in runs.items():
+        run_answered = run.answered_results()
+        answered.extend(run_answered)
+        for chunk_dict in run_chunks + [result[0] for result in run_answered]:
+            link_category.update({link: category for link in chunk_dict})
+        chunks.extend(run_chunks)
+
+    totals = {category: 0 for category in categories}
+    if chunks or answered:
+        def build_messages(handled_chunk, chunk_dict):
+            # Chunks (and the halves of a split chunk) never mix categories
+            return _build_subgroup_messages(link_category[next(iter(chunk_dict))], handled_chunk)
+
+        print(f"Sub-grouping {len(chunks)} chunks across {len(runs)} categories.")
+        results = answered + call_gpt_api_chunks(chunks, build_messages, "groups", api_key, id_field="articles")
+        for category, (run, _) in runs.items():
+            run.record_answers([r for r in results if link_category[next(iter(r[0]))] == category])
+
+        for chunk_dict, messages, groups in results:
+            category = link_category[next(iter(chunk_dict))]
+            totals[category] += _save_subgroup_response(category, chunk_dict, groups, db_path=db_path)
+            runs[category][0].chunk_saved(chunk_dict)
+
+    for run, _ in runs.values():
+        run.finish()
+    for category, total_new_subgroups in totals.items():
+        print(f"Done grouping articles for category '{category}'. "
+              f"Total new subgroups created: {total_new_subgroups}.")
+    return totals
+
+def _record_subgroup_failure(article_links, error, db_path="db/news.db"):
+    """
+    Record a failed 'subgrouping' attempt for every article in a chunk.
+    """
+    conn = get_connection(db_path)
+    try:
+        mark_stage_failed(conn.cursor(), list(article_links), "subgrouping", error)
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,126 @@
+# analysis/vectors.py
+
+import re
+import zlib
+import numpy as np
+
+# Hashed feature space for article text (unigrams + bigrams)
+HASH_FEATURES = 2 ** 18
+WORD_PATTERN = re.compile(r"[^\W_]{2,}")
+
+def tokenize(text):
+    """Lower-cased words (2+ letters/digits) and adjacent-word bigrams."""
+    words = WORD_PATTERN.findall((text or "").lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def feature_index(token, n_features=HASH_FEATURES):
+    """Stable hash of a token into [0, n_features) (independent of PYTHONHASHSEED)."""
+    return zlib.crc32(token.encode("utf-8")) % n_features
+
+class SparseRows:
+    """
+    Minimal CSR matrix (one row per document): the few products the local
+    models need, without pulling in scipy.
+    """
+
+    def __init__(self, indptr, indices, data, n_features=HASH_FEATURES):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.n_features = n_features
+        self._by_feature = None  # cached (order, features, starts) for t_dot
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    def row_ids(self):
+        """Row number of every stored value."""
+        return np.repeat(np.arange(self.n_rows), np.diff(self.indptr))
+
+    def take(self, rows):
+        """A new SparseRows with only 'rows' (in that order)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        picks = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)] + [np.array([], dtype=np.int64)])
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        return SparseRows(indptr, self.indices[picks], self.data[picks], self.n_features)
+
+    def restrict(self, features):
+        """
+        Re-index onto 'features' (sorted feature ids): column j of the result
+        is features[j]. Values of other features are dropped.
+        """
+        pos = np.searchsorted(features, self.indices)
+        pos = np.minimum(pos, max(len(features) - 1, 0))
+        keep = (features[pos] == self.indices) if len(features) else np.zeros(len(self.indices), dtype=bool)
+        kept_per_row = np.bincount(self.row_ids()[keep], minlength=self.n_rows)
+        indptr = np.concatenate([[0], np.cumsum(kept_per_row)])
+        return SparseRows(indptr, pos[keep], self.data[keep], len(features))
+
+    def dot(self, weights):
+        """self @ weights, for a dense (n_features, k) matrix."""
+        out = np.zeros((self.n_rows, weights.shape[1]))
+        if len(self.data):
+            nonempty = np.diff(self.indptr) > 0
+            products = self.data[:, None] * weights[self.indices]
+            out[nonempty] = np.add.reduceat(products, self.indptr[:-1][nonempty], axis=0)
+        return out
+
+    def t_dot(self, dense):
+        """self.T @ dense, for a dense (n_rows, k) matrix; returns (n_features, k)."""
+        out = np.zeros((self.n_features, dense.shape[1]))
+        if len(self.data):
+            if self._by_feature is None:
+                order = np.argsort(self.indices, kind="stable")
+                features, starts = np.unique(self.indices[order], return_index=True)
+                self._by_feature = (order, features, starts)
+            order, features, starts = self._by_feature
+            products = self.data[order, None] * dense[self.row_ids()[order]]
+            out[features] = np.add.reduceat(products, starts, axis=0)
+        return out
+
+    def sketch(self, dim):
+        """
+        Dense (n_rows, dim) count-sketch of the rows: every feature is folded
+        into one of 'dim' columns with a hashed sign, which keeps dot products
+        (and so cosine similarity) close to those of the full vectors.
+        """
+        cols = self.indices % dim
+        signs = np.where((self.indices // dim) % 2 == 0, 1.0, -1.0)
+        out = np.zeros((self.n_rows, dim))
+        np.add.at(out, (self.row_ids(), cols), signs * self.data)
+        return out
+
+def hashed_term_counts(texts, n_features=HASH_FEATURES):
+    """
+    Sublinear (1 + log tf) hashed term frequencies of 'texts' as SparseRows.
+    """
+    indptr = [0]
+    indices = []
+    data = []
+    for text in texts:
+        counts = {}
+        for token in tokenize(text):
+            idx = feature_index(token, n_features)
+            counts[idx] = counts.get(idx, 0) + 1
+        for idx, tf in sorted(counts.items()):
+            indices.append(idx)
+            data.append(1.0 + np.log(tf))
+        indptr.append(len(indices))
+    return SparseRows(indptr, indices, data, n_features)
+
+def fit_idf(counts):
+    """Smoothed inverse document frequency per feature, from SparseRows counts."""
+    df = np.bincount(counts.indices, minlength=counts.n_features)
+    return np.log((1 + counts.n_rows) / (1 + df)) + 1.0
+
+def tfidf(texts, idf, n_features=HASH_FEATURES):
+    """L2-normalized hashed TF-IDF rows for 'texts' (idf from fit_idf)."""
+    rows = hashed_term_counts(texts, n_features)
+    rows.data = rows.data * idf[rows.indices]
+    norms = np.sqrt(np.bincount(rows.row_ids(), weights=rows.data ** 2, minlength=rows.n_rows))
+    norms[norms == 0] = 1.0
+    rows.data = rows.data / norms[rows.row_ids()]
+    return rows
@@ -1,3 +1,4 @@
+import os
 import streamlit as st
 import pandas as pd
 import sqlite3
@@ -5,16 +6,21 @@ from datetime import datetime, timedelta
 import pytz
 
 # === Imports from your own modules ===
-from analysis.company_extraction import get_companies_in_article_list, filter_articles_by_company
+from analysis.company_extraction import (
+    get_companies_in_article_list,
+    filter_articles_by_company,
+    get_all_company_names
+)
 from analysis.cve_extraction import build_cve_table
 from analysis.two_phase_grouping import (
-    PREDEFINED_CATEGORIES,
     get_existing_groups_two_phase,
     get_articles_for_group_two_phase,
     get_subgroups_for_category,
     get_articles_for_subgroup
 )
-from db.database import setup_database
+from analysis.search import search_articles, get_article_sources
+from analysis.taxonomy import get_categories
+from db.database import setup_database, get_dashboard_stats, get_snapshot_path, needs_archive
 
 
 # === Constants & Configuration ===
@@ -121,6 +127,20 @@ def get_articles_for_date_range(df_articles, hours):
     return df_articles.loc[df_articles["published_date"] >= cutoff].copy()
 
 
+def display_search_result(result):
+    """
+    Renders a single full-text search hit, with the highlighted snippet.
+    """
+    st.markdown(f"""
+        <div class="article-card">
+            <div class="article-title">{result['title']}</div>
+            <div class="article-meta">Published: {result['published_date']} · Source: {result['source'] or 'unknown'}</div>
+            <div class="article-content">{result['snippet']}</div>
+            <a href="{result['link']}" target="_blank" class="article-link">Read more →</a>
+        </div>
+    """, unsafe_allow_html=True)
+
+
 def display_article(article):
     """
     Renders a single article card using HTML.
@@ -160,33 +180,32 @@ def toggled_button(label, toggled=False, key=None, on_click=None, args=None):
         return st.button(label, key=key, on_click=on_click, args=args)
 
 
-# === Main App ===
-def main():
+def get_dashboard_db_path(db_path="db/news.db"):
+    """
+    The dashboard reads the read-only snapshot the pipeline publishes after
+    each cycle. Before the first snapshot exists, it falls back to the live DB.
+    """
+    snapshot_path = get_snapshot_path(db_path)
+    if os.path.exists(snapshot_path):
+        return snapshot_path
     # Ensure database is set up
-    setup_database()
-
-    st.title("🛡️ Security News Dashboard")
+    setup_database(db_path)
+    return db_path
 
-    # === 1) Gather all-time stats ===
-    conn, c = setup_connection()
-    c.execute("SELECT COUNT(*) FROM articles")
-    total_articles = c.fetchone()[0]
 
-    c.execute("""
-        SELECT COUNT(*) FROM articles a
-        WHERE NOT EXISTS (
-            SELECT 1 FROM two_phase_article_group_memberships m
-            WHERE m.article_link=a.link
-        )
-    """)
-    ungrouped_two = c.fetchone()[0]
+# === Main App ===
+def main():
+    db_path = get_dashboard_db_path()
+    categories = get_categories(db_path=db_path)
 
-    c.execute("SELECT COUNT(*) FROM two_phase_article_group_memberships")
-    grouped_two = c.fetchone()[0]
+    st.title("🛡️ Security News Dashboard")
 
-    c.execute("SELECT COUNT(*) FROM two_phase_article_groups")
-    total_groups_two = c.fetchone()[0]
-    conn.close()
+    # === 1) Gather all-time stats (trigger-maintained counters) ===
+    all_time_stats = get_dashboard_stats(db_path=db_path, include_archive=True)
+    total_articles = all_time_stats["total_articles"]
+    ungrouped_two = all_time_stats["ungrouped_articles"]
+    grouped_two = all_time_stats["grouped_articles"]
+    total_groups_two = all_time_stats["total_groups"]
 
     # === 2) Show top-level (all-time) metrics ===
     col1, col2, col3, col4 = st.columns(4)
@@ -208,54 +227,16 @@ def main():
         value="Last 24 hours"
     )
     date_hours = DATE_FILTER_OPTIONS[selected_date_range]
+    # Archived (older) articles are only read when the range reaches them
+    use_archive = needs_archive(date_hours)
 
     # If a time range (hours) is set, compute time-range-based stats
     if date_hours is not None:
-        cutoff_utc = datetime.now(tz=pytz.UTC) - timedelta(hours=date_hours)
-        cutoff_str = cutoff_utc.isoformat()
-
-        conn, c = setup_connection()
-
-        # total articles
-        c.execute("""
-            SELECT COUNT(*)
-            FROM articles
-            WHERE published_date >= ?
-        """, (cutoff_str,))
-        range_total_articles = c.fetchone()[0]
-
-        # ungrouped articles
-        c.execute("""
-            SELECT COUNT(*)
-            FROM articles a
-            WHERE a.published_date >= ?
-              AND NOT EXISTS (
-                  SELECT 1 FROM two_phase_article_group_memberships m
-                  WHERE m.article_link = a.link
-              )
-        """, (cutoff_str,))
-        range_ungrouped = c.fetchone()[0]
-
-        # grouped articles
-        c.execute("""
-            SELECT COUNT(DISTINCT a.link)
-            FROM articles a
-            JOIN two_phase_article_group_memberships m ON a.link = m.article_link
-            WHERE a.published_date >= ?
-        """, (cutoff_str,))
-        range_grouped = c.fetchone()[0]
-
-        # total groups with at least 1 article in range
-        c.execute("""
-            SELECT COUNT(DISTINCT g.group_id)
-            FROM two_phase_article_groups g
-            JOIN two_phase_article_group_memberships m ON g.group_id = m.group_id
-            JOIN articles a ON a.link = m.article_link
-            WHERE a.published_date >= ?
-        """, (cutoff_str,))
-        range_total_groups = c.fetchone()[0]
-
-        conn.close()
+        range_stats = get_dashboard_stats(date_hours=date_hours, db_path=db_path, include_archive=use_archive)
+        range_total_articles = range_stats["total_articles"]
+        range_ungrouped = range_stats["ungrouped_articles"]
+        range_grouped = range_stats["grouped_articles"]
+        range_total_groups = range_stats["total_groups"]
 
         st.subheader(f"Stats for '{selected_date_range}' Range")
         colA, colB, colC, colD = st.columns(4)
@@ -269,16 +250,17 @@ def main():
             st.metric("Total Groups (Time Range)", f"{range_total_groups:,}")
 
     # === 4) Main content tabs ===
-    tab_cve, tab_groups, tab_categories = st.tabs([
+    tab_cve, tab_groups, tab_categories, tab_search = st.tabs([
         "🎯 CVE Mentions",
         "📊 View Groups",
-        "🗂️ Categories"
+        "🗂️ Categories",
+        "🔎 Search"
     ])
 
     # ----------------- TAB 1: CVE Mentions ------------------
     with tab_cve:
         st.header("CVE Mentions & Analysis")
-        cve_table = build_cve_table(date_hours, db_path="db/news.db")
+        cve_table = build_cve_table(date_hours, db_path=db_path, include_archive=use_archive)
         if cve_table.empty:
             st.info("No CVEs found in the selected time range.")
         else:
@@ -299,14 +281,14 @@ def main():
             </style>
         """, unsafe_allow_html=True)
 
-        df2 = get_existing_groups_two_phase(db_path="db/news.db")
+        df2 = get_existing_groups_two_phase(db_path=db_path, include_archive=use_archive)
         if df2.empty:
             st.info("No groups found.")
         else:
             # Filter out groups with zero articles in the selected date range
             valid_groups = []
             for _, row in df2.iterrows():
-                articles_df = get_articles_for_group_two_phase(row["group_id"], db_path="db/news.db")
+                articles_df = get_articles_for_group_two_phase(row["group_id"], db_path=db_path, include_archive=use_archive)
                 articles_df = get_articles_for_date_range(articles_df, date_hours)
                 if not articles_df.empty:
                     new_row = dict(row)
@@ -380,7 +362,7 @@ def main():
                             st.divider()
 
                             # Retrieve articles for this group, re-filtered by date
-                            articles_df = get_articles_for_group_two_phase(group_id, db_path="db/news.db")
+                            articles_df = get_articles_for_group_two_phase(group_id, db_path=db_path, include_archive=use_archive)
                             articles_df = get_articles_for_date_range(articles_df, date_hours)
 
                             for _, article in articles_df.iterrows():
@@ -390,15 +372,15 @@ def main():
     with tab_categories:
         st.header("Category Analysis")
 
-        category = st.selectbox("Select Category", PREDEFINED_CATEGORIES)
+        category = st.selectbox("Select Category", categories)
         if category:
-            sub_df = get_subgroups_for_category(category, db_path="db/news.db")
+            sub_df = get_subgroups_for_category(category, db_path=db_path, include_archive=use_archive)
             if sub_df.empty:
                 st.info(f"No subgroups found for {category}.")
             else:
                 valid_subgroups = []
                 for _, row in sub_df.iterrows():
-                    articles_df = get_articles_for_subgroup(row["subgroup_id"], db_path="db/news.db")
+                    articles_df = get_articles_for_subgroup(row["subgroup_id"], db_path=db_path, include_archive=use_archive)
                     articles_df = get_articles_for_date_range(articles_df, date_hours)
                     if not articles_df.empty:
                         new_row = dict(row)
@@ -416,12 +398,51 @@ def main():
                             st.markdown(f"**Summary:** {row.get('summary', 'No summary available')}")
                             st.divider()
 
-                            articles_df = get_articles_for_subgroup(row["subgroup_id"], db_path="db/news.db")
+                            articles_df = get_articles_for_subgroup(row["subgroup_id"], db_path=db_path, include_archive=use_archive)
                             articles_df = get_articles_for_date_range(articles_df, date_hours)
 
                             for _, article in articles_df.iterrows():
                                 display_article(article)
 
+    # ----------------- TAB 4: Search ------------------------
+    with tab_search:
+        st.header("Search Articles")
+
+        search_query = st.text_input(
+            "Search titles and content",
+            placeholder='e.g. ransomware healthcare, or exploit* (prefix)'
+        )
+        colS1, colS2, colS3 = st.columns(3)
+        with colS1:
+            search_category = st.selectbox(
+                "Category", ["(All)"] + categories, key="search_category"
+            )
+        with colS2:
+            search_source = st.selectbox(
+                "Source", ["(All)"] + get_article_sources(db_path=db_path, include_archive=use_archive), key="search_source"
+            )
+        with colS3:
+            search_company = st.selectbox(
+                "Company", ["(All)"] + get_all_company_names(db_path=db_path, include_archive=use_archive), key="search_company"
+            )
+
+        if search_query.strip():
+            results_df = search_articles(
+                search_query,
+                date_hours=date_hours,
+                category=search_category,
+                source=search_source,
+                company=search_company,
+                db_path=db_path,
+                include_archive=use_archive
+            )
+            if results_df.empty:
+                st.info(f"No articles match '{search_query}' in the {selected_date_range} range.")
+            else:
+                st.caption(f"Top {len(results_df)} matches, best first.")
+                for _, result in results_df.iterrows():
+                    display_search_result(result)
+
 
 if __name__ == "__main__":
     main()
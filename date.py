@@ -3,9 +3,19 @@ import sqlite3
 from dateutil import parser
 import datetime
 
+from db.database import get_input_watermark, stage_inputs_unchanged, save_stage_watermark
+
+DB_PATH = "db/news.db"
+
+# Dates already in the "%Y-%m-%dT%H:%M:%SZ" form are not parsed again
+NORMALIZED_DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9]:[0-9][0-9]:[0-9][0-9]Z"
+
 def convert_dates(conn):
     cur = conn.cursor()
-    cur.execute("SELECT link, published_date FROM articles")
+    cur.execute("""
+        SELECT link, published_date FROM articles
+        WHERE published_date IS NOT NULL AND published_date NOT GLOB ?
+    """, (NORMALIZED_DATE_GLOB,))
     rows = cur.fetchall()
 
     for row in rows:
@@ -28,11 +38,18 @@ def convert_dates(conn):
     conn.commit()
 
 def main():
-    conn = sqlite3.connect("db/news.db")
+    # Nothing to do unless articles were written since the last run
+    watermark = get_input_watermark(("articles",), db_path=DB_PATH)
+    if stage_inputs_unchanged("normalize_dates", watermark, db_path=DB_PATH):
+        print("Articles unchanged since the last run; dates already standardized.")
+        return
+
+    conn = sqlite3.connect(DB_PATH)
     try:
         convert_dates(conn)
     finally:
         conn.close()
+    save_stage_watermark("normalize_dates", watermark, db_path=DB_PATH)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,160 @@
+# db/archive.py
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from db.database import (
+    get_connection,
+    get_archive_path,
+    setup_database,
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVED_TABLES,
+    COPIED_TABLES
+)
+
+logger = logging.getLogger(__name__)
+
+# Articles to archive, for a cutoff date parameter
+ARCHIVE_DUE_CONDITION = "published_date < ? AND published_date GLOB '[0-9][0-9][0-9][0-9]-*'"
+
+def _shared_columns(conn, table):
+    main_cols = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+    archive_cols = {row[1] for row in conn.execute(f"PRAGMA archive.table_info({table})")}
+    return ", ".join(c for c in main_cols if c in archive_cols)
+
+def _align_archived_categories(c):
+    """
+    Point archived category memberships at the hot DB's row for their
+    main_topic. Both DBs keep one row per category, but collapsing older
+    duplicates may have kept a different row in each.
+    """
+    c.execute("""
+        CREATE TEMP TABLE category_remap AS
+        SELECT ag.group_id AS old_id, g.group_id AS new_id
+        FROM archive.two_phase_article_groups ag
+        JOIN main.two_phase_article_groups g ON g.main_topic = ag.main_topic
+        WHERE g.group_id != ag.group_id
+    """)
+    try:
+        if not c.execute("SELECT COUNT(*) FROM temp.category_remap").fetchone()[0]:
+            return
+        cols = _shared_columns(c.connection, "two_phase_article_groups")
+        c.execute("""
+            INSERT OR IGNORE INTO archive.two_phase_article_group_memberships
+                (article_link, group_id, added_at, assigned_by)
+            SELECT m.article_link, r.new_id, m.added_at, m.assigned_by
+            FROM archive.two_phase_article_group_memberships m
+            JOIN temp.category_remap r ON r.old_id = m.group_id
+        """)
+        c.execute("""
+            DELETE FROM archive.two_phase_article_group_memberships
+            WHERE group_id IN (SELECT old_id FROM temp.category_remap)
+        """)
+        c.execute("""
+            DELETE FROM archive.two_phase_article_groups
+            WHERE group_id IN (SELECT old_id FROM temp.category_remap)
+        """)
+        c.execute(f"""
+            INSERT OR IGNORE INTO archive.two_phase_article_groups ({cols})
+            SELECT {cols} FROM main.two_phase_article_groups
+            WHERE group_id IN (SELECT new_id FROM temp.category_remap)
+        """)
+    finally:
+        c.execute("DROP TABLE IF EXISTS temp.category_remap")
+
+def archive_old_articles(max_age_days=ARCHIVE_AFTER_DAYS, db_path="db/news.db"):
+    """
+    Move articles published more than max_age_days ago from the hot DB into the
+    archive DB (see get_archive_path), together with their category/subgroup
+    memberships, company and CVE rows and pipeline state. Category and subgroup
+    rows they reference are copied; subgroups left without hot members are
+    removed from the hot DB. Everything happens in one transaction.
+    The archive DB is only set up and attached when some article is due.
+    Returns the number of archived articles.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    conn = get_connection(db_path)
+    # Only dates already normalized by date.py compare correctly as strings
+    due = conn.execute(f"""
+        SELECT COUNT(*) FROM articles
+        WHERE {ARCHIVE_DUE_CONDITION}
+    """, (cutoff,)).fetchone()[0]
+    conn.close()
+    if not due:
+        logger.info("No articles older than %s days to archive.", max_age_days)
+        return 0
+
+    archive_path = get_archive_path(db_path)
+    setup_database(archive_path)
+
+    conn = get_connection(db_path)
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    c = conn.cursor()
+    try:
+        _align_archived_categories(c)
+
+        c.execute(f"""
+            CREATE TEMP TABLE archive_links AS
+            SELECT link FROM main.articles
+            WHERE {ARCHIVE_DUE_CONDITION}
+        """, (cutoff,))
+        moved = c.execute("SELECT COUNT(*) FROM temp.archive_links").fetchone()[0]
+        if not moved:
+            conn.commit()
+            logger.info("No articles older than %s days to archive.", max_age_days)
+            return 0
+
+        # Copy the category / subgroup rows the archived memberships point to
+        for table, membership_table in (
+            ("two_phase_article_groups", "two_phase_article_group_memberships"),
+            ("two_phase_subgroups", "two_phase_subgroup_memberships"),
+        ):
+            key = COPIED_TABLES[table]
+            cols = _shared_columns(conn, table)
+            c.execute(f"""
+                INSERT OR IGNORE INTO archive.{table} ({cols})
+                SELECT {cols} FROM main.{table}
+                WHERE {key} IN (
+                    SELECT m.{key} FROM main.{membership_table} m
+                    WHERE m.article_link IN (SELECT link FROM temp.archive_links)
+                )
+            """)
+
+        # Articles first, so the archive's own triggers (FTS, stats) see them
+        for table in ARCHIVED_TABLES + ("article_pipeline_state",):
+            link_col = "link" if table == "articles" else "article_link"
+            cols = _shared_columns(conn, table)
+            c.execute(f"""
+                INSERT OR REPLACE INTO archive.{table} ({cols})
+                SELECT {cols} FROM main.{table}
+                WHERE {link_col} IN (SELECT link FROM temp.archive_links)
+            """)
+
+        # Then remove them from the hot DB (articles last)
+        for table in reversed(ARCHIVED_TABLES + ("article_pipeline_state",)):
+            link_col = "link" if table == "articles" else "article_link"
+            c.execute(f"""
+                DELETE FROM main.{table}
+                WHERE {link_col} IN (SELECT link FROM temp.archive_links)
+            """)
+
+        c.execute("""
+            DELETE FROM main.two_phase_subgroups
+            WHERE subgroup_id IN (SELECT subgroup_id FROM archive.two_phase_subgroups)
+              AND NOT EXISTS (
+                  SELECT 1 FROM main.two_phase_subgroup_memberships tsgm
+                  WHERE tsgm.subgroup_id = two_phase_subgroups.subgroup_id
+              )
+        """)
+
+        conn.commit()
+        logger.info("Archived %d articles older than %s days to %s.", moved, max_age_days, archive_path)
+        return moved
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error archiving articles: {e}")
+        return 0
+    finally:
+        c.execute("DROP TABLE IF EXISTS temp.archive_links")
+        conn.close()
@@ -0,0 +1,231 @@
+# db/checkpoints.py
+"""
+Per-chunk checkpoints of the chunked LLM stages (pipeline_runs / pipeline_chunks).
+
+A stage records the chunks of a run before sending them, marks each one
+'answered' (storing its parsed answer) and then 'done' once its results are
+saved, and the run 'done' at the end. A run left 'running' by a killed
+process is resumed the next time its stage runs, from its first incomplete
+chunk: answered chunks are replayed from their stored answer, and only the
+chunks that never got one are sent again, with the same articles in the
+same order.
+"""
+
+import json
+import logging
+
+from db.database import get_connection, stage_pending_condition
+
+logger = logging.getLogger(__name__)
+
+# Finished runs are kept this long, for inspection
+PIPELINE_RUN_RETENTION_DAYS = 7
+
+class ChunkRun:
+    """
+    One checkpointed pass of 'stage' (a pipeline stage, see PIPELINE_STAGES)
+    over its chunks. 'scope' tells runs of the same stage apart, e.g. the
+    category being sub-grouped.
+    """
+
+    def __init__(self, run_id, stage, scope, db_path="db/news.db"):
+        self.run_id = run_id
+        self.stage = stage
+        self.scope = scope
+        self.db_path = db_path
+        self._chunk_index = {}   # article link -> chunk index
+        self._open_results = {}  # chunk index -> results not saved yet
+        self._answered = []      # stored results of answered chunks, see pending_chunks
+
+    @classmethod
+    def start(cls, stage, chunks, scope="", db_path="db/news.db"):
+        """Record a new run over 'chunks' ({link: text} dicts, in send order)."""
+        conn = get_connection(db_path)
+        c = conn.cursor()
+        try:
+            expired = f"-{PIPELINE_RUN_RETENTION_DAYS} days"
+            c.execute("""
+                DELETE FROM pipeline_chunks WHERE run_id IN (
+                    SELECT run_id FROM pipeline_runs
+                    WHERE status = 'done' AND finished_at < datetime('now', ?)
+                )
+            """, (expired,))
+            c.execute("""
+                DELETE FROM pipeline_runs
+                WHERE status = 'done' AND finished_at < datetime('now', ?)
+            """, (expired,))
+            c.execute("INSERT INTO pipeline_runs (stage, scope) VALUES (?, ?)", (stage, scope))
+            run_id = c.lastrowid
+            c.executemany("""
+                INSERT INTO pipeline_chunks (run_id, chunk_index, article_links)
+                VALUES (?, ?, ?)
+            """, [(run_id, idx, json.dumps(list(chunk))) for idx, chunk in enumerate(chunks)])
+            conn.commit()
+        finally:
+            conn.close()
+
+        run = cls(run_id, stage, scope, db_path)
+        for idx, chunk in enumerate(chunks):
+            run._chunk_index.update({link: idx for link in chunk})
+        return run
+
+    @classmethod
+    def unfinished(cls, stage, scope="", db_path="db/news.db"):
+        """Runs of 'stage' (in 'scope'; any scope if None) left 'running', oldest first."""
+        conn = get_connection(db_path)
+        try:
+            rows = conn.execute("""
+                SELECT run_id, scope FROM pipeline_runs
+                WHERE stage = ? AND status = 'running' AND (? IS NULL OR scope = ?)
+                ORDER BY run_id
+            """, (stage, scope, scope)).fetchall()
+        finally:
+            conn.close()
+        return [cls(run_id, stage, run_scope, db_path) for run_id, run_scope in rows]
+
+    def _incomplete_chunks(self):
+        conn = get_connection(self.db_path)
+        try:
+            rows = conn.execute("""
+                SELECT chunk_index, article_links, answers FROM pipeline_chunks
+                WHERE run_id = ? AND status != 'done'
+                ORDER BY chunk_index
+            """, (self.run_id,)).fetchall()
+        finally:
+            conn.close()
+        return [(idx, json.loads(links), json.loads(answers) if answers else None)
+                for idx, links, answers in rows]
+
+    def pending_links(self):
+        """
+        Links of the incomplete chunks whose stage is still due (articles that
+        were saved, or failed and backed off, are left out).
+        """
+        links = [link for _, chunk_links, _ in self._incomplete_chunks() for link in chunk_links]
+        if not links:
+            return []
+        conn = get_connection(self.db_path)
+        try:
+            due = {row[0] for row in conn.execute(f"""
+                SELECT ps.article_link
+                FROM json_each(?) j
+                JOIN article_pipeline_state ps ON ps.article_link = j.value
+                WHERE ps.stage = ? AND {stage_pending_condition("ps")}
+            """, (json.dumps(links), self.stage))}
+        finally:
+            conn.close()
+        return [link for link in links if link in due]
+
+    def pending_chunks(self, texts):
+        """
+        The incomplete chunks that still need an LLM answer, first one first,
+        rebuilt from 'texts' ({link: text}, normally for pending_links()) in
+        their recorded order. Links without text are dropped, and so are
+        chunks left empty. Chunks that were already answered are kept for
+        answered_results() instead.
+        """
+        chunks = []
+        self._answered = []
+        for idx, chunk_links, answers in self._incomplete_chunks():
+            if answers is not None:
+                for part_links, items in answers:
+                    part = self._chunk_texts(idx, part_links, texts)
+                    if part:
+                        self._answered.append((part, None, items))
+                continue
+            chunk = self._chunk_texts(idx, chunk_links, texts)
+            if chunk:
+                chunks.append(chunk)
+        logger.info(f"Resuming {self.stage} run {self.run_id} ({self.scope or 'all'}): "
+                    f"{len(self._answered)} answered results to save, {len(chunks)} chunks to send.")
+        return chunks
+
+    def _chunk_texts(self, idx, links, texts):
+        chunk = {}
+        for link in links:
+            text = (texts.get(link) or "").strip()
+            if text:
+                chunk[link] = text
+                self._chunk_index[link] = idx
+        return chunk
+
+    def answered_results(self):
+        """
+        The stored answers of the chunks pending_chunks() found answered, as
+        call_gpt_api_chunks results (chunk_dict, None, items), for the caller
+        to save together with the answers of the chunks it sends.
+        """
+        return list(self._answered)
+
+    def record_answers(self, results):
+        """
+        Mark the chunks of call_gpt_api_chunks 'results' answered and store
+        their parsed items (every part of a split chunk), so a resumed run
+        saves them without asking the LLM again.
+        """
+        answers = {}
+        for chunk_dict, messages, items in results:
+            idx = self._chunk_index.get(next(iter(chunk_dict)))
+            if idx is None:
+                continue
+            self._open_results[idx] = self._open_results.get(idx, 0) + 1
+            answers.setdefault(idx, []).append([list(chunk_dict), items])
+        self._update_chunks("""
+            UPDATE pipeline_chunks SET status = 'answered', answers = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE run_id = ? AND chunk_index = ?
+        """, [(json.dumps(parts), self.run_id, idx) for idx, parts in answers.items()])
+
+    def chunk_saved(self, chunk_dict):
+        """
+        Call after saving one result of record_answers: its chunk is 'done'
+        once all of its results are saved.
+        """
+        idx = self._chunk_index.get(next(iter(chunk_dict)))
+        if idx is None:
+            return
+        self._open_results[idx] = self._open_results.get(idx, 1) - 1
+        if self._open_results[idx] <= 0:
+            self._update_chunks("""
+                UPDATE pipeline_chunks SET status = 'done', updated_at = CURRENT_TIMESTAMP
+                WHERE run_id = ? AND chunk_index = ?
+            """, [(self.run_id, idx)])
+
+    def finish(self):
+        """Mark the run done (its remaining chunks are not resumed)."""
+        conn = get_connection(self.db_path)
+        try:
+            conn.execute("""
+                UPDATE pipeline_runs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+                WHERE run_id = ?
+            """, (self.run_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _update_chunks(self, query, rows):
+        if not rows:
+            return
+        conn = get_connection(self.db_path)
+        try:
+            conn.executemany(query, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_unfinished_runs(db_path="db/news.db"):
+    """
+    [(stage, scope, chunks done, chunks in total)] for runs left 'running',
+    oldest first.
+    """
+    conn = get_connection(db_path)
+    try:
+        return conn.execute("""
+            SELECT r.stage, r.scope, SUM(ch.status = 'done'), COUNT(ch.chunk_index)
+            FROM pipeline_runs r
+            LEFT JOIN pipeline_chunks ch ON ch.run_id = r.run_id
+            WHERE r.status = 'running'
+            GROUP BY r.run_id
+            ORDER BY r.run_id
+        """).fetchall()
+    finally:
+        conn.close()
@@ -1,20 +1,153 @@
+import os
 import sqlite3
 import time
-from datetime import datetime
+from urllib.parse import quote
+from datetime import datetime, timedelta, timezone
 
-def get_connection(db_path="db/news.db"):
+# Articles older than this are moved from the hot DB to the archive DB
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+
+# How long a connection waits for another writer's lock (parallel pipeline
+# workers write to the same DB) before failing with "database is locked"
+DB_BUSY_TIMEOUT_SECONDS = 30
+
+# Per-article tables whose rows move to the archive together with the article
+ARCHIVED_TABLES = (
+    "articles",
+    "two_phase_article_group_memberships",
+    "two_phase_subgroup_memberships",
+    "article_companies",
+    "article_cves",
+)
+# Tables copied (not moved) to the archive; archive rows only fill in IDs the
+# hot DB no longer has
+COPIED_TABLES = {
+    "two_phase_article_groups": "group_id",
+    "two_phase_subgroups": "subgroup_id",
+}
+
+def get_archive_path(db_path="db/news.db"):
+    """
+    Path of the archive database that belongs to db_path (db/news.db -> db/news_archive.db).
+    """
+    root, ext = os.path.splitext(db_path)
+    return f"{root}_archive{ext or '.db'}"
+
+def get_snapshot_path(db_path="db/news.db"):
+    """
+    Path of the read-only dashboard snapshot of db_path (db/news.db -> db/news_snapshot.db).
+    """
+    root, ext = os.path.splitext(db_path)
+    return f"{root}_snapshot{ext or '.db'}"
+
+def is_snapshot_path(db_path):
+    """
+    True for published snapshot files (including a snapshot's archive), which
+    are never written in place and can be opened with immutable=1.
+    """
+    root, _ = os.path.splitext(os.path.basename(db_path))
+    return root.endswith("_snapshot") or root.endswith("_snapshot_archive")
+
+def _connect(db_path):
+    if is_snapshot_path(db_path):
+        return sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro&immutable=1", uri=True)
+    return sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_SECONDS)
+
+def needs_archive(date_hours):
+    """
+    True if a dashboard time range ('All time' is None) reaches into archived articles.
+    """
+    return date_hours is None or date_hours > ARCHIVE_AFTER_DAYS * 24
+
+def get_connection(db_path="db/news.db", include_archive=False):
     """
     Returns a new connection to the SQLite database.
+    Snapshot paths (see get_snapshot_path) are opened read-only with immutable=1.
+
+    With include_archive=True (and an existing archive DB), the archive is
+    attached as 'archive' and TEMP views named like the archived tables shadow
+    them, so unqualified read queries see hot + archived rows. Such a
+    connection is for reading only.
     """
-    return sqlite3.connect(db_path)
+    conn = _connect(db_path)
+    archive_path = get_archive_path(db_path)
+    if include_archive and os.path.exists(archive_path):
+        if is_snapshot_path(archive_path):
+            archive_path = f"file:{quote(os.path.abspath(archive_path))}?mode=ro&immutable=1"
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        _create_combined_views(conn)
+    return conn
+
+# Rows fetched per round trip by iter_query
+FETCH_BATCH_ROWS = 500
+
+def iter_query(query, params=(), db_path="db/news.db", batch_size=FETCH_BATCH_ROWS):
+    """
+    Yield the rows of 'query' straight from a cursor, batch_size at a time
+    (fetchmany), so only one batch is held in memory. The connection stays
+    open until the generator is exhausted or closed; in WAL mode the rows come
+    from one consistent snapshot while other connections keep writing.
+    """
+    conn = get_connection(db_path)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def _table_columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def _create_combined_views(conn):
+    """
+    Create TEMP views (hot UNION ALL archive) for every archived/copied table.
+    Only columns present in both databases are exposed.
+    """
+    for table in ARCHIVED_TABLES + tuple(COPIED_TABLES):
+        archive_cols = set(_table_columns(conn, "archive", table))
+        cols = [c for c in _table_columns(conn, "main", table) if c in archive_cols]
+        if not cols:
+            continue
+        col_list = ", ".join(cols)
+        archive_filter = ""
+        if table in COPIED_TABLES:
+            key = COPIED_TABLES[table]
+            archive_filter = f"WHERE {key} NOT IN (SELECT {key} FROM main.{table})"
+        conn.execute(f"""
+            CREATE TEMP VIEW IF NOT EXISTS {table} AS
+            SELECT {col_list} FROM main.{table}
+            UNION ALL
+            SELECT {col_list} FROM archive.{table} {archive_filter}
+        """)
+
+def is_archive_attached(conn):
+    """
+    True if 'conn' was opened with the archive attached.
+    """
+    return any(row[1] == "archive" for row in conn.execute("PRAGMA database_list"))
+
+# Bump whenever setup_database changes (a table, column, index, trigger or
+# migration), so existing databases run it again once
+SCHEMA_VERSION = 1
 
 def setup_database(db_path="db/news.db"):
     """
     Create all necessary tables in the SQLite database.
     (Call this once at startup or whenever you need to ensure the schema exists.)
+    A database already at SCHEMA_VERSION (PRAGMA user_version) is left alone,
+    so calling it every cycle costs one pragma read.
     """
     conn = get_connection(db_path)
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        return
     cursor = conn.cursor()
+    # Readers never block the writer (and vice versa); persistent per DB file
+    cursor.execute("PRAGMA journal_mode=WAL")
 
     # Articles table (assumes you have this table in your schema)
     # Adjust as needed if you store articles differently
@@ -23,9 +156,25 @@ def setup_database(db_path="db/news.db"):
         link TEXT PRIMARY KEY,
         title TEXT,
         content TEXT,
-        published_date TIMESTAMP
+        published_date TIMESTAMP,
+        source TEXT
     )
     """)
+    # Older databases were created without the scrapers' 'source' column
+    ensure_column(cursor, "articles", "source", "TEXT")
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_articles_published_date ON articles (published_date)
+    """)
+
+    # -------------------------------
+    # Lead paragraph, cut at ingest (cheap input for coarse LLM stages)
+    # -------------------------------
+    setup_lead_text(cursor)
+
+    # -------------------------------
+    # Full-text search (FTS5) over articles
+    # -------------------------------
+    setup_search_index(cursor)
 
     # -------------------------------
     # Two-phase grouping tables
@@ -49,6 +198,40 @@ def setup_database(db_path="db/news.db"):
         PRIMARY KEY (article_link, group_id)
     )
     """)
+    # 'llm' or 'classifier' (the local model, see analysis/local_classifier.py)
+    ensure_column(cursor, "two_phase_article_group_memberships", "assigned_by", "TEXT DEFAULT 'llm'")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS classifier_audits (
+        model_version INTEGER NOT NULL,
+        article_link TEXT NOT NULL,
+        predicted_category TEXT NOT NULL,
+        llm_category TEXT NOT NULL,
+        confidence REAL NOT NULL,
+        checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (model_version, article_link)
+    )
+    """)
+
+    # -------------------------------
+    # Category taxonomy, versioned (see analysis/taxonomy.py)
+    # -------------------------------
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS taxonomy_versions (
+        version INTEGER PRIMARY KEY,
+        note TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS taxonomy_categories (
+        version INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        derived_from TEXT,
+        PRIMARY KEY (version, name),
+        FOREIGN KEY (version) REFERENCES taxonomy_versions (version)
+    )
+    """)
 
     # -------------------------------
     # Subgroup tables
@@ -72,6 +255,21 @@ def setup_database(db_path="db/news.db"):
         PRIMARY KEY (article_link, subgroup_id)
     )
     """)
+    # Mean embedding of the members (float32 bytes) and the number of members it
+    # averages, used to attach new articles (see analysis/subgroup_clustering.py)
+    ensure_column(cursor, "two_phase_subgroups", "centroid", "BLOB")
+    ensure_column(cursor, "two_phase_subgroups", "centroid_count", "INTEGER DEFAULT 0")
+    # Latest member added_at the summary covers (see analysis/subgroup_summaries.py);
+    # existing summaries were written when the subgroup was created
+    if ensure_column(cursor, "two_phase_subgroups", "summarized_through", "TIMESTAMP"):
+        cursor.execute("UPDATE two_phase_subgroups SET summarized_through = created_at")
+    # Last merge of duplicate subgroups per category (see analysis/subgroup_compaction.py)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subgroup_compaction_runs (
+        category TEXT PRIMARY KEY,
+        compacted_at TIMESTAMP
+    )
+    """)
 
     # -------------------------------
     # Company references
@@ -111,9 +309,728 @@ def setup_database(db_path="db/news.db"):
     )
     """)
 
+    # -------------------------------
+    # Dashboard counters (trigger-maintained)
+    # -------------------------------
+    setup_dashboard_stats(cursor)
+    setup_canonical_categories(cursor)
+
+    # -------------------------------
+    # Per-article pipeline stage state
+    # -------------------------------
+    setup_pipeline_state(cursor)
+
+    # -------------------------------
+    # Checkpoints of chunked LLM stage runs (see db/checkpoints.py)
+    # -------------------------------
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pipeline_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        stage TEXT NOT NULL,
+        scope TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT 'running',  -- 'running' / 'done'
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_pipeline_runs_stage
+    ON pipeline_runs (stage, status)
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pipeline_chunks (
+        run_id INTEGER NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        article_links TEXT NOT NULL,             -- JSON list, in prompt order
+        status TEXT NOT NULL DEFAULT 'pending',  -- 'pending' / 'answered' / 'done'
+        answers TEXT,                            -- JSON [[part links, parsed items], ...]
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (run_id, chunk_index)
+    )
+    """)
+    ensure_column(cursor, "pipeline_chunks", "answers", "TEXT")
+
+    # -------------------------------
+    # Change counters + stage watermarks (skip stages whose inputs are unchanged)
+    # -------------------------------
+    setup_stage_watermarks(cursor)
+
+    # -------------------------------
+    # Text view chosen per LLM stage (see analysis/text_views.py)
+    # -------------------------------
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stage_text_views (
+        stage TEXT PRIMARY KEY,
+        text_view TEXT NOT NULL,
+        accuracy REAL,
+        sample_size INTEGER,
+        measured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
     conn.close()
 
+def ensure_column(cursor, table, column, column_type):
+    """
+    Add 'column' to 'table' if it does not exist yet (lightweight migration).
+    Returns True if the column was added.
+    """
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    if column not in existing:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        return True
+    return False
+
+# Characters of content kept in articles.lead_text (~600-800 tokens of English)
+LEAD_TEXT_CHARS = 3000
+
+def setup_lead_text(cursor):
+    """
+    Add articles.lead_text (the first LEAD_TEXT_CHARS characters of content)
+    and the triggers that fill it whenever an article is written, so stages
+    that only need the lead never read (or send) the whole body.
+    """
+    added = ensure_column(cursor, "articles", "lead_text", "TEXT")
+    lead_sql = f"substr(new.content, 1, {LEAD_TEXT_CHARS})"
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS articles_lead_text_after_insert
+    AFTER INSERT ON articles BEGIN
+        UPDATE articles SET lead_text = {lead_sql} WHERE rowid = new.rowid;
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS articles_lead_text_after_update
+    AFTER UPDATE OF content ON articles BEGIN
+        UPDATE articles SET lead_text = {lead_sql} WHERE rowid = new.rowid;
+    END
+    """)
+    # Articles stored before the column existed
+    if added:
+        cursor.execute(f"""
+            UPDATE articles SET lead_text = substr(content, 1, {LEAD_TEXT_CHARS})
+        """)
+
+def setup_search_index(cursor):
+    """
+    Create the 'articles_fts' FTS5 index over articles.title/content and the
+    triggers that keep it in sync. The index is external-content, so the text
+    itself is only stored once (in 'articles').
+
+    The scrapers write with INSERT OR REPLACE, and REPLACE does not fire delete
+    triggers, so a BEFORE INSERT trigger removes the old index entry first.
+    """
+    exists = cursor.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'articles_fts'
+    """).fetchone()
+
+    cursor.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(
+        title,
+        content,
+        content='articles',
+        content_rowid='rowid',
+        tokenize='porter unicode61'
+    )
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS articles_fts_before_insert
+    BEFORE INSERT ON articles BEGIN
+        INSERT INTO articles_fts (articles_fts, rowid, title, content)
+        SELECT 'delete', rowid, title, content FROM articles WHERE link = new.link;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS articles_fts_after_insert
+    AFTER INSERT ON articles BEGIN
+        INSERT INTO articles_fts (rowid, title, content)
+        VALUES (new.rowid, new.title, new.content);
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS articles_fts_after_delete
+    AFTER DELETE ON articles BEGIN
+        INSERT INTO articles_fts (articles_fts, rowid, title, content)
+        VALUES ('delete', old.rowid, old.title, old.content);
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS articles_fts_after_update
+    AFTER UPDATE OF title, content ON articles BEGIN
+        INSERT INTO articles_fts (articles_fts, rowid, title, content)
+        VALUES ('delete', old.rowid, old.title, old.content);
+        INSERT INTO articles_fts (rowid, title, content)
+        VALUES (new.rowid, new.title, new.content);
+    END
+    """)
+
+    # First time on an existing database: index everything already stored
+    if not exists:
+        cursor.execute("INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')")
+
+def rebuild_search_index(db_path="db/news.db"):
+    """
+    Rebuild 'articles_fts' from scratch. Needed after a VACUUM (which may
+    renumber the implicit rowids of 'articles') or if the index gets out of sync.
+    """
+    conn = get_connection(db_path)
+    try:
+        conn.execute("INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')")
+        conn.commit()
+    finally:
+        conn.close()
+
+# Pipeline stages tracked per article in article_pipeline_state
+PIPELINE_STAGES = ("companies", "cves", "categorization", "subgrouping")
+MAX_STAGE_ATTEMPTS = 3
+RETRY_BACKOFF_MINUTES = 30  # doubled after every failed attempt
+
+def setup_pipeline_state(cursor):
+    """
+    Create article_pipeline_state: one row per (article, stage) with status
+    ('pending' / 'done' / 'failed'), attempt count, last error and retry_after.
+    New articles get a pending row for every stage via trigger, and each stage
+    selects its work from the (stage, status, retry_after) index instead of
+    anti-joining its output table, so an article the LLM found nothing in
+    is not re-sent every cycle.
+    """
+    exists = cursor.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'article_pipeline_state'
+    """).fetchone()
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS article_pipeline_state (
+        article_link TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        retry_after TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (article_link, stage)
+    )
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_pipeline_state_work
+    ON article_pipeline_state (stage, status, retry_after)
+    """)
+
+    stage_rows = " UNION ALL ".join(f"SELECT '{stage}' AS stage" for stage in PIPELINE_STAGES)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS pipeline_state_after_insert
+    AFTER INSERT ON articles BEGIN
+        INSERT OR IGNORE INTO article_pipeline_state (article_link, stage)
+        SELECT new.link, stage FROM ({stage_rows});
+    END
+    """)
+
+    if not exists:
+        _backfill_pipeline_state(cursor)
+
+def _backfill_pipeline_state(cursor):
+    """
+    Seed article_pipeline_state for articles stored before the table existed,
+    deriving 'done' from the stage output tables. The CVE regex pass is cheap,
+    so every existing article is simply scanned once more.
+    """
+    cursor.execute("""
+        INSERT OR IGNORE INTO article_pipeline_state (article_link, stage, status)
+        SELECT a.link, 'companies',
+               CASE WHEN EXISTS (SELECT 1 FROM article_companies ac WHERE ac.article_link = a.link)
+                    THEN 'done' ELSE 'pending' END
+        FROM articles a
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO article_pipeline_state (article_link, stage, status)
+        SELECT a.link, 'cves', 'pending'
+        FROM articles a
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO article_pipeline_state (article_link, stage, status)
+        SELECT a.link, 'categorization',
+               CASE WHEN EXISTS (SELECT 1 FROM two_phase_article_group_memberships tgm
+                                 WHERE tgm.article_link = a.link)
+                    THEN 'done' ELSE 'pending' END
+        FROM articles a
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO article_pipeline_state (article_link, stage, status)
+        SELECT a.link, 'subgrouping',
+               CASE WHEN EXISTS (
+                   SELECT 1
+                   FROM two_phase_article_group_memberships tgm
+                   JOIN two_phase_article_groups tg ON tg.group_id = tgm.group_id
+                   JOIN two_phase_subgroups tsg ON tsg.category = tg.main_topic
+                   JOIN two_phase_subgroup_memberships tsgm
+                        ON tsgm.subgroup_id = tsg.subgroup_id AND tsgm.article_link = a.link
+                   WHERE tgm.article_link = a.link
+               ) THEN 'done' ELSE 'pending' END
+        FROM articles a
+    """)
+
+def stage_pending_condition(alias="ps"):
+    """
+    SQL condition selecting article_pipeline_state rows that are due for work.
+    """
+    return (
+        f"{alias}.status = 'pending' "
+        f"AND ({alias}.retry_after IS NULL OR {alias}.retry_after <= CURRENT_TIMESTAMP)"
+    )
+
+# added_at of new subgroup memberships: millisecond precision, so members added
+# right after a summary was written are still newer than its summarized_through
+MEMBERSHIP_ADDED_AT_SQL = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+def mark_subgroup_summarized(cursor, subgroup_id):
+    """
+    Record that the subgroup's summary covers all of its current members.
+    """
+    cursor.execute("""
+        UPDATE two_phase_subgroups
+        SET summarized_through = (
+            SELECT MAX(added_at) FROM two_phase_subgroup_memberships
+            WHERE subgroup_id = two_phase_subgroups.subgroup_id
+        )
+        WHERE subgroup_id = ?
+    """, (subgroup_id,))
+
+def mark_stage_done(cursor, article_links, stage):
+    """
+    Mark 'stage' as done for the given articles (call inside the transaction
+    that stores the stage's results).
+    """
+    cursor.executemany("""
+        INSERT INTO article_pipeline_state (article_link, stage, status)
+        VALUES (?, ?, 'done')
+        ON CONFLICT(article_link, stage) DO UPDATE SET
+            status = 'done',
+            last_error = NULL,
+            retry_after = NULL,
+            updated_at = CURRENT_TIMESTAMP
+    """, [(link, stage) for link in article_links])
+
+def mark_stage_failed(cursor, article_links, stage, error, max_attempts=MAX_STAGE_ATTEMPTS):
+    """
+    Record a failed attempt of 'stage' for the given articles. They are retried
+    after an exponential backoff, and marked 'failed' for good after max_attempts.
+    """
+    cursor.executemany("""
+        UPDATE article_pipeline_state
+        SET attempts = attempts + 1,
+            last_error = ?,
+            status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+            retry_after = datetime('now', printf('+%d minutes', ? * (1 << attempts))),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE article_link = ? AND stage = ?
+    """, [(str(error)[:1000], max_attempts, RETRY_BACKOFF_MINUTES, link, stage)
+          for link in article_links])
+
+def reset_stage(cursor, article_links, stage):
+    """
+    Put 'stage' back to pending (fresh attempts) for the given articles,
+    e.g. subgrouping after an article moved to another category.
+    """
+    cursor.executemany("""
+        INSERT INTO article_pipeline_state (article_link, stage, status)
+        VALUES (?, ?, 'pending')
+        ON CONFLICT(article_link, stage) DO UPDATE SET
+            status = 'pending',
+            attempts = 0,
+            last_error = NULL,
+            retry_after = NULL,
+            updated_at = CURRENT_TIMESTAMP
+    """, [(link, stage) for link in article_links])
+
+# Tables whose writes are counted in table_change_counters
+COUNTED_TABLES = (
+    "articles",
+    "article_cves",
+    "article_pipeline_state",
+    "two_phase_article_group_memberships",
+    "two_phase_subgroup_memberships",
+)
+
+def setup_stage_watermarks(cursor):
+    """
+    Create table_change_counters (a trigger-maintained write counter per
+    COUNTED_TABLES entry) and stage_watermarks (the input watermark each
+    cycle stage last ran successfully on), see get_input_watermark.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS table_change_counters (
+        table_name TEXT PRIMARY KEY,
+        changes INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stage_watermarks (
+        stage TEXT PRIMARY KEY,
+        watermark TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO table_change_counters (table_name) VALUES (?)",
+        [(table,) for table in COUNTED_TABLES]
+    )
+    for table in COUNTED_TABLES:
+        for event in ("insert", "update", "delete"):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS changes_{table}_after_{event}
+            AFTER {event.upper()} ON {table} BEGIN
+                UPDATE table_change_counters SET changes = changes + 1
+                WHERE table_name = '{table}';
+            END
+            """)
+
+def get_input_watermark(tables, retry_stage=None, db_path="db/news.db"):
+    """
+    Watermark of a stage's inputs: the change counters of 'tables', plus the
+    number of 'retry_stage' articles whose retry_after has come due (a retry
+    becoming due is not a write). Equal watermarks mean unchanged inputs.
+    """
+    conn = get_connection(db_path)
+    try:
+        placeholders = ",".join("?" for _ in tables)
+        counters = dict(conn.execute(f"""
+            SELECT table_name, changes FROM table_change_counters
+            WHERE table_name IN ({placeholders})
+        """, list(tables)).fetchall())
+        parts = [f"{table}={counters.get(table, 0)}" for table in tables]
+        if retry_stage:
+            due = conn.execute("""
+                SELECT COUNT(*) FROM article_pipeline_state
+                WHERE stage = ? AND status = 'pending' AND retry_after <= CURRENT_TIMESTAMP
+            """, (retry_stage,)).fetchone()[0]
+            parts.append(f"{retry_stage}_retries_due={due}")
+    finally:
+        conn.close()
+    return ";".join(parts)
+
+def stage_inputs_unchanged(stage, watermark, max_age_hours=None, db_path="db/news.db"):
+    """
+    True if 'stage' last succeeded on this same input watermark (and, with
+    max_age_hours, did so within that many hours), so it can be skipped.
+    """
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute("""
+            SELECT 1 FROM stage_watermarks
+            WHERE stage = ? AND watermark = ?
+              AND (? IS NULL OR updated_at > datetime('now', '-' || ? || ' hours'))
+        """, (stage, watermark, max_age_hours, max_age_hours)).fetchone()
+    finally:
+        conn.close()
+    return row is not None
+
+def save_stage_watermark(stage, watermark, db_path="db/news.db"):
+    """
+    Record that 'stage' ran successfully on 'watermark', as read before the
+    run: the stage's own writes make the next cycle run it once more, but
+    writes made by anything else during the run are never missed.
+    """
+    conn = get_connection(db_path)
+    try:
+        conn.execute("""
+            INSERT INTO stage_watermarks (stage, watermark, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(stage) DO UPDATE SET
+                watermark = excluded.watermark,
+                updated_at = excluded.updated_at
+        """, (stage, watermark))
+        conn.commit()
+    finally:
+        conn.close()
+
+# Hour bucket for a published_date ('YYYY-MM-DDTHH'); NULL for dates that
+# date.py has not normalized yet, which are simply not bucketed until it does.
+HOUR_BUCKET_SQL = "strftime('%Y-%m-%dT%H', {date})"
+
+DASHBOARD_STAT_NAMES = ("total_articles", "grouped_articles", "total_groups")
+
+def _article_stats_sql(link, published_date, delta, guard="1"):
+    """
+    Statements that add (delta=+1) or remove (delta=-1) one article's
+    contribution to dashboard_stats and the hourly bucket tables.
+    'link' / 'published_date' are SQL expressions, 'guard' a SQL condition.
+    """
+    bucket = HOUR_BUCKET_SQL.format(date=published_date)
+    is_grouped = f"""EXISTS (
+            SELECT 1 FROM two_phase_article_group_memberships WHERE article_link = {link}
+        )"""
+    return f"""
+        UPDATE dashboard_stats SET value = value + ({delta})
+        WHERE stat_name = 'total_articles' AND {guard};
+
+        UPDATE dashboard_stats SET value = value + ({delta})
+        WHERE stat_name = 'grouped_articles' AND {guard} AND {is_grouped};
+
+        INSERT INTO article_hourly_stats (bucket, total_articles, grouped_articles)
+        SELECT {bucket}, {delta}, ({delta}) * {is_grouped}
+        WHERE {guard} AND {bucket} IS NOT NULL
+        ON CONFLICT(bucket) DO UPDATE SET
+            total_articles = total_articles + excluded.total_articles,
+            grouped_articles = grouped_articles + excluded.grouped_articles;
+
+        INSERT INTO group_hourly_stats (bucket, group_id, article_count)
+        SELECT {bucket}, group_id, {delta}
+        FROM two_phase_article_group_memberships
+        WHERE article_link = {link} AND {guard} AND {bucket} IS NOT NULL
+        ON CONFLICT(bucket, group_id) DO UPDATE SET
+            article_count = article_count + excluded.article_count;
+    """
+
+def setup_dashboard_stats(cursor):
+    """
+    Create dashboard_stats (all-time counters), article_hourly_stats and
+    group_hourly_stats (per published hour, for time-range metrics) and the
+    triggers on articles / group tables that keep them current, so the
+    dashboard header never has to COUNT(*) over the articles table.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS dashboard_stats (
+        stat_name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS article_hourly_stats (
+        bucket TEXT PRIMARY KEY,
+        total_articles INTEGER NOT NULL DEFAULT 0,
+        grouped_articles INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS group_hourly_stats (
+        bucket TEXT NOT NULL,
+        group_id INTEGER NOT NULL,
+        article_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, group_id)
+    )
+    """)
+
+    # Replacing an existing link: drop the old row's contribution first
+    # (REPLACE does not fire the delete trigger).
+    old_link = "new.link"
+    old_date = "(SELECT published_date FROM articles WHERE link = new.link)"
+    old_exists = "EXISTS (SELECT 1 FROM articles WHERE link = new.link)"
+    triggers = {
+        "stats_articles_before_insert": (
+            "BEFORE INSERT ON articles",
+            _article_stats_sql(old_link, old_date, -1, guard=old_exists)
+        ),
+        "stats_articles_after_insert": (
+            "AFTER INSERT ON articles",
+            _article_stats_sql("new.link", "new.published_date", 1)
+        ),
+        "stats_articles_after_delete": (
+            "AFTER DELETE ON articles",
+            _article_stats_sql("old.link", "old.published_date", -1)
+        ),
+        "stats_articles_after_update_date": (
+            "AFTER UPDATE OF published_date ON articles",
+            _article_stats_sql("old.link", "old.published_date", -1)
+            + _article_stats_sql("new.link", "new.published_date", 1)
+        ),
+        "stats_memberships_after_insert": (
+            "AFTER INSERT ON two_phase_article_group_memberships",
+            _membership_stats_sql("new", 1)
+        ),
+        "stats_memberships_after_delete": (
+            "AFTER DELETE ON two_phase_article_group_memberships",
+            _membership_stats_sql("old", -1)
+        ),
+        "stats_groups_after_insert": (
+            "AFTER INSERT ON two_phase_article_groups",
+            "UPDATE dashboard_stats SET value = value + 1 WHERE stat_name = 'total_groups';"
+        ),
+        "stats_groups_after_delete": (
+            "AFTER DELETE ON two_phase_article_groups",
+            "UPDATE dashboard_stats SET value = value - 1 WHERE stat_name = 'total_groups';"
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+    # First time (or after a manual reset, with PRAGMA user_version = 0): compute everything once
+    seeded = cursor.execute("SELECT COUNT(*) FROM dashboard_stats").fetchone()[0]
+    if seeded < len(DASHBOARD_STAT_NAMES):
+        _rebuild_dashboard_stats(cursor)
+
+def setup_canonical_categories(cursor):
+    """
+    Keep one two_phase_article_groups row per main_topic. Older databases got
+    a new row per category on every pipeline run: their duplicates are
+    collapsed onto the oldest row (memberships included) before the unique
+    index is created. The stats triggers see the moves as inserts/deletes.
+    """
+    exists = cursor.execute("""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'index' AND name = 'idx_two_phase_article_groups_main_topic'
+    """).fetchone()
+    if exists:
+        return
+
+    cursor.execute("""
+        CREATE TEMP TABLE category_remap AS
+        SELECT group_id AS old_id, canonical_id AS new_id
+        FROM (
+            SELECT group_id, MIN(group_id) OVER (PARTITION BY main_topic) AS canonical_id
+            FROM two_phase_article_groups
+        )
+        WHERE group_id != canonical_id
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO two_phase_article_group_memberships (article_link, group_id, added_at, assigned_by)
+        SELECT m.article_link, r.new_id, m.added_at, m.assigned_by
+        FROM two_phase_article_group_memberships m
+        JOIN temp.category_remap r ON r.old_id = m.group_id
+    """)
+    cursor.execute("""
+        DELETE FROM two_phase_article_group_memberships
+        WHERE group_id IN (SELECT old_id FROM temp.category_remap)
+    """)
+    cursor.execute("""
+        DELETE FROM two_phase_article_groups
+        WHERE group_id IN (SELECT old_id FROM temp.category_remap)
+    """)
+    cursor.execute("DROP TABLE temp.category_remap")
+    cursor.execute("""
+        CREATE UNIQUE INDEX idx_two_phase_article_groups_main_topic
+        ON two_phase_article_groups (main_topic)
+    """)
+
+def _membership_stats_sql(row, delta):
+    """
+    Statements for one inserted (row='new', delta=+1) or deleted (row='old',
+    delta=-1) category membership. An article only counts as grouped/ungrouped
+    on its first membership insert / last membership delete.
+    """
+    link = f"{row}.article_link"
+    bucket = HOUR_BUCKET_SQL.format(date="published_date")
+    remaining = 1 if delta > 0 else 0
+    boundary = f"""EXISTS (SELECT 1 FROM articles WHERE link = {link})
+        AND (SELECT COUNT(*) FROM two_phase_article_group_memberships
+             WHERE article_link = {link}) = {remaining}"""
+    return f"""
+        UPDATE dashboard_stats SET value = value + ({delta})
+        WHERE stat_name = 'grouped_articles' AND {boundary};
+
+        UPDATE article_hourly_stats SET grouped_articles = grouped_articles + ({delta})
+        WHERE bucket = (SELECT {bucket} FROM articles WHERE link = {link}) AND {boundary};
+
+        INSERT INTO group_hourly_stats (bucket, group_id, article_count)
+        SELECT {bucket}, {row}.group_id, {delta}
+        FROM articles
+        WHERE link = {link} AND {bucket} IS NOT NULL
+        ON CONFLICT(bucket, group_id) DO UPDATE SET
+            article_count = article_count + excluded.article_count;
+    """
+
+def _rebuild_dashboard_stats(cursor):
+    """
+    Recompute all dashboard counters from the base tables.
+    """
+    bucket = HOUR_BUCKET_SQL.format(date="a.published_date")
+    cursor.execute("DELETE FROM dashboard_stats")
+    cursor.execute("DELETE FROM article_hourly_stats")
+    cursor.execute("DELETE FROM group_hourly_stats")
+    cursor.execute("""
+        INSERT INTO dashboard_stats (stat_name, value)
+        SELECT 'total_articles', COUNT(*) FROM articles
+        UNION ALL
+        SELECT 'grouped_articles', COUNT(*) FROM articles a
+        WHERE EXISTS (
+            SELECT 1 FROM two_phase_article_group_memberships m
+            WHERE m.article_link = a.link
+        )
+        UNION ALL
+        SELECT 'total_groups', COUNT(*) FROM two_phase_article_groups
+    """)
+    cursor.execute(f"""
+        INSERT INTO article_hourly_stats (bucket, total_articles, grouped_articles)
+        SELECT
+            {bucket},
+            COUNT(*),
+            SUM(EXISTS (
+                SELECT 1 FROM two_phase_article_group_memberships m
+                WHERE m.article_link = a.link
+            ))
+        FROM articles a
+        WHERE {bucket} IS NOT NULL
+        GROUP BY 1
+    """)
+    cursor.execute(f"""
+        INSERT INTO group_hourly_stats (bucket, group_id, article_count)
+        SELECT {bucket}, m.group_id, COUNT(*)
+        FROM two_phase_article_group_memberships m
+        JOIN articles a ON a.link = m.article_link
+        WHERE {bucket} IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+def rebuild_dashboard_stats(db_path="db/news.db"):
+    """
+    Recompute the trigger-maintained dashboard counters from scratch
+    (e.g. after bulk edits done with triggers disabled).
+    """
+    conn = get_connection(db_path)
+    try:
+        _rebuild_dashboard_stats(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_dashboard_stats(date_hours=None, db_path="db/news.db", include_archive=False):
+    """
+    Return the dashboard header metrics as a dict with total_articles,
+    ungrouped_articles, grouped_articles and total_groups.
+    With date_hours, metrics cover articles published in the last N hours,
+    at hour granularity (the hour containing the cutoff is included).
+    With include_archive, archived articles are counted too (group rows are
+    never removed from the hot DB, so total_groups is the hot count).
+    """
+    conn = get_connection(db_path, include_archive=include_archive)
+    schemas = ["main"] + (["archive"] if is_archive_attached(conn) else [])
+    try:
+        total = grouped = 0
+        group_ids = set()
+        for schema in schemas:
+            if date_hours is None:
+                stats = dict(conn.execute(
+                    f"SELECT stat_name, value FROM {schema}.dashboard_stats"
+                ).fetchall())
+                total += stats.get("total_articles", 0)
+                grouped += stats.get("grouped_articles", 0)
+                if schema == "main":
+                    groups = stats.get("total_groups", 0)
+            else:
+                cutoff_utc = datetime.now(timezone.utc) - timedelta(hours=date_hours)
+                cutoff_bucket = cutoff_utc.strftime("%Y-%m-%dT%H")
+                range_total, range_grouped = conn.execute(f"""
+                    SELECT COALESCE(SUM(total_articles), 0), COALESCE(SUM(grouped_articles), 0)
+                    FROM {schema}.article_hourly_stats
+                    WHERE bucket >= ?
+                """, (cutoff_bucket,)).fetchone()
+                total += range_total
+                grouped += range_grouped
+                group_ids.update(row[0] for row in conn.execute(f"""
+                    SELECT DISTINCT group_id
+                    FROM {schema}.group_hourly_stats
+                    WHERE bucket >= ? AND article_count > 0
+                """, (cutoff_bucket,)))
+                groups = len(group_ids)
+    finally:
+        conn.close()
+
+    return {
+        "total_articles": total,
+        "ungrouped_articles": total - grouped,
+        "grouped_articles": grouped,
+        "total_groups": groups,
+    }
+
 #
 # Below you can add optional "getter" or "setter" functions that encapsulate queries
 # for articles, groups, etc. For example:
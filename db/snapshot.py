@@ -0,0 +1,72 @@
+# db/snapshot.py
+
+import os
+import sqlite3
+import logging
+
+from db.database import (
+    get_archive_path,
+    get_snapshot_path,
+    get_input_watermark,
+    stage_inputs_unchanged,
+    save_stage_watermark,
+    COUNTED_TABLES
+)
+
+logger = logging.getLogger(__name__)
+
+# Re-publish at least this often even without counted changes, for writes to
+# tables the change counters do not cover (e.g. rolled-forward subgroup summaries)
+SNAPSHOT_MAX_AGE_HOURS = 6
+
+def _backup_and_swap(src_path, snapshot_path):
+    """
+    Copy src_path into a temp file with the online backup API (a consistent
+    point-in-time copy, even while the pipeline keeps writing), then atomically
+    rename it over snapshot_path. Readers holding the old file keep reading it.
+    """
+    tmp_path = snapshot_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+        # The snapshot is opened immutable, so it must not be in WAL mode
+        dst.execute("PRAGMA journal_mode=DELETE")
+        dst.commit()
+    finally:
+        dst.close()
+        src.close()
+
+    os.replace(tmp_path, snapshot_path)
+
+def publish_dashboard_snapshot(db_path="db/news.db", refresh_archive=False):
+    """
+    Publish a read-only snapshot of db_path for the dashboard (see
+    get_snapshot_path). The archive DB, which only changes when articles are
+    archived, is re-published when refresh_archive is set or no snapshot of it
+    exists yet. The archive is swapped first, so a reader never misses an
+    article that was just archived.
+    Skipped (returns None) when no counted table (COUNTED_TABLES) changed
+    since the last published snapshot, nothing was archived and that
+    snapshot is less than SNAPSHOT_MAX_AGE_HOURS old.
+    """
+    snapshot_path = get_snapshot_path(db_path)
+    archive_path = get_archive_path(db_path)
+    archive_snapshot_path = get_archive_path(snapshot_path)
+
+    watermark = get_input_watermark(COUNTED_TABLES, db_path=db_path)
+    if (not refresh_archive and os.path.exists(snapshot_path)
+            and stage_inputs_unchanged("snapshot", watermark, SNAPSHOT_MAX_AGE_HOURS, db_path=db_path)):
+        logger.info("Dashboard snapshot is up to date; not re-published.")
+        return None
+
+    if os.path.exists(archive_path) and (refresh_archive or not os.path.exists(archive_snapshot_path)):
+        _backup_and_swap(archive_path, archive_snapshot_path)
+
+    _backup_and_swap(db_path, snapshot_path)
+    save_stage_watermark("snapshot", watermark, db_path=db_path)
+    logger.info("Published dashboard snapshot %s.", snapshot_path)
+    return snapshot_path
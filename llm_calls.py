@@ -1,54 +1,457 @@
 # llm_calls.py
 
 import os
+import re
+import json
 import time
+import sqlite3
+import asyncio
+import hashlib
+import random
 import logging
-from openai import OpenAI
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import openai
+from openai import AsyncOpenAI
+
+from tokenizer import count_message_tokens
+from utils import parse_json_list
 
 MODEL = "o3-mini"
-MAX_RETRIES = 3
+MAX_RETRIES = 6
 REQUEST_TIMEOUT = 240
+# Account rate limits the governor keeps all calls of this process under
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "500"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "2000000"))
+# Exponential backoff (with jitter) for transient errors
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 120
+# How many times a chunk with a malformed answer is halved and re-sent
+SALVAGE_MAX_SPLIT_DEPTH = 3
+# Max LLM requests in flight at once for batched (concurrent) dispatch
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+
+# Persistent response cache (separate file, so it never bloats news.db or its snapshot)
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "db/llm_cache.db")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+# Set LLM_CACHE_BYPASS=1 to always call the API (responses are still stored)
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
 
 logger = logging.getLogger(__name__)
 
-def call_gpt_api(messages, api_key=None, model=MODEL):
+_cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+def cache_key(messages, model=MODEL):
     """
-    Call OpenAI API with retry logic and basic error handling.
-    If api_key is not provided, attempts to get it from environment variables.
+    Stable hash of (model, messages), used as the response cache key.
+    """
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _cache_connection():
+    conn = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used_at)")
+    return conn
+
+def cache_get(key):
+    """
+    Return the cached response for 'key' if present and younger than the TTL, else None.
+    """
+    now = time.time()
+    with _cache_lock:
+        conn = _cache_connection()
+        try:
+            row = conn.execute("""
+                SELECT response FROM llm_cache
+                WHERE cache_key = ? AND created_at >= ?
+            """, (key, now - LLM_CACHE_TTL_SECONDS)).fetchone()
+            if row is None:
+                cache_stats["misses"] += 1
+                return None
+            conn.execute("UPDATE llm_cache SET last_used_at = ? WHERE cache_key = ?", (now, key))
+            conn.commit()
+            cache_stats["hits"] += 1
+            return row[0]
+        finally:
+            conn.close()
+
+def cache_put(key, model, response):
+    """
+    Store a response, then evict expired entries and the least recently used
+    ones beyond LLM_CACHE_MAX_ENTRIES.
+    """
+    now = time.time()
+    with _cache_lock:
+        conn = _cache_connection()
+        try:
+            conn.execute("""
+                INSERT OR REPLACE INTO llm_cache (cache_key, model, response, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, model, response, now, now))
+            evicted = conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL_SECONDS,)
+            ).rowcount
+            evicted += conn.execute("""
+                DELETE FROM llm_cache WHERE cache_key IN (
+                    SELECT cache_key FROM llm_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (LLM_CACHE_MAX_ENTRIES,)).rowcount
+            conn.commit()
+            cache_stats["stores"] += 1
+            cache_stats["evictions"] += evicted
+        finally:
+            conn.close()
+
+def cache_invalidate(messages, model=MODEL):
+    """
+    Drop the cached response for a request, e.g. because it could not be parsed.
+    """
+    with _cache_lock:
+        conn = _cache_connection()
+        try:
+            conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (cache_key(messages, model),))
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_cache_stats():
+    """
+    Hit/miss/store/eviction counters for this process, plus the current entry count.
+    """
+    with _cache_lock:
+        conn = _cache_connection()
+        try:
+            entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        finally:
+            conn.close()
+        return dict(cache_stats, entries=entries)
+
+class RateGovernor:
+    """
+    Process-wide sliding-window limiter for requests and tokens per minute.
+    Calls reserve() before sending; reservations are granted in FIFO order at
+    the earliest time both limits allow, and a 429 Retry-After pauses everyone.
+    Thread-safe, and usable from sync and async code (it only computes waits).
+    """
+
+    def __init__(self, rpm_limit, tpm_limit, window_seconds=60.0):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.window = window_seconds
+        self._events = deque()  # (send_time, tokens), in send_time order
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """
+        Book a request of 'tokens' tokens. Returns how many seconds the caller
+        must wait before sending it (0 if it may go now).
+        """
+        tokens = min(tokens, self.tpm_limit)  # an oversize request still runs, alone
+        with self._lock:
+            now = time.monotonic()
+            while self._events and self._events[0][0] <= now - self.window:
+                self._events.popleft()
+
+            send_at = max(now, self._paused_until, self._events[-1][0] if self._events else now)
+            while True:
+                in_window = [(t, n) for t, n in self._events if t > send_at - self.window]
+                if (len(in_window) + 1 <= self.rpm_limit
+                        and sum(n for _, n in in_window) + tokens <= self.tpm_limit):
+                    break
+                # Wait until the oldest request in the window drops out
+                send_at = in_window[0][0] + self.window
+
+            self._events.append((send_at, tokens))
+            return send_at - now
+
+    def pause(self, seconds):
+        """Hold back all new requests for 'seconds' (e.g. after a 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+governor = RateGovernor(LLM_RPM_LIMIT, LLM_TPM_LIMIT)
+
+def _retry_after_seconds(error):
+    """Seconds from a Retry-After / retry-after-ms header, or None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _retry_delay(error, attempt):
+    """
+    Decide how to handle a failed call: returns seconds to sleep before the next
+    attempt, or None to give up now. Rate limits pause the governor (honoring
+    Retry-After); timeouts, connection errors and 5xx back off exponentially
+    with jitter; anything else (bad request, auth, quota exhausted) fails fast.
     """
+    if attempt >= MAX_RETRIES - 1:
+        return None
+
+    backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+    backoff *= random.uniform(0.5, 1.5)
+
+    if isinstance(error, openai.RateLimitError):
+        if getattr(error, "code", None) == "insufficient_quota":
+            return None
+        wait = _retry_after_seconds(error)
+        governor.pause(wait if wait is not None else backoff)
+        return 0
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return backoff
+    status = getattr(error, "status_code", None) or 0
+    if status in (408, 409) or status >= 500:
+        return backoff
+    return None
+
+def _resolve_api_key(api_key):
     if api_key is None:
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             logger.error("No API key provided. Please set OPENAI_API_KEY environment variable.")
-            return None
+    return api_key
 
-    # Estimate tokens (very rough)
-    total_token_estimate = int(sum(len(m["content"].split()) for m in messages) * 1.3)
+def _log_request_details(messages, model):
     logger.info("API Request Details:")
     logger.info(f"- Model: {model}")
     logger.info(f"- Timeout: {REQUEST_TIMEOUT}s")
     logger.info(f"- Message count: {len(messages)}")
-    logger.info(f"- Approx token count: {total_token_estimate}")
+    logger.info(f"- Input token count: {count_message_tokens(messages, model)}")
+
+def call_gpt_api(messages, api_key=None, model=MODEL, use_cache=True):
+    """
+    Call OpenAI API with retry logic and basic error handling.
+    If api_key is not provided, attempts to get it from environment variables.
+    Responses are stored in the persistent cache and served from it, unless
+    use_cache=False (or LLM_CACHE_BYPASS is set) forces a fresh call.
+    A one-request call_gpt_api_batch, so the cache and retry logic live in
+    call_gpt_api_async only; must be called from synchronous code.
+    """
+    return call_gpt_api_batch([messages], api_key, model=model, concurrency=1, use_cache=use_cache)[0]
+
+async def call_gpt_api_async(messages, client, model=MODEL, use_cache=True):
+    """
+    Send one request over a shared AsyncOpenAI 'client' (None when there is no
+    API key: only the cache can answer), retrying per _retry_delay under the
+    rate governor. Returns the response text or None.
+    The SQLite cache is read and written in a worker thread, so a slow or
+    locked cache file never blocks the other requests on the event loop.
+    """
+    key = cache_key(messages, model)
+    if use_cache and not LLM_CACHE_BYPASS:
+        cached = await asyncio.to_thread(cache_get, key)
+        if cached is not None:
+            logger.info(f"Cache hit for {model} request {key[:12]}.")
+            return cached
+    if client is None:
+        return None
+
+    _log_request_details(messages, model)
+    request_tokens = count_message_tokens(messages, model)
 
-    client = OpenAI(api_key=api_key)
     for attempt in range(MAX_RETRIES):
+        wait = governor.reserve(request_tokens)
+        if wait > 0:
+            logger.info(f"Rate governor: waiting {wait:.1f}s before sending.")
+            await asyncio.sleep(wait)
+        start_time = time.time()
         try:
             logger.info(f"Making API call (attempt {attempt+1}/{MAX_RETRIES}) to {model}...")
-            start_time = time.time()
-            response = client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=model,
                 messages=messages,
                 timeout=REQUEST_TIMEOUT
             )
             elapsed_time = time.time() - start_time
             logger.info(f"API call successful in {elapsed_time:.2f}s with model='{model}'")
-            return response.choices[0].message.content.strip()
+            content = response.choices[0].message.content.strip()
+            await asyncio.to_thread(cache_put, key, model, content)
+            return content
 
         except Exception as e:
-            elapsed_time = time.time() - start_time
             logger.error(f"Error on attempt {attempt+1}: {type(e).__name__}: {e}")
-            if attempt < MAX_RETRIES - 1:
-                logger.warning("Retrying in 2 seconds...")
-                time.sleep(2)
-            else:
+            delay = _retry_delay(e, attempt)
+            if delay is None:
                 return None
+            logger.warning(f"Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+def call_gpt_api_batch(messages_list, api_key=None, model=MODEL, concurrency=LLM_CONCURRENCY, use_cache=True):
+    """
+    Send several independent requests concurrently, with at most 'concurrency'
+    in flight, over one shared client. Returns the responses in the same order
+    as messages_list (None where a request failed). Without an API key, only
+    cached responses are returned.
+    Must be called from synchronous code (it runs its own event loop).
+    """
+    if not messages_list:
+        return []
+    api_key = _resolve_api_key(api_key)
+
+    async def _run_all():
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        # Retries are ours (governor-aware), not the client's
+        client = AsyncOpenAI(api_key=api_key, max_retries=0) if api_key else None
+
+        async def _run_one(messages):
+            async with semaphore:
+                return await call_gpt_api_async(messages, client, model=model, use_cache=use_cache)
+
+        try:
+            return await asyncio.gather(*(_run_one(m) for m in messages_list))
+        finally:
+            if client is not None:
+                await client.close()
+
+    logger.info(f"Dispatching {len(messages_list)} requests with concurrency {concurrency}.")
+    return list(asyncio.run(_run_all()))
+
+def format_handled_articles(handled_chunk):
+    """Prompt text for {handle: text}: one "Article <handle>:" block per article."""
+    return "".join(f"Article {handle}:\n{text}\n\n" for handle, text in handled_chunk.items())
+
+def _handle_to_link(value, links):
+    """
+    Map an article handle from an answer (1-based int, or a string like "3"
+    or "#3") back to its link; None for anything that isn't a handle of this chunk.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        m = re.fullmatch(r'\s*#?(\d+)\s*', value)
+        value = int(m.group(1)) if m else None
+    if isinstance(value, int) and 1 <= value <= len(links):
+        return links[value - 1]
+    return None
+
+def _resolve_handles(items, links, id_field):
+    """
+    Replace the handles in each item's id_field (a single handle or a list of
+    them) with article links. Unknown handles are dropped; an item whose
+    single handle is unknown is rejected.
+    """
+    resolved = []
+    rejected = 0
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        value = item.get(id_field)
+        if isinstance(value, list):
+            mapped = [_handle_to_link(v, links) for v in value]
+            rejected += mapped.count(None)
+            resolved.append({**item, id_field: [link for link in mapped if link is not None]})
+        else:
+            link = _handle_to_link(value, links)
+            if link is None:
+                rejected += 1
+                continue
+            resolved.append({**item, id_field: link})
+    if rejected:
+        logger.warning(f"Rejected {rejected} unknown article handles in LLM answer.")
+    return resolved
+
+def _covered_links(items, id_field):
+    covered = set()
+    for item in items:
+        value = item.get(id_field)
+        covered.update(value if isinstance(value, list) else [value])
+    return covered
+
+def call_gpt_api_chunks(chunks, build_messages, list_key, api_key=None, model=MODEL,
+                        id_field="article_id", max_split_depth=SALVAGE_MAX_SPLIT_DEPTH):
+    """
+    Send one request per chunk ({article_link: text}) and parse the
+    {"<list_key>": [...]} answers.
+
+    Prompts never carry the links: build_messages(handled_chunk, chunk) gets
+    {handle: text} with compact per-chunk handles 1..n (plus the chunk itself,
+    for prompts that depend on which articles it holds), and the answer's
+    id_field (a handle, or a list of handles) is mapped back to links, so the
+    items returned use links again. Unknown handles are rejected.
+
+    Answers are parsed with utils.parse_json_list, salvaging what it can from
+    malformed ones:
+
+      - the complete list elements of a malformed answer are kept;
+      - its remaining articles are split in half and re-sent (recursively, up
+        to max_split_depth times), so a bad answer costs its share of the
+        chunk instead of all of it.
+
+    Returns a list of (chunk_dict, messages, items): items is the parsed list,
+    or None if the request got no usable answer at all. Articles of a chunk
+    that no item covers are for the caller to record as failed (the pipeline
+    state re-queues them); answers that do not cover the whole chunk are
+    dropped from the LLM cache, so the retry is answered afresh.
+    """
+    results = []
+    pending = [(chunk, 0) for chunk in chunks if chunk]
+    while pending:
+        messages_list = [
+            build_messages({i: text for i, text in enumerate(chunk.values(), start=1)}, chunk)
+            for chunk, _ in pending
+        ]
+        responses = call_gpt_api_batch(messages_list, api_key, model=model)
+
+        retry = []
+        for (chunk, depth), messages, response in zip(pending, messages_list, responses):
+            if not response:
+                results.append((chunk, messages, None))
+                continue
+
+            items, complete = parse_json_list(response, list_key)
+            items = _resolve_handles(items, list(chunk), id_field)
+            if complete:
+                # An answer that leaves articles out is not reused either, or a
+                # retry of the same chunk would get it back instead of a new one
+                if not set(chunk) <= _covered_links(items, id_field):
+                    cache_invalidate(messages, model=model)
+                results.append((chunk, messages, items))
+                continue
+
+            # Don't serve the broken answer from the cache next time
+            cache_invalidate(messages, model=model)
+            covered = _covered_links(items, id_field)
+            rest = [link for link in chunk if link not in covered]
+            logger.warning(
+                f"Malformed JSON answer: salvaged {len(chunk) - len(rest)}/{len(chunk)} articles."
+            )
+            if not rest or depth >= max_split_depth:
+                results.append((chunk, messages, items or None))
+                continue
+
+            # Keep what was salvaged; the rest of the chunk is retried below
+            salvaged = {link: text for link, text in chunk.items() if link in covered}
+            if salvaged:
+                results.append((salvaged, messages, items))
+            half = max(1, len(rest) // 2)
+            for part in (rest[:half], rest[half:]):
+                if part:
+                    retry.append(({link: chunk[link] for link in part}, depth + 1))
+        pending = retry
+    return results
@@ -4,8 +4,12 @@ import sys
 import os
 import time
 import threading
+import traceback
 
+from db.database import setup_database
 from pipeline import run_full_pipeline_headless
+from db.archive import archive_old_articles
+from db.snapshot import publish_dashboard_snapshot
 
 # Reuse your existing functions for running scrapers in threads:
 # (e.g., from the old main.py code)
@@ -33,10 +37,16 @@ def run_all_scrapers_in_threads(scraper_scripts):
 def run_full_cycle(api_key):
     """
     Runs the entire cycle:
+      0) Bring the DB schema up to date (new tables/columns on upgraded installs)
       1) Scrape all sources
       2) Standardize dates
       3) Run the pipeline
+      4) Move old articles to the archive DB
+      5) Publish a read-only snapshot for the dashboard
     """
+    # 0) Every stage below assumes the current schema; this is a no-op once applied
+    setup_database("db/news.db")
+
     # 1) Run all scrapers in parallel
     scraper_scripts = [
         "scrapers/bleepingcomputer.py",
@@ -63,6 +73,18 @@ def run_full_cycle(api_key):
     logs = run_full_pipeline_headless(api_key=api_key, db_path="db/news.db")
     for line in logs:
         print(line)
+
+    # 4) Keep the hot DB small: archive articles past the retention age
+    archived = archive_old_articles(db_path="db/news.db")
+    print(f"Archived {archived} old articles.")
+
+    # 5) Give the dashboard a consistent copy it can read without ever
+    #    waiting on (or seeing half of) the pipeline's write transactions
+    #    (skipped when nothing changed since the last one)
+    if publish_dashboard_snapshot(db_path="db/news.db", refresh_archive=archived > 0):
+        print("Published dashboard snapshot.")
+    else:
+        print("Dashboard snapshot unchanged.")
     print("--- Finished pipeline cycle ---")
 
 def background_loop(api_key):
@@ -70,7 +92,12 @@ def background_loop(api_key):
     Background loop that repeats the entire pipeline every 15 minutes.
     """
     while True:
-        run_full_cycle(api_key)
+        try:
+            run_full_cycle(api_key)
+        except Exception as e:
+            # One failed cycle must not stop the loop (the thread would die silently)
+            print(f"Error in pipeline cycle: {e}")
+            traceback.print_exc()
         # Sleep 15 minutes
         time.sleep(15 * 60)
 
@@ -2,23 +2,45 @@
 # In app.py (or pipeline.py if you prefer a separate file)
 # -------------------------------------------------------------
 
+import os
+
+from llm_calls import get_cache_stats
+from analysis.combined_extraction import extract_companies_and_categories
+from analysis.subgroup_compaction import compact_subgroups
+from analysis.subgroup_summaries import update_subgroup_summaries
+from analysis.text_views import needs_view_measurement, measure_categorization_views
 from analysis.company_extraction import extract_company_names_for_all_articles
 from analysis.cve_extraction import process_cves_in_articles, update_cve_details_from_api
 from analysis.two_phase_grouping import (
-    get_ungrouped_articles_two_phase,
-    two_phase_grouping_with_predefined_categories,
-    save_two_phase_groups,
-    group_articles_within_category,
-    PREDEFINED_CATEGORIES
+    categorize_pending_articles,
+    group_articles_within_categories
 )
+from analysis.taxonomy import get_categories
+from db.database import get_input_watermark, stage_inputs_unchanged, save_stage_watermark
+from db.checkpoints import get_unfinished_runs
+
+# Set PIPELINE_COMBINED_EXTRACTION=1 to extract companies and categories of
+# new articles in one LLM pass (see analysis/combined_extraction.py)
+COMBINED_EXTRACTION = os.getenv("PIPELINE_COMBINED_EXTRACTION", "").lower() in ("1", "true", "yes")
+
+# CVE details are re-pulled at least this often, even without new mentions
+CVE_DETAILS_MAX_AGE_HOURS = float(os.getenv("CVE_DETAILS_MAX_AGE_HOURS", "24"))
 
-def run_full_pipeline_headless(api_key=None, db_path="db/news.db"):
+def run_full_pipeline_headless(api_key=None, db_path="db/news.db", combined_extraction=None):
     """
     Run all steps in one go, but WITHOUT any Streamlit calls.
     If api_key is not provided, attempts to get it from environment variable.
+    With combined_extraction (default: COMBINED_EXTRACTION), new articles get
+    their companies and category from a single LLM call; steps 1 and 4 then
+    only pick up what that pass left over.
+    Chunked LLM stages checkpoint every chunk (see db/checkpoints.py), so a
+    run interrupted by a restart is resumed from its first incomplete chunk.
+    Steps 2, 3 and 5 are skipped when their input tables did not change
+    since their last successful run (see get_input_watermark).
     Returns a dict of messages or logs that you can print or ignore.
     """
-    import os
+    if combined_extraction is None:
+        combined_extraction = COMBINED_EXTRACTION
     if api_key is None:
         api_key = os.getenv('OPENAI_API_KEY')
         if not api_key:
@@ -26,47 +48,89 @@ def run_full_pipeline_headless(api_key=None, db_path="db/news.db"):
 
     logs = []
 
+    # Runs a killed process left behind; each stage resumes its own below
+    for stage, scope, done, total in get_unfinished_runs(db_path=db_path):
+        logs.append(f"Resuming unfinished {stage} run{f' ({scope})' if scope else ''}: "
+                    f"{done or 0} of {total} chunks were done.")
+
+    # 0) Optional: companies + category of new articles in one pass
+    if combined_extraction:
+        logs.append("Extracting companies and categories in one pass...")
+        processed = extract_companies_and_categories(api_key, db_path=db_path)
+        logs.append(f"Done combined extraction for {processed} articles.")
+
     # 1) Extract company names
     logs.append("Extracting company names...")
     extract_company_names_for_all_articles(api_key, db_path=db_path)
     logs.append("Done extracting company names.")
 
-    # 2) Extract CVE mentions
-    logs.append("Extracting CVE mentions from articles...")
-    process_cves_in_articles(db_path=db_path)
-    logs.append("Done extracting CVE mentions.")
+    # 2) Extract CVE mentions (only when articles were written)
+    watermark = get_input_watermark(("articles",), db_path=db_path)
+    if stage_inputs_unchanged("cves", watermark, db_path=db_path):
+        logs.append("Skipped CVE extraction: articles unchanged since the last run.")
+    else:
+        logs.append("Extracting CVE mentions from articles...")
+        process_cves_in_articles(db_path=db_path)
+        save_stage_watermark("cves", watermark, db_path=db_path)
+        logs.append("Done extracting CVE mentions.")
 
-    # 3) Pull CVE details from MITRE
-    logs.append("Pulling CVE details from MITRE API...")
-    update_cve_details_from_api(db_path=db_path)
-    logs.append("Done pulling CVE details.")
+    # 3) Pull CVE details from MITRE (on new mentions, or once they are stale)
+    watermark = get_input_watermark(("article_cves",), db_path=db_path)
+    if stage_inputs_unchanged("cve_details", watermark,
+                              max_age_hours=CVE_DETAILS_MAX_AGE_HOURS, db_path=db_path):
+        logs.append("Skipped pulling CVE details: no new CVE mentions since the last run.")
+    else:
+        logs.append("Pulling CVE details from MITRE API...")
+        update_cve_details_from_api(db_path=db_path)
+        save_stage_watermark("cve_details", watermark, db_path=db_path)
+        logs.append("Done pulling CVE details.")
 
     # 4) Group ungrouped articles into top-level categories
-    df = get_ungrouped_articles_two_phase(db_path=db_path)
-    if df.empty:
+    #    (first, once: measure how little of each article categorization needs)
+    if needs_view_measurement("categorization", db_path=db_path):
+        accuracies = measure_categorization_views(api_key, db_path=db_path)
+        if accuracies:
+            logs.append("Measured categorization text views: " + ", ".join(
+                f"{view} {acc:.0%}" for view, acc in accuracies.items()
+            ))
+    #    (streamed in checkpointed batches; unfinished runs are resumed first)
+    categorized = categorize_pending_articles(api_key, db_path=db_path)
+    if categorized:
+        logs.append(f"Categorized {categorized} articles into top-level groups.")
+    else:
         logs.append("No ungrouped articles found for top-level grouping.")
+
+    # 5) Sub-group articles for each category of the current taxonomy
+    #    (categories run in parallel on a worker pool, see SUBGROUP_WORKERS)
+    #    (skipped when no article was categorized and no retry came due)
+    categories = get_categories(db_path=db_path)
+    watermark = get_input_watermark(("two_phase_article_group_memberships",),
+                                    retry_stage="subgrouping", db_path=db_path)
+    if stage_inputs_unchanged("subgrouping", watermark, db_path=db_path):
+        logs.append("Skipped sub-grouping: category memberships unchanged since the last run.")
     else:
-        logs.append(f"Found {len(df)} articles needing top-level grouping.")
-        summaries_dict = {}
-        for _, row in df.iterrows():
-            s = str(row["expanded_summary"]).strip()
-            if s:
-                summaries_dict[row["article_link"]] = s
-        if summaries_dict:
-            result = two_phase_grouping_with_predefined_categories(summaries_dict, api_key, db_path=db_path)
-            if result["groups"]:
-                save_two_phase_groups(result, db_path=db_path)
-                logs.append("Saved top-level groups.")
+        logs.append("Sub-grouping for each category...")
+        totals = group_articles_within_categories(categories, api_key, db_path=db_path)
+        for cat in categories:
+            if totals[cat] is None:
+                logs.append(f"Sub-grouping FAILED for category: {cat} (its articles stay pending)")
             else:
-                logs.append("No groups created in two-phase approach.")
-        else:
-            logs.append("No valid summaries for top-level grouping.")
+                logs.append(f"Finished grouping articles for category: {cat} ({totals[cat]} new subgroups)")
+        if None not in totals.values():
+            save_stage_watermark("subgrouping", watermark, db_path=db_path)
+
+    # 6) Periodically merge subgroups that cover the same story
+    for cat, removed in compact_subgroups(categories, api_key, db_path=db_path).items():
+        logs.append(f"Compacted subgroups of category: {cat} ({removed} merged away)")
 
-    # 5) Sub-group articles for each predefined category
-    logs.append("Sub-grouping for each predefined category...")
-    for cat in PREDEFINED_CATEGORIES:
-        group_articles_within_category(cat, api_key, db_path=db_path)
-        logs.append(f"Finished grouping articles for category: {cat}")
+    # 7) Roll subgroup summaries forward over the articles added since
+    updated = update_subgroup_summaries(api_key, db_path=db_path)
+    logs.append(f"Updated {updated} subgroup summaries.")
 
+    stats = get_cache_stats()
+    logs.append(
+        f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['entries']} entries ({stats['evictions']} evicted)."
+    )
     logs.append("All steps in the pipeline are complete.")
     return logs
@@ -6,9 +6,19 @@ and the CVE regex from the original code.
 """
 
 import re
+import json
 import hashlib
 
-MAX_TOKEN_CHUNK = 70000  # from the original script (~70k tokens)
+from tokenizer import count_tokens, get_model_limits
+
+MAX_TOKEN_CHUNK = 70000  # from the original script (~70k tokens); per-call input cap for latency
+# Output room kept free in every request (o-series models spend output tokens on reasoning)
+OUTPUT_RESERVE_TOKENS = 20000
+# Prompt tokens per article besides its text (the "Article <handle>:" line)
+ARTICLE_OVERHEAD_TOKENS = 8
+# Streamed articles are handed to a stage in batches of this many chunks'
+# worth of tokens: enough to pack chunks tightly and send them concurrently
+STREAM_BATCH_CHUNKS = 4
 CVE_REGEX = r'\bCVE-\d{4}-\d{4,7}\b'
 
 def generate_content_hash(text):
@@ -16,39 +26,146 @@ def generate_content_hash(text):
     return hashlib.md5(text.encode()).hexdigest()
 
 def approximate_tokens(text: str) -> int:
-    """Roughly estimate tokens by counting words and multiplying by ~1.3."""
-    return int(len(text.split()) * 1.3)
-
-def chunk_summaries(summaries_dict, max_token_chunk=MAX_TOKEN_CHUNK):
-    """
-    Splits article summaries into chunks without exceeding max_token_chunk.
-    If a single article alone exceeds max_token_chunk, yield it alone.
-    """
-    current_chunk = {}
-    current_tokens = 0
-
-    for link, summary in summaries_dict.items():
-        tokens_for_article = approximate_tokens(summary)
-        if tokens_for_article > max_token_chunk:
-            # If article alone exceeds chunk limit, yield current then yield it alone
-            if current_chunk:
-                yield current_chunk
-                current_chunk = {}
-                current_tokens = 0
-            yield {link: summary}
-            continue
+    """Token count of 'text' (BPE, see tokenizer.count_tokens)."""
+    return count_tokens(text)
+
+def chunk_token_budget(model=None,
+                       max_token_chunk=MAX_TOKEN_CHUNK,
+                       reserve_output_tokens=OUTPUT_RESERVE_TOKENS,
+                       prompt_tokens=0):
+    """
+    Input tokens available for articles in one request to 'model': its context
+    window minus the reserved output room and the fixed prompt, capped at
+    max_token_chunk.
+    """
+    context = get_model_limits(model)["context"]
+    return max(1, min(max_token_chunk, context - reserve_output_tokens - prompt_tokens))
+
+def pack_summaries(summaries_dict,
+                   model=None,
+                   max_token_chunk=MAX_TOKEN_CHUNK,
+                   reserve_output_tokens=OUTPUT_RESERVE_TOKENS,
+                   prompt_tokens=0,
+                   output_tokens_per_article=0):
+    """
+    Split article summaries into as few chunks as possible with first-fit
+    decreasing bin packing, using exact token counts.
+
+    Each article costs its text tokens + ARTICLE_OVERHEAD_TOKENS +
+    output_tokens_per_article (its share of the JSON answer); a chunk holds at
+    most chunk_token_budget(...) of that. An article that alone exceeds the
+    budget gets a chunk of its own. Yields {link: summary} dicts, largest first.
+    """
+    budget = chunk_token_budget(model, max_token_chunk, reserve_output_tokens, prompt_tokens)
+    sized = sorted(
+        ((count_tokens(summary, model) + ARTICLE_OVERHEAD_TOKENS + output_tokens_per_article, link)
+         for link, summary in summaries_dict.items()),
+        reverse=True
+    )
 
-        if current_tokens + tokens_for_article > max_token_chunk:
-            if current_chunk:
-                yield current_chunk
-            current_chunk = {link: summary}
-            current_tokens = tokens_for_article
+    bins = []  # [remaining_tokens, {link: summary}]
+    for size, link in sized:
+        for b in bins:
+            if b[0] >= size:
+                b[0] -= size
+                b[1][link] = summaries_dict[link]
+                break
         else:
-            current_chunk[link] = summary
-            current_tokens += tokens_for_article
+            bins.append([budget - size, {link: summaries_dict[link]}])
+
+    for _, chunk in bins:
+        yield chunk
+
+def batch_summaries(rows,
+                    model=None,
+                    max_token_chunk=MAX_TOKEN_CHUNK,
+                    reserve_output_tokens=OUTPUT_RESERVE_TOKENS,
+                    prompt_tokens=0,
+                    output_tokens_per_article=0,
+                    batch_chunks=STREAM_BATCH_CHUNKS):
+    """
+    Group a stream of (link, summary) pairs into {link: summary} batches of at
+    most batch_chunks chunks' worth of tokens (sized as in pack_summaries),
+    reading only as far into 'rows' as the current batch needs. Each batch is
+    then packed and sent on its own, so memory is bounded by one batch no
+    matter how many articles are pending.
+    """
+    budget = batch_chunks * chunk_token_budget(model, max_token_chunk, reserve_output_tokens, prompt_tokens)
+    batch, used = {}, 0
+    for link, summary in rows:
+        size = count_tokens(summary, model) + ARTICLE_OVERHEAD_TOKENS + output_tokens_per_article
+        if batch and used + size > budget:
+            yield batch
+            batch, used = {}, 0
+        batch[link] = summary
+        used += size
+    if batch:
+        yield batch
+
+def _decode_objects(text):
+    """Yield (start, end, value) for every JSON object that decodes at a '{' in text."""
+    decoder = json.JSONDecoder()
+    for m in re.finditer(r'\{', text):
+        try:
+            value, end = decoder.raw_decode(text, m.start())
+        except ValueError:
+            continue
+        yield m.start(), end, value
+
+def _salvage_array_items(text, list_key):
+    """
+    Complete elements of the (possibly truncated) array under "list_key",
+    e.g. from a response cut off mid-way. Stops at the first broken element.
+    """
+    m = re.search(r'"%s"\s*:\s*\[' % re.escape(list_key), text)
+    if not m:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    pos = m.end()
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        try:
+            value, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        items.append(value)
+    return items
+
+def parse_json_list(response, list_key):
+    """
+    Tolerant parsing of an LLM JSON answer of the form {"<list_key>": [...]}.
+    Returns (items, complete):
+      - the whole answer (or the largest valid object in it, ignoring code
+        fences and chatter around it) parses: (its list, True)
+      - otherwise: (the complete array elements that could be recovered, False)
+    """
+    if not response:
+        return [], False
+    text = response.strip()
+    fenced = re.search(r'```(?:json)?\s*(.*?)\s*(?:```|$)', text, flags=re.DOTALL | re.IGNORECASE)
+    if fenced:
+        text = fenced.group(1)
+
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and isinstance(data.get(list_key), list):
+            return data[list_key], True
+    except ValueError:
+        pass
+
+    best = None
+    for start, end, value in _decode_objects(text):
+        if isinstance(value, dict) and isinstance(value.get(list_key), list):
+            if best is None or end - start > best[0]:
+                best = (end - start, value[list_key])
+    if best is not None:
+        return best[1], True
 
-    if current_chunk:
-        yield current_chunk
+    return _salvage_array_items(text, list_key), False
 
 def extract_cves(text: str):
     """Extract a set of unique CVE numbers from the provided text."""